@@ -1,5 +1,3 @@
-import requests
-import openai
 import re
 import plugins
 import os
@@ -9,109 +7,39 @@ from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
 from datetime import datetime, timedelta
-from collections import defaultdict
+from concurrent.futures import as_completed
+import threading
+import time as time_module
 import traceback
 
-# OpenAI配置
-OPENAI_API_KEY = None  # 从配置文件中加载
-OPENAI_API_BASE = "https://api.openai.com/v1"  # 默认API基础URL
-OPENAI_MODEL = "gpt-3.5-turbo"  # 默认模型
-OPENAI_API_VERSION = "v1"  # 默认API版本
-USE_OPENAI = False  # 是否使用OpenAI筛选功能
-
-# 预定义热门中转站映射
-TRANSFER_STATIONS = {
-    # 格式：("出发城市", "目的城市"): ["中转站1", "中转站2", ...]
-    ("成都", "上海"): ["武汉", "郑州", "南京"],
-    ("北京", "广州"): ["郑州", "武汉", "长沙"],
-    ("西安", "上海"): ["郑州", "合肥"],
-    ("北京", "成都"): ["郑州", "西安"],
-    ("广州", "北京"): ["武汉", "郑州"],
-    ("上海", "成都"): ["武汉", "重庆"],
-    ("深圳", "北京"): ["长沙", "武汉", "郑州"],
-    ("重庆", "上海"): ["武汉", "合肥"],
-    ("杭州", "成都"): ["武汉", "重庆"],
-    ("成都", "杭州"): ["重庆", "武汉"]
-}
-
-# 全国主要铁路枢纽站（用于动态计算中转）
-MAJOR_STATIONS = [
-    "北京", "上海", "广州", "深圳", "杭州", "南京", "武汉", 
-    "郑州", "西安", "成都", "重庆", "长沙", "合肥", "济南",
-    "天津", "沈阳", "哈尔滨", "太原", "兰州", "南昌", "昆明",
-    "福州", "厦门", "宁波", "青岛", "大连", "贵阳"
-]
-
-# 尝试从插件目录加载配置
-try:
-    plugin_dir = os.path.dirname(os.path.abspath(__file__))
-    config_path = os.path.join(plugin_dir, "config.json")
-    logger.info(f"尝试从 {config_path} 加载配置")
-    
-    if os.path.exists(config_path):
-        logger.info(f"配置文件存在，尝试读取内容")
-        try:
-            with open(config_path, 'r', encoding='utf-8') as f:
-                file_content = f.read()
-                logger.info(f"读取到配置文件内容: {file_content[:100]}...")
-                plugin_config = json.loads(file_content)
-                
-            logger.info(f"配置文件解析结果: {json.dumps(plugin_config, ensure_ascii=False)}")
-            
-            OPENAI_API_KEY = plugin_config.get("open_ai_api_key")
-            if OPENAI_API_KEY:
-                OPENAI_API_BASE = plugin_config.get("open_ai_api_base", OPENAI_API_BASE)
-                OPENAI_MODEL = plugin_config.get("open_ai_model", OPENAI_MODEL)
-                # 检查API版本配置
-                OPENAI_API_VERSION = plugin_config.get("open_ai_api_version", OPENAI_API_VERSION)
-                logger.info(f"检测到API版本配置: {OPENAI_API_VERSION}")
-                USE_OPENAI = True
-                logger.info(f"从插件配置加载OpenAI设置成功！API密钥: {OPENAI_API_KEY[:8]}..., API基础URL: {OPENAI_API_BASE}, 模型: {OPENAI_MODEL}, API版本: {OPENAI_API_VERSION}")
-            else:
-                logger.warning("插件配置中未找到有效的OpenAI API密钥")
-        except Exception as read_error:
-            logger.error(f"读取配置文件出错: {read_error}")
-            logger.error(traceback.format_exc())
-    else:
-        logger.warning(f"插件配置文件不存在: {config_path}")
-        
-    # 如果插件配置不可用，尝试从全局配置加载
-    if not USE_OPENAI:
-        logger.info("插件配置不可用，尝试从全局配置加载")
-        try:
-            from config import conf
-            config = conf()
-            if hasattr(config, "get"):
-                OPENAI_API_KEY = config.get("open_ai_api_key")
-                if OPENAI_API_KEY:
-                    OPENAI_API_BASE = config.get("open_ai_api_base", OPENAI_API_BASE)
-                    OPENAI_MODEL = config.get("open_ai_model", OPENAI_MODEL)
-                    USE_OPENAI = True
-                    logger.info(f"从全局配置加载OpenAI设置成功！API基础URL: {OPENAI_API_BASE}, 模型: {OPENAI_MODEL}")
-                else:
-                    logger.warning("全局配置中未找到有效的OpenAI API密钥")
-        except Exception as e:
-            logger.warning(f"加载全局OpenAI配置失败: {e}")
-            
-except Exception as e:
-    logger.error(f"加载配置时出错: {e}")
-    logger.error(traceback.format_exc())
+from .ticket_engine import (
+    AVAILABLE_PATTERNS, CHEAPEST_PATTERNS, ConfigWatcher, DATE_RANGE_PATTERN, Deadline, FilterPlan,
+    MAJOR_STATIONS, PLAN_FIELDS, PLAN_OPERATORS, PLAN_SEAT_NAMES, PRIORITY_FANOUT, PRIORITY_PREFETCH,
+    PriceCalendar, QuerySession, RESET_FILTER_PATTERN, RuleQueryParser, SeatWatcher, SessionStore, TTLCache,
+    TicketEngine, UNWATCH_COMMAND_PATTERN, WATCH_COMMAND_PATTERN, WatchSubscription, encode_train_table,
+    encode_transfer_table, inventory_count, inventory_text, lazy_openai, lazy_requests,
+    load_station_dictionary, normalize_query, normalize_ticket_type, order_filtered_results, pack_table,
+    parse_chinese_number, parse_date_range, parse_matched_indices, plan_decode, plan_encode, relative_dates,
+    seconds_until_midnight, train_order_keys, train_ticket_type, transfer_order_keys
+)
+
+
+class _SessionField:
+    """插件上按会话隔离的字段：读写当前线程正在处理的会话"""
+
+    def __set_name__(self, owner, name):
+        self.name = name
 
-# 初始化OpenAI客户端
-if USE_OPENAI:
-    try:
-        openai.api_key = OPENAI_API_KEY
-        openai.api_base = OPENAI_API_BASE
-        logger.info(f"OpenAI客户端已初始化 - 基础URL: {openai.api_base}, API密钥前8位: {OPENAI_API_KEY[:8]}...")
-    except Exception as init_error:
-        logger.error(f"初始化OpenAI客户端失败: {init_error}")
-        logger.error(traceback.format_exc())
-        USE_OPENAI = False
+    def __get__(self, plugin, owner=None):
+        if plugin is None:
+            return self
+        return getattr(plugin._current_session(), self.name)
 
-logger.info(f"OpenAI筛选功能状态: {'已启用' if USE_OPENAI else '未启用'}")
+    def __set__(self, plugin, value):
+        session = plugin._current_session()
+        setattr(session, self.name, value)
+        session.dirty = True
 
-# 高铁API基础URL
-BASE_URL_HIGHSPEEDTICKET = "https://api.pearktrue.cn/api/highspeedticket"
 
 @plugins.register(name="TicketQuery",
                   desc="智能票务查询插件",
@@ -119,99 +47,202 @@ BASE_URL_HIGHSPEEDTICKET = "https://api.pearktrue.cn/api/highspeedticket"
                   author="sofs2005",
                   desire_priority=10)
 class TicketQuery(Plugin):
-    content = None
-    ticket_info_list = []
-    intermediate_ticket_info_list = []
-    conversation_history = []
-    last_interaction_time = None
-    is_approximate_time = False
-    approximate_time = None
-    original_query = None
-    
-    # 新增字段，用于保存原始查询结果
-    original_data = []  # 存储原始查询结果
-    total_data = []     # 存储当前筛选结果
-    current_page = 1
-
-    def __init__(self):
+    # 查询状态按会话隔离（见QuerySession），不同用户、群聊的结果和分页互不影响
+    original_query = _SessionField()
+    original_data = _SessionField()  # 存储原始查询结果
+    total_data = _SessionField()     # 存储当前筛选结果
+    current_page = _SessionField()
+    is_transfer_query = _SessionField()
+    seat_index = _SessionField()     # 当前直达结果的座位索引
+    renderer = _SessionField()       # 查询结果渲染器，保存结果时预先生成每个条目的文本
+
+    def __init__(self, config_path=None):
         super().__init__()
         self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
         
-        # 初始化分页相关属性
-        self.current_page = 1
-        self.page_size = 10  # 每页显示10条
-        self.last_query_params = None  # 保存上次查询参数
-        # 初始化近似时间属性
-        self.is_approximate_time = False
-        self.approximate_time = None
-        self.original_query = None
+        # 会话状态：当前线程正在处理的会话和消息内容；不在消息处理中时使用默认会话
+        self._local = threading.local()
+        self._default_session = QuerySession("default")
+        self._session_lock = threading.Lock()
+        
+        # 加载配置（只在这里读取一次文件，之后仅在config.json修改时重新加载；LLM客户端在首次使用时创建）
+        # config_path供独立运行时指定配置文件，框架加载插件时使用插件目录下的config.json
+        plugin_dir = os.path.dirname(os.path.abspath(__file__))
+        self.config_watcher = ConfigWatcher(config_path or os.path.join(plugin_dir, "config.json"))
+        
+        # 车票查询引擎：API请求、车票缓存、限流和线程池，插件与其他调用方共用
+        self.engine = TicketEngine(self.config_watcher)
         
-        # 重新加载OpenAI配置，确保配置正确加载
-        self._load_openai_config()
+        # LLM自然语言解析结果缓存，键中包含当天日期，保证"明天""周五"等相对日期正确
+        self.parse_cache = self.engine.make_cache("自然语言解析", self._config().parse_cache_size)
+        # 本地规则解析器，高置信度的查询不再调用LLM
+        self.rule_parser = RuleQueryParser(load_station_dictionary())
+        self.rule_parse_stats = {"total": 0, "confident": 0}
+        # LLM编译的筛选计划缓存，键为(结果类型, 规范化后的问题)
+        self.plan_cache = self.engine.make_cache("筛选计划", self._config().plan_cache_size, self._config().plan_cache_ttl,
+                                           encode=plan_encode, decode=plan_decode)
+        # 余票订阅，轮询线程在第一个订阅时启动
+        self.watcher = SeatWatcher(self._poll_watch_route, self._deliver_watch, self._submit_watch_poll)
+        # 会话快照，重启后在会话首次被访问时读取
+        self.session_store = SessionStore(
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "sessions"),
+            lambda func, *args: self._executor("store", 1).submit(func, *args),
+            max_bytes=self._config().session_store_max_mb * 1024 * 1024,
+            ttl=self._config().session_store_ttl)
+        # 会话状态，超过session_ttl未活动的会话自动清理
+        self.sessions = TTLCache("会话", max_size=self._config().session_limit,
+                                 default_ttl=self._config().session_ttl)
+        # 异步查询的排队统计
+        self._reply_lock = threading.Lock()
+        self.reply_stats = {"pending": 0, "submitted": 0, "completed": 0, "rejected": 0,
+                            "wait_total": 0.0, "wait_max": 0.0}
         
-        logger.info(f"[{__class__.__name__}] 初始化完成，OpenAI状态: {'已启用' if USE_OPENAI else '未启用'}")
+        logger.info(f"[{__class__.__name__}] 初始化完成，OpenAI状态: {'已启用' if self._config().use_openai else '未启用'}")
+
+    def _config(self):
+        """获取当前配置快照"""
+        return self.config_watcher.current()
+
+    @property
+    def content(self):
+        """当前线程正在处理的消息内容（解析后会被替换为标准格式）"""
+        return getattr(self._local, "content", None)
+
+    @content.setter
+    def content(self, value):
+        self._local.content = value
+
+    def _executor(self, name, workers):
+        """按用途复用的线程池，与车票查询引擎共用"""
+        return self.engine.executor(name, workers)
+
+    def _current_session(self):
+        return getattr(self._local, "session", None) or self._default_session
+
+    def _bind(self, session, content, deadline=None):
+        """把会话、消息内容和耗时预算绑定到当前线程"""
+        self._local.session = session
+        self._local.content = content
+        self._local.deadline = deadline
+
+    def _current_deadline(self):
+        """当前消息的耗时预算；不在消息处理中（如直接调用查询方法）时不限时"""
+        return getattr(self._local, "deadline", None) or Deadline()
+
+    def _save_session(self, session):
+        """会话状态有修改时，在后台保存快照；调用时需持有session.lock"""
+        if not session.dirty or not session.original_data or not self._config().session_store:
+            return
+        session.dirty = False
+        self.session_store.save(session.session_id, session.snapshot())
 
-    def _load_openai_config(self):
-        """重新加载OpenAI配置"""
-        global USE_OPENAI, OPENAI_API_KEY, OPENAI_API_BASE, OPENAI_MODEL, OPENAI_API_VERSION
+    def _session_for(self, context):
+        """按session_id获取会话状态，不存在时创建；每次访问都刷新有效期"""
+        session_id = context.get("session_id") or context.get("receiver") or "default"
+        with self._session_lock:
+            config = self._config()
+            session = self.sessions.get(session_id)
+            if (session is not None and config.session_store and config.cache_backend == "sqlite"
+                    and not session.dirty and not session.pending
+                    and self.session_store.changed_elsewhere(session_id)):
+                # 多进程部署时，该会话的上一条消息可能由其他进程处理
+                logger.info(f"会话快照已被其他进程更新，重新读取: {session_id}")
+                session = None
+            if session is None:
+                state = self.session_store.load(session_id) if config.session_store else None
+                if state is not None:
+                    session = QuerySession.restore(session_id, state)
+                    logger.info(f"从快照恢复查询会话: {session_id}，{len(session.original_data)}条结果，"
+                                f"第{session.current_page}页")
+                else:
+                    session = QuerySession(session_id)
+                    logger.info(f"创建查询会话: {session_id}，当前会话数: {len(self.sessions) + 1}")
+            self.sessions.set(session_id, session)
+            return session
+
+    @property
+    def page_size(self):
+        return self._config().page_size
+
+    def _chat_completion(self, prompt, temperature=0.3, max_tokens=1000, timeout=None, deadline=None):
+        """调用LLM并返回文本结果，兼容新旧版openai SDK，SDK调用失败时回退到HTTP直连
+
+        超时时间不超过本条消息剩余的耗时预算，预算已用完时抛出DeadlineExceeded。
+        """
+        config = self._config()
+        deadline = deadline or self._current_deadline()
+        deadline.check("LLM调用")
+        timeout = deadline.timeout(config.llm_timeout if timeout is None else timeout)
+        openai, client = lazy_openai(config)
+        messages = [{"role": "user", "content": prompt}]
         
         try:
-            # 获取插件目录路径
-            plugin_dir = os.path.dirname(os.path.abspath(__file__))
-            config_path = os.path.join(plugin_dir, "config.json")
-            
-            if os.path.exists(config_path):
-                try:
-                    with open(config_path, 'r', encoding='utf-8') as f:
-                        file_content = f.read()
-                        plugin_config = json.loads(file_content)
-                    
-                    # 提取OpenAI配置
-                    OPENAI_API_KEY = plugin_config.get("open_ai_api_key")
-                    if OPENAI_API_KEY:
-                        OPENAI_API_BASE = plugin_config.get("open_ai_api_base", OPENAI_API_BASE)
-                        OPENAI_MODEL = plugin_config.get("open_ai_model", OPENAI_MODEL)
-                        OPENAI_API_VERSION = plugin_config.get("open_ai_api_version", OPENAI_API_VERSION)
-                        
-                        # 检查API基础URL是否已包含API版本
-                        if OPENAI_API_BASE.endswith(f"/{OPENAI_API_VERSION}"):
-                            pass
-                        else:
-                            # 如果URL不是以/结尾，添加/
-                            if not OPENAI_API_BASE.endswith("/"):
-                                OPENAI_API_BASE += "/"
-                            # 再添加版本号（但不重复添加）
-                            if not OPENAI_API_BASE.endswith(f"{OPENAI_API_VERSION}/"):
-                                OPENAI_API_BASE += f"{OPENAI_API_VERSION}"
-                        
-                        USE_OPENAI = True
-                        
-                        # 初始化OpenAI客户端
-                        openai.api_key = OPENAI_API_KEY
-                        openai.api_base = OPENAI_API_BASE
-                        
-                        logger.info(f"OpenAI配置加载成功")
-                    else:
-                        logger.warning("未找到有效的OpenAI API密钥")
-                        USE_OPENAI = False
-                except Exception as e:
-                    logger.error(f"配置文件读取失败: {e}")
-                    USE_OPENAI = False
-            else:
-                logger.warning(f"配置文件不存在: {config_path}")
-                USE_OPENAI = False
-        except Exception as e:
-            logger.error(f"加载OpenAI配置出错: {e}")
-            USE_OPENAI = False
+            if client is not None:
+                # openai>=1.0 客户端
+                response = client.chat.completions.create(
+                    model=config.model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    timeout=timeout
+                )
+                return response.choices[0].message.content.strip()
             
-        return USE_OPENAI
+            try:
+                # 旧版ChatCompletion API
+                response = openai.ChatCompletion.create(
+                    model=config.model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    api_key=config.api_key,
+                    api_base=config.api_base,
+                    request_timeout=timeout
+                )
+                return response.choices[0].message.content.strip()
+            except AttributeError:
+                # 更旧的Completion API
+                response = openai.Completion.create(
+                    model=config.model,
+                    prompt=prompt,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    api_key=config.api_key,
+                    api_base=config.api_base,
+                    request_timeout=timeout
+                )
+                return response.choices[0].text.strip()
+                
+        except Exception as sdk_error:
+            logger.warning(f"SDK调用LLM失败，改用HTTP直连: {sdk_error}")
+        
+        # 使用HTTP直接请求
+        requests = lazy_requests()
+        api_url = f"{config.api_base.rstrip('/')}/chat/completions"
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {config.api_key}"
+        }
+        payload = {
+            "model": config.model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        }
+        deadline.check("LLM调用")
+        response = requests.post(api_url, headers=headers, json=payload, timeout=deadline.timeout(timeout))
+        if response.status_code != 200:
+            raise Exception(f"HTTP请求失败: {response.text}")
+        return response.json()["choices"][0]["message"]["content"].strip()
 
     def get_help_text(self, **kwargs):
         help_text = """【使用说明】
 1. 基础查询（显示前10条）：
    - 票种 出发地 终点地 （例：高铁 北京 上海）
    - 票种 出发地 终点地 日期 （例：高铁 北京 上海 2024-06-05）
-   - 票种 出发地 终点地 日期 时间 （例：高铁 北京 上海 2024-06-05 09:00）
+   - 票种 出发地 终点地 日期 时间 （例：高铁 北京 上海 2024-06-05 09:00，前后30分钟内发车）
+   - 时间也可以写成 14:00之后、08:00之前 或 上午、下午、晚上
+   - 票种 出发地 终点地 日期范围 （例：高铁 北京 上海 2024-06-05~2024-06-12，返回每天最低价）
 
 2. 自然语言查询：
    - "查明天上午从北京到上海的高铁"
@@ -221,30 +252,44 @@ class TicketQuery(Plugin):
    - +下一页：查看后续结果
    - +上一页：返回前页结果
 
-4. 后续筛选：
+4. 后续筛选（在当前结果上继续筛选）：
    - +最便宜的二等座
    - +上午出发的车次
+   - +全部：回到全部查询结果（如 +全部 有商务座的车）
 
 5. 中转查询：
-   - 中转+高铁 成都 上海 2024-06-05 09:00"""
+   - 中转+高铁 成都 上海 2024-06-05 09:00
+
+6. 余票订阅（余票变化时主动通知，发车后自动取消）：
+   - 订阅 车次 出发地 终点地 日期 [座位] （例：订阅 G1 北京 上海 2024-06-05 二等座）
+   - 我的订阅：查看当前订阅
+   - 取消订阅 [车次]：取消指定车次或全部订阅"""
         return help_text
 
     def on_handle_context(self, e_context: EventContext):
         if e_context['context'].type != ContextType.TEXT:
             return
             
-        self.content = e_context["context"].content.strip()
+        # 会话在确定交给车票处理函数后（_dispatch）才获取，无关的聊天消息不占用会话缓存
+        self._bind(None, e_context["context"].content.strip(), Deadline(self._config().query_budget))
+        try:
+            self._route_message(e_context)
+        finally:
+            self._bind(None, None)
+
+    def _route_message(self, e_context):
+        """判断消息类型并交给对应的处理函数；耗时的查询在异步模式下提交到线程池执行"""
         logger.info(f"收到查询内容：{self.content}")
 
         # 处理分页命令
         if self.content in ["+下一页", "+上一页"]:
-            self._handle_pagination(e_context)
+            self._dispatch(e_context, self._handle_pagination, quick=True)
             return
 
         # 处理后续筛选问题
         if self.content.startswith("+"):
             logger.info("处理筛选请求")
-            self._handle_followup_question(e_context)
+            self._dispatch(e_context, self._handle_followup_question)
             return
             
         # 处理帮助命令
@@ -257,19 +302,39 @@ class TicketQuery(Plugin):
             e_context.action = EventAction.BREAK_PASS
             return
         
+        # 余票订阅命令
+        if re.match(r"订阅\s*[A-Za-z]?\d", self.content):
+            self._dispatch(e_context, self._handle_watch_command)
+            return
+        if self.content == "我的订阅" or UNWATCH_COMMAND_PATTERN.match(self.content):
+            self._dispatch(e_context, self._handle_watch_list, quick=True)
+            return
+        
         # 检查是否是中转查询，直接处理不需要判断
         is_transfer_query = self.content.startswith("中转") or "换乘" in self.content
         if is_transfer_query:
             logger.info("处理中转查询请求")
-            self._handle_transfer_query(e_context)
+            self._dispatch(e_context, self._handle_transfer_query)
             return
         
         # 使用关键词进行初步筛选
         is_potential_query = self._is_potential_ticket_query(self.content)
         
-        # 只有在可能是车票查询的情况下，才使用LLM进行精确判断
+        # 日期范围查询（如"高铁 北京 上海 2024-06-05~2024-06-12"），并发查询每一天并返回价格日历
+        range_match = DATE_RANGE_PATTERN.search(self.content) if is_potential_query else None
+        if range_match:
+            logger.info("处理日期范围查询请求")
+            self._dispatch(e_context, self._handle_date_range_query, range_match)
+            return
+        
+        # 只有在可能是车票查询的情况下，才进一步判断：本地规则能高置信度解析的直接视为车票查询，否则使用LLM判断
+        rule_parsed = None
         if is_potential_query:
-            is_ticket_query = self._ai_is_ticket_query(self.content)
+            rule_parsed = self._rule_parse_query(self.content)
+            if self._is_confident_parse(rule_parsed):
+                is_ticket_query = True
+            else:
+                is_ticket_query = self._ai_is_ticket_query(self.content)
         else:
             is_ticket_query = False
         
@@ -277,11 +342,104 @@ class TicketQuery(Plugin):
         if not is_ticket_query:
             return
         
-        # 所有符合条件的查询都视为普通查询，用LLM处理
+        # 所有符合条件的查询都视为普通查询
         logger.info("处理车票查询请求")
+        self._dispatch(e_context, self._handle_ticket_query, rule_parsed)
+
+    def _handle_ticket_query(self, e_context, rule_parsed):
         # 保存原始查询内容，便于后续处理
         self.original_query = self.content
-        self._process_query(e_context)
+        self._process_query(e_context, rule_parsed)
+
+    def _dispatch(self, e_context, handler, *args, quick=False):
+        """执行消息处理函数
+
+        异步模式（async_reply）下立即回复"正在查询"，处理函数在线程池中执行，结果通过channel.send发送；
+        quick表示处理很快的命令（如翻页），只有同一会话还有未完成的查询时才排到其后异步执行。
+        同一会话的消息总是按到达顺序依次处理。
+        """
+        session = self._session_for(e_context["context"])
+        self._local.session = session
+        content = self.content
+        deadline = self._current_deadline()
+        config = self._config()
+        context = e_context["context"]
+        channel = e_context.econtext.get("channel")
+        use_async = config.async_reply and channel is not None and hasattr(channel, "send")
+        
+        with self._reply_lock:
+            busy = session.pending > 0
+            if use_async and not (quick and not busy):
+                if self.reply_stats["pending"] >= config.reply_queue_limit:
+                    self.reply_stats["rejected"] += 1
+                    use_async = None
+                else:
+                    self.reply_stats["pending"] += 1
+                    self.reply_stats["submitted"] += 1
+                    session.pending += 1
+        
+        if use_async is None:
+            logger.warning(f"异步查询队列已满（{config.reply_queue_limit}），拒绝请求: {content}")
+            self._send_error("当前查询人数较多，请稍后再试", e_context)
+            return
+        if not use_async or (quick and not busy):
+            with session.lock:
+                try:
+                    handler(e_context, *args)
+                finally:
+                    self._save_session(session)
+            return
+        
+        submitted = time_module.monotonic()
+        
+        def run():
+            waited = time_module.monotonic() - submitted
+            worker_context = EventContext(e_context.event, {"context": context, "channel": channel})
+            self._bind(session, content, deadline)
+            try:
+                with session.lock:
+                    try:
+                        handler(worker_context, *args)
+                    finally:
+                        self._save_session(session)
+            except Exception as e:
+                logger.error(f"异步查询失败: {e}")
+                logger.error(traceback.format_exc())
+                self._send_error("查询处理失败，请稍后重试", worker_context)
+            finally:
+                self._bind(None, None)
+                with self._reply_lock:
+                    self.reply_stats["pending"] -= 1
+                    self.reply_stats["completed"] += 1
+                    self.reply_stats["wait_total"] += waited
+                    self.reply_stats["wait_max"] = max(self.reply_stats["wait_max"], waited)
+                    session.pending -= 1
+            
+            reply = worker_context.econtext.get("reply")
+            logger.info(f"异步查询完成: {content}，排队{waited:.2f}秒，"
+                        f"总耗时{time_module.monotonic() - submitted:.2f}秒，队列状态: {self.reply_queue_stats()}")
+            if reply:
+                try:
+                    channel.send(reply, context)
+                except Exception as e:
+                    logger.error(f"发送异步回复失败: {e}")
+        
+        self._executor("reply", config.reply_workers).submit(run)
+        e_context.action = EventAction.BREAK_PASS
+        if not quick:
+            reply = Reply()
+            reply.type = ReplyType.TEXT
+            reply.content = "🔍正在查询，请稍候..."
+            e_context["reply"] = reply
+
+    def reply_queue_stats(self):
+        """异步查询队列：排队和执行中的任务数、累计提交/完成/拒绝数、平均和最长排队时间（秒）"""
+        with self._reply_lock:
+            stats = dict(self.reply_stats)
+        wait_total = stats.pop("wait_total")
+        stats["avg_wait"] = round(wait_total / stats["completed"], 3) if stats["completed"] else 0.0
+        stats["wait_max"] = round(stats["wait_max"], 3)
+        return stats
 
     def _is_potential_ticket_query(self, query):
         """初步判断是否可能是车票查询请求（基于关键词和模式匹配）"""
@@ -321,16 +479,12 @@ class TicketQuery(Plugin):
 
     def _ai_is_ticket_query(self, query):
         """使用OpenAI判断是否是火车票查询请求"""
-        if not USE_OPENAI or not OPENAI_API_KEY:
+        if not self._config().use_openai:
             logger.info("OpenAI配置无效，跳过LLM判断")
             # 直接返回True，因为已经在_is_potential_ticket_query中通过了关键词筛选
             return True
             
         try:
-            # 强制重新配置OpenAI
-            openai.api_key = OPENAI_API_KEY
-            openai.api_base = OPENAI_API_BASE
-            
             # 构建提示
             prompt = f"""
             请判断以下用户请求是否是关于火车票或高铁票查询的问题："{query}"
@@ -345,62 +499,8 @@ class TicketQuery(Plugin):
             """
             
             # 调用OpenAI API
-            result_text = ""
-            
             try:
-                # 标准ChatCompletion API
-                response = openai.ChatCompletion.create(
-                    model=OPENAI_MODEL,
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.1,
-                    max_tokens=10
-                )
-                result_text = response.choices[0].message.content.strip()
-                
-            except AttributeError:
-                try:
-                    # 最新客户端格式
-                    response = openai.chat.completions.create(
-                        model=OPENAI_MODEL,
-                        messages=[{"role": "user", "content": prompt}],
-                        temperature=0.1,
-                        max_tokens=10
-                    )
-                    result_text = response.choices[0].message.content.strip()
-                    
-                except Exception as latest_error:
-                    logger.warning(f"最新API调用失败: {latest_error}")
-                    
-                    try:
-                        # 旧版API
-                        response = openai.Completion.create(
-                            model=OPENAI_MODEL,
-                            prompt=prompt,
-                            temperature=0.1,
-                            max_tokens=10
-                        )
-                        result_text = response.choices[0].text.strip()
-                    except Exception as old_error:
-                        logger.error(f"所有API调用方法均失败: {old_error}")
-                        
-                        # 使用HTTP直接请求
-                        api_url = f"{OPENAI_API_BASE.rstrip('/')}/chat/completions"
-                        headers = {
-                            "Content-Type": "application/json",
-                            "Authorization": f"Bearer {OPENAI_API_KEY}"
-                        }
-                        payload = {
-                            "model": OPENAI_MODEL,
-                            "messages": [{"role": "user", "content": prompt}],
-                            "temperature": 0.1,
-                            "max_tokens": 10
-                        }
-                        response = requests.post(api_url, headers=headers, json=payload, timeout=30)
-                        if response.status_code == 200:
-                            result_text = response.json()["choices"][0]["message"]["content"].strip()
-                        else:
-                            raise Exception(f"HTTP请求失败: {response.text}")
-            
+                result_text = self._chat_completion(prompt, temperature=0.1, max_tokens=10)
             except Exception as api_error:
                 logger.error(f"API调用失败: {api_error}")
                 return False
@@ -435,16 +535,6 @@ class TicketQuery(Plugin):
             # 保存原始查询，用于后续精确过滤
             self.original_query = self.content
             
-            # 检查是否包含模糊时间表达
-            fuzzy_time_words = ["左右", "前后", "附近"]
-            if any(word in self.content for word in fuzzy_time_words):
-                # 获取解析结果中的时间部分（如果有）
-                parts = parsed_result.split()
-                if len(parts) >= 5:  # 包含时间
-                    self.is_approximate_time = True
-                    self.approximate_time = parts[4]
-                    logger.info(f"检测到模糊时间表达，将使用{self.approximate_time}±30分钟的时间窗口")
-            
             # 使用解析结果作为查询内容
             self.content = parsed_result
             logger.info(f"LLM解析结果：{self.content}")
@@ -453,6 +543,66 @@ class TicketQuery(Plugin):
             logger.error(f"LLM自然语言解析失败：{e}")
             logger.error(traceback.format_exc())
 
+    def _handle_date_range_query(self, e_context, range_match):
+        """日期范围查询：在线程池中并发查询每一天，结果到达后逐日归并为价格日历"""
+        try:
+            start, end = parse_date_range(*range_match.groups())
+        except ValueError:
+            self._send_error("日期范围格式错误，请使用如 2024-06-05~2024-06-12 的格式", e_context)
+            return
+        if end < start:
+            self._send_error("结束日期不能早于开始日期", e_context)
+            return
+        day_count = (end - start).days + 1
+        max_days = self._config().max_date_range_days
+        if day_count > max_days:
+            self._send_error(f"日期范围最多{max_days}天，请缩小范围", e_context)
+            return
+        
+        parts = (self.content[:range_match.start()] + " " + self.content[range_match.end():]).split()
+        if len(parts) < 3:
+            self._send_error("请按格式查询：车型 出发地 目的地 开始日期~结束日期（例：高铁 北京 上海 2024-06-05~2024-06-12）", e_context)
+            return
+        ticket_type = normalize_ticket_type(parts[0])
+        time = parts[3] if len(parts) >= 4 else ""
+        from_loc, to_loc = self._validate_locations(e_context, parts[1], parts[2])
+        if not from_loc:
+            return
+        
+        dates = [start + timedelta(days=offset) for offset in range(day_count)]
+        logger.info(f"日期范围查询: {ticket_type} {from_loc}->{to_loc} {start}~{end}，共{day_count}天")
+        calendar = PriceCalendar(dates)
+        query_start = time_module.monotonic()
+        executor = self._executor("date", self._config().date_range_workers)
+        deadline = self._current_deadline()
+        futures = {
+            executor.submit(self.engine.get_ticket_info, ticket_type, from_loc, to_loc, date.strftime("%Y-%m-%d"), time,
+                            PRIORITY_FANOUT, deadline): date
+            for date in dates
+        }
+        for future in as_completed(futures):
+            date = futures[future]
+            try:
+                trains = future.result()
+            except Exception as e:
+                logger.error(f"查询{date}车票失败: {e}")
+                trains = None
+            calendar.add(date, trains)
+        logger.info(f"日期范围查询完成，耗时{time_module.monotonic() - query_start:.2f}秒，"
+                    f"失败{len(calendar.failed)}天，车票缓存命中率：{self.engine.ticket_cache.hit_ratio():.1%}")
+        
+        if len(calendar.failed) == day_count:
+            self._send_error(f"未能查询到从{from_loc}到{to_loc}的{ticket_type}车次", e_context)
+            return
+        
+        title = f"📅{from_loc}→{to_loc} {ticket_type}价格日历（{start.strftime('%m-%d')}~{end.strftime('%m-%d')}）"
+        reply = Reply()
+        reply.type = ReplyType.TEXT
+        reply.content = (calendar.render(title)
+                         + f"\n🔍发送【{ticket_type} {from_loc} {to_loc} 日期】查看当天车次")
+        e_context["reply"] = reply
+        e_context.action = EventAction.BREAK_PASS
+
     def _handle_main_query(self, e_context):
         """处理主查询请求"""
         logger.info(f"处理主查询: {self.content}")
@@ -475,31 +625,32 @@ class TicketQuery(Plugin):
             logger.info(f"解析的查询参数: 车型={ticket_type}, 出发地={from_loc}, 目的地={to_loc}, 日期={date}, 时间={time}")
             
             # 标准化车型（确保与API兼容）
-            if ticket_type.lower() in ["普通火车", "火车", "普快", "特快", "快车", "特快列车"]:
-                ticket_type = "普通"
-                logger.info(f"标准化车型: '{ticket_type}' -> '普通'")
-            elif ticket_type.lower() in ["高速", "高速铁路", "高铁列车", "高速列车"]:
-                ticket_type = "高铁"
-                logger.info(f"标准化车型: '{ticket_type}' -> '高铁'")
-            elif ticket_type.lower() in ["动车组", "动车列车"]:
-                ticket_type = "动车"
-                logger.info(f"标准化车型: '{ticket_type}' -> '动车'")
+            standard_type = normalize_ticket_type(ticket_type)
+            if standard_type != ticket_type:
+                logger.info(f"标准化车型: '{ticket_type}' -> '{standard_type}'")
+                ticket_type = standard_type
+            
+            # 校验出发地和目的地，未知站点直接提示，不发起网络请求
+            from_loc, to_loc = self._validate_locations(e_context, from_loc, to_loc)
+            if not from_loc:
+                return
             
             # 调用车票API获取信息
-            trains = self.get_ticket_info(ticket_type, from_loc, to_loc, date, time)
+            deadline = self._current_deadline()
+            trains = self.engine.get_ticket_info(ticket_type, from_loc, to_loc, date, time, deadline=deadline)
             
+            if trains is None and deadline.expired():
+                self._send_error("查询超时，请稍后重试", e_context)
+                return
             if not trains:
                 self._send_error(f"未能找到从{from_loc}到{to_loc}的{ticket_type}车次", e_context)
                 return
                 
             # 保存查询结果，便于后续筛选
-            self.original_data = trains
-            self.total_data = trains
-            self.current_page = 1
+            self._store_results(trains)
             
             # 格式化并返回结果
-            page_data = self._get_current_page()
-            reply_content = self._format_response(page_data)
+            reply_content = self._format_current_page()
             
             reply = Reply()
             reply.type = ReplyType.TEXT
@@ -512,205 +663,22 @@ class TicketQuery(Plugin):
             logger.error(traceback.format_exc())
             self._send_error("查询处理失败，请稍后重试", e_context)
 
-    def get_ticket_info(self, ticket_type, from_loc, to_loc, date, time=""):
-        """调用票务API获取数据"""
-        logger.info(f"开始查询车票信息：{ticket_type} {from_loc}->{to_loc} 日期：{date} 时间：{time}")
-        
-        # 保存时间信息用于后续过滤
-        if time:
-            self.is_approximate_time = True
-            self.approximate_time = time
-            logger.info(f"设置近似时间过滤条件：{time}±30分钟")
-        
-        # 构建查询参数
-        params = {
-            "from": from_loc,
-            "to": to_loc,
-            "time": date,  # API参数为time而不是date
-            "type": ticket_type
-        }
-        
-        # 输出完整请求URL
-        param_str = "&".join([f"{k}={v}" for k, v in params.items()])
-        full_url = f"{BASE_URL_HIGHSPEEDTICKET}?{param_str}"
-        logger.info(f"请求URL：{full_url}")
-        
-        try:
-            resp = requests.get(BASE_URL_HIGHSPEEDTICKET, params=params, timeout=15)
-            logger.info(f"API响应状态码：{resp.status_code}")
-            logger.info(f"API响应内容：{resp.text[:200]}...")  # 只输出前200个字符避免日志过长
-            
-            if resp.status_code != 200:
-                logger.error(f"API请求失败，状态码：{resp.status_code}")
-                return None
-                
-            try:
-                data = resp.json()
-                logger.info(f"API返回code：{data.get('code')}")
-                logger.info(f"API返回msg：{data.get('msg')}")
-                
-                if data.get('code') == 200:
-                    raw_data = data.get('data', [])
-                    logger.info(f"获取到{len(raw_data)}条原始数据")
-                    
-                    # 处理数据前先输出几条样例
-                    if raw_data:
-                        logger.info(f"数据样例：{raw_data[0]}")
-                    
-                    filtered_trains = self._process_api_data(raw_data, ticket_type, time)
-                    logger.info(f"筛选后剩余{len(filtered_trains)}条数据")
-                    
-                    if not filtered_trains:
-                        logger.warning("筛选后没有符合条件的车次")
-                    return filtered_trains
-                else:
-                    error_msg = data.get('msg', '未知错误')
-                    logger.error(f"API返回错误：{error_msg}")
-                    return None
-                    
-            except json.JSONDecodeError as je:
-                logger.error(f"JSON解析错误：{je}")
-                logger.error(f"原始响应内容：{resp.text}")
-                return None
-                
-        except requests.exceptions.Timeout:
-            logger.error("API请求超时")
-            return None
-        except requests.exceptions.RequestException as e:
-            logger.error(f"请求异常：{e}")
-            return None
-        except Exception as e:
-            logger.error(f"未知错误：{str(e)}")
-            logger.error(f"错误详情：{traceback.format_exc()}")
-            return None
+    def _validate_locations(self, e_context, *locations):
+        """用站点词典校验并标准化城市名（站名、拼音、别名统一为所属城市），None表示未指定
 
-    def _process_api_data(self, data, ticket_type, query_time):
-        """处理API返回数据"""
-        logger.info(f"处理API数据：车型={ticket_type}, 查询时间={query_time}")
-        logger.info(f"收到{len(data)}条数据待处理")
-        
-        # 标准化查询车型，确保与API返回数据兼容
-        standard_ticket_type = ticket_type
-        if ticket_type.lower() in ["普通火车", "火车", "普快", "特快", "快车", "特快列车"]:
-            standard_ticket_type = "普通"
-        elif ticket_type.lower() in ["高速", "高速铁路", "高铁列车", "高速列车"]:
-            standard_ticket_type = "高铁"
-        elif ticket_type.lower() in ["动车组", "动车列车"]:
-            standard_ticket_type = "动车"
-            
-        # 处理模糊时间表达
-        time_window_minutes = 30  # 默认时间窗口±30分钟
-        time_range_start = None
-        time_range_end = None
-        
-        # 处理自然语言时间表达
-        if query_time in ["上午", "早上", "早晨", "凌晨"]:
-            time_range_start = "06:00"  # 早上6点
-            time_range_end = "12:00"    # 中午12点
-        elif query_time in ["中午"]:
-            time_range_start = "11:00"  # 上午11点
-            time_range_end = "13:00"    # 下午1点
-        elif query_time in ["下午"]:
-            time_range_start = "12:00"  # 中午12点
-            time_range_end = "18:00"    # 下午6点
-        elif query_time in ["傍晚"]:
-            time_range_start = "17:00"  # 下午5点
-            time_range_end = "19:00"    # 晚上7点
-        elif query_time in ["晚上", "夜晚", "夜里"]:
-            time_range_start = "18:00"  # 下午6点
-            time_range_end = "23:59"    # 午夜
-            
-        # 记录时间过滤状态
-        if time_range_start and time_range_end:
-            logger.info(f"使用时间范围筛选：{time_range_start}至{time_range_end}")
-            # 覆盖原有的近似时间设置
-            self.is_approximate_time = False
-            self.approximate_time = None
-        elif self.is_approximate_time:
-            logger.info(f"启用近似时间过滤：{self.approximate_time}±{time_window_minutes}分钟")
-        elif query_time:
-            logger.info(f"启用精确时间过滤：{query_time}之后的车次")
-        
-        filtered = []
-        for item in data:
-            try:
-                # 简化日志记录，只记录必要信息
-                train_number = item.get('trainumber', 'unknown')
-                train_type = item.get('traintype', 'unknown')
-                depart_time = item.get('departtime', 'unknown')
-                
-                # 1. 车型筛选 - 使用标准化后的车型进行匹配
-                if train_type != standard_ticket_type:
-                    continue
-                    
-                # 2. 时间筛选
-                try:
-                    # 解析发车时间
-                    depart_time_obj = datetime.strptime(depart_time, "%H:%M").time()
-                    depart_minutes = depart_time_obj.hour * 60 + depart_time_obj.minute
-                    
-                    # 处理时间范围筛选（如"上午"、"下午"等）
-                    if time_range_start and time_range_end:
-                        start_time_obj = datetime.strptime(time_range_start, "%H:%M").time()
-                        end_time_obj = datetime.strptime(time_range_end, "%H:%M").time()
-                        
-                        start_minutes = start_time_obj.hour * 60 + start_time_obj.minute
-                        end_minutes = end_time_obj.hour * 60 + end_time_obj.minute
-                        
-                        # 检查发车时间是否在范围内
-                        if not (start_minutes <= depart_minutes <= end_minutes):
-                            continue
-                            
-                    # 处理近似时间筛选（如"10:30左右"）
-                    elif self.is_approximate_time and self.approximate_time:
-                        try:
-                            # 解析近似时间
-                            approx_time_obj = datetime.strptime(self.approximate_time, "%H:%M").time()
-                            approx_minutes = approx_time_obj.hour * 60 + approx_time_obj.minute
-                            
-                            # 计算时间差（分钟）
-                            time_diff = abs(approx_minutes - depart_minutes)
-                            
-                            # 使用指定的时间窗口
-                            if time_diff > time_window_minutes:
-                                continue
-                        except ValueError as e:
-                            # 格式错误时，不进行筛选，允许通过
-                            pass
-                    
-                    # 常规时间筛选（如"14:00"）
-                    elif query_time and ":" in query_time:
-                        try:
-                            query_time_obj = datetime.strptime(query_time, "%H:%M").time()
-                            query_minutes = query_time_obj.hour * 60 + query_time_obj.minute
-                            
-                            # 计算时间差（分钟）
-                            time_diff = depart_minutes - query_minutes
-                            
-                            if time_diff < -30:  # 发车时间早于查询时间30分钟以上
-                                continue
-                        except ValueError as e:
-                            # 格式错误时，不进行筛选，允许通过
-                            pass
-                except ValueError as e:
-                    # 格式错误时，不进行筛选，允许通过
-                    pass
-                        
-                # 3. 添加有效数据
-                filtered.append(item)
-                          
-            except KeyError as ke:
-                logger.warning(f"数据格式错误，缺少必要字段：{ke}")
-                continue
-            except Exception as e:
-                logger.warning(f"处理数据时发生错误：{e}")
+        任一地点被TicketEngine.resolve_location判定为无效时发送错误并返回全None。
+        """
+        resolved = []
+        for location in locations:
+            if not location:
+                resolved.append(location)
                 continue
-
-        # 按发车时间排序
-        filtered.sort(key=lambda x: x['departtime'])
-        logger.info(f"筛选完成，共有{len(filtered)}条符合条件的车次")
-        
-        return filtered
+            city = self.engine.resolve_location(location)
+            if city is None:
+                self._send_error(f"未识别的站点或城市：{location}，请检查输入", e_context)
+                return (None,) * len(locations)
+            resolved.append(city)
+        return tuple(resolved)
 
     def _handle_pagination(self, e_context):
         """处理分页请求"""
@@ -735,55 +703,28 @@ class TicketQuery(Plugin):
                 return
 
         # 获取当前页数据
-        page_data = self._get_current_page()
         reply = Reply()
         reply.type = ReplyType.TEXT
-        reply.content = self._format_response(page_data)
+        reply.content = self._format_current_page()
         e_context["reply"] = reply
         e_context.action = EventAction.BREAK_PASS
 
-    def _get_current_page(self):
-        """获取当前页数据"""
-        start = (self.current_page - 1) * self.page_size
-        end = start + self.page_size
-        return self.total_data[start:end]
-        
-    def _format_response(self, page_data):
-        if not page_data:
-            return "没有更多车次信息"
+    def _store_results(self, items, is_transfer=False):
+        """保存新的查询结果（直达或中转），并预先生成每个条目的文本块"""
+        self._current_session().load_results(items, is_transfer)
 
-        # 限制最大显示结果，避免消息过长
-        if len(page_data) > 20:
-            logger.warning(f"结果过多({len(page_data)}条)，只显示前20条")
-            page_data = page_data[:20]
+    def _format_current_page(self):
+        """格式化当前页：文本块已在保存结果时生成，翻页只需切片拼接"""
+        body = self.renderer.page(self.current_page, self.page_size)
+        if not body:
+            return "没有更多车次信息"
 
-        result = []
-        global_index = (self.current_page - 1) * self.page_size + 1
-        for idx, item in enumerate(page_data, global_index):
-            info = f"{idx}. 【{item.get('trainumber', '未知车次')}】{item.get('traintype', '未知类型')}\n"
-            info += f"   🚩出发站：{item.get('departstation', '未知')} ➔ 到达站：{item.get('arrivestation', '未知')}\n"
-            info += f"   ⏰时间：{item.get('departtime', '未知')} - {item.get('arrivetime', '未知')}（历时：{item.get('runtime', '未知')}\n"
-            
-            # 处理票价信息
-            seats = item.get('ticket_info', [])
-            if seats:
-                seat_info = "   💺席位："
-                seat_info += " | ".join([
-                    f"{s.get('seatname', '未知')}：¥{s.get('seatprice', '未知')}（余{s.get('seatinventory', 0)}张）"
-                    for s in seats
-                ])
-                info += seat_info + "\n"
-            else:
-                info += "   ⚠️暂无余票信息\n"
-            
-            result.append(info)
-            
         total_pages = (len(self.total_data) + self.page_size - 1) // self.page_size
         footer = f"\n📄第 {self.current_page}/{total_pages} 页"
         footer += f"\n🔍共找到 {len(self.total_data)} 条符合条件的车次"
         footer += "\n🔍发送【+下一页】查看后续结果" if self.current_page < total_pages else ""
         footer += "\n🎯发送【+筛选条件】进行精确筛选（如：+二等座低于500元）"
-        return "\n".join(result) + footer
+        return body + footer
 
     def _handle_followup_question(self, e_context):
         """处理后续筛选问题"""
@@ -795,37 +736,51 @@ class TicketQuery(Plugin):
             self._send_error("请先进行车次查询", e_context)
             return
             
-        # 全部使用LLM进行筛选
-        logger.info("====== 使用LLM进行智能筛选 ======")
-        if not USE_OPENAI or not OPENAI_API_KEY:
-            logger.warning("OpenAI未配置，无法使用AI筛选")
-            self._send_error("无法处理筛选请求，请联系管理员配置LLM服务", e_context)
-            return
-            
-        logger.info(f"API密钥前8位: {OPENAI_API_KEY[:8] if OPENAI_API_KEY else '未配置'}")
-        logger.info(f"API基础URL: {OPENAI_API_BASE}")
-        logger.info(f"使用模型: {OPENAI_MODEL}")
+        # 筛选在当前结果上继续进行（可以逐步缩小范围）；"+全部""+重置"回到全部查询结果，其后可接新的条件
+        base = self.total_data
+        match = RESET_FILTER_PATTERN.match(content)
+        if match:
+            base = self._current_session().view()
+            content = content[match.end():]
+            logger.info(f"回到全部查询结果（{len(base)}条）" + (f"后筛选：{content}" if content else ""))
+        logger.info(f"筛选范围：{len(base)}/{len(self.original_data)}条")
         
-        # 判断是否正在处理中转查询结果
-        if hasattr(self, 'is_transfer_query') and self.is_transfer_query:
-            logger.info("检测到正在处理中转查询结果，使用中转筛选流程")
-            filtered_data = self._ai_filter_transfer(content)
+        if not content:
+            filtered_data = base
         else:
-            logger.info("使用普通查询筛选流程")
-            filtered_data = self._ai_filter(content)
+            # "最便宜的二等座""还有商务座的车"这类问题直接查座位索引，不调用LLM
+            filtered_data = None if self.is_transfer_query else self._seat_index_lookup(content, base)
+        
+        if filtered_data is None:
+            # 其余问题使用LLM进行筛选
+            logger.info("====== 使用LLM进行智能筛选 ======")
+            if not self._config().use_openai:
+                logger.warning("OpenAI未配置，无法使用AI筛选")
+                self._send_error("无法处理筛选请求，请联系管理员配置LLM服务", e_context)
+                return
+                
+            logger.info(f"使用模型: {self._config().model}")
+            
+            # 判断是否正在处理中转查询结果
+            if self.is_transfer_query:
+                logger.info("检测到正在处理中转查询结果，使用中转筛选流程")
+                filtered_data = self._ai_filter_transfer(content, base)
+            else:
+                logger.info("使用普通查询筛选流程")
+                filtered_data = self._ai_filter(content, base)
         
-        # 更新现有数据 - 只更新total_data，保留original_data
+        # 更新现有数据 - 只更新total_data（原始结果上的序号视图），保留original_data
         if filtered_data is not None:
             if len(filtered_data) > 0:
                 self.total_data = filtered_data
                 self.current_page = 1
+                self.renderer.set_view(filtered_data)
                 
                 # 格式化响应
-                if hasattr(self, 'is_transfer_query') and self.is_transfer_query:
+                if self.is_transfer_query:
                     reply_content = self._format_transfer_response(filtered_data[:20])  # 限制显示条数
                 else:
-                    page_data = self._get_current_page()
-                    reply_content = self._format_response(page_data)
+                    reply_content = self._format_current_page()
                 
                 reply = Reply()
                 reply.type = ReplyType.TEXT
@@ -837,197 +792,219 @@ class TicketQuery(Plugin):
         else:
             self._send_error("筛选失败，请重试", e_context)
 
-    def _ai_filter_transfer(self, question):
-        """针对中转查询结果的AI筛选"""
+    def _seat_index_lookup(self, question, base):
+        """在base（当前结果视图）上用座位索引回答最便宜/有余票类问题；问题不是这两类或座位不存在时返回None"""
+        if self.seat_index is None:
+            return None
+        within = base.position_set()
+        question = re.sub(r"[\s，。,.!！?？]", "", question)
+        for pattern in CHEAPEST_PATTERNS:
+            match = pattern.match(question)
+            if not match:
+                continue
+            groups = match.groupdict()
+            seat = self.seat_index.resolve_seat(groups["seat"])
+            count = parse_chinese_number(groups["count"]) if groups["count"] else 1
+            if seat is None or not count:
+                return None
+            result = base.select(self.seat_index.cheapest(seat, k=count, within=within))
+            logger.info(f"座位索引命中: 最便宜的{count}班（{groups['seat'] or '任意座位'}），返回{len(result)}条")
+            return result
+        for pattern in AVAILABLE_PATTERNS:
+            match = pattern.match(question)
+            if not match:
+                continue
+            seat = self.seat_index.resolve_seat(match.group("seat"))
+            if seat is None:
+                return None
+            result = base.select(self.seat_index.with_inventory(seat, within=within))
+            logger.info(f"座位索引命中: 有{match.group('seat')}余票的车次{len(result)}条")
+            return result
+        return None
+
+    def _ai_filter_transfer(self, question, base):
+        """针对中转查询结果的AI筛选（base中的中转方案分块并发筛选后合并）"""
         logger.info(f"使用AI筛选中转查询结果: {question}")
         
-        if not USE_OPENAI or not OPENAI_API_KEY:
+        if not self._config().use_openai:
             logger.warning("OpenAI配置无效，回退到手动筛选")
-            return self._manual_filter_transfer(question)
+            return self._manual_filter_transfer(question, base)
             
         try:
-            # 配置OpenAI
-            logger.info(f"初始化OpenAI客户端...")
-            logger.info(f"API密钥: {OPENAI_API_KEY[:8]}...")
-            logger.info(f"API基础URL: {OPENAI_API_BASE}")
-            logger.info(f"使用模型: {OPENAI_MODEL}")
-            
-            # 强制重新配置OpenAI
-            openai.api_key = OPENAI_API_KEY
-            openai.api_base = OPENAI_API_BASE
-            
-            # 准备数据，始终使用原始数据，限制数量防止超出API限制
-            max_data_items = min(len(self.original_data), 20)
-            sample_data = self.original_data[:max_data_items]
-            
-            # 构建简化的样本数据以适应token限制
-            simplified_samples = []
-            for route in sample_data:
-                simplified = {
-                    "transfer_station": route.get("transfer_station"),
-                    "total_price": route.get("total_price"),
-                    "total_runtime": route.get("total_runtime"),
-                    "first_leg": {
-                        "trainumber": route.get("first_leg", {}).get("trainumber"),
-                        "traintype": route.get("first_leg", {}).get("traintype"),
-                        "departtime": route.get("first_leg", {}).get("departtime"),
-                        "arrivetime": route.get("first_leg", {}).get("arrivetime"),
-                        "departstation": route.get("first_leg", {}).get("departstation"),
-                        "ticket_info": [
-                            {
-                                "seatname": seat.get("seatname"),
-                                "seatprice": seat.get("seatprice"),
-                                "seatinventory": seat.get("seatinventory")
-                            } for seat in route.get("first_leg", {}).get("ticket_info", [])[:2]  # 只包含前两种座位类型
-                        ]
-                    },
-                    "second_leg": {
-                        "trainumber": route.get("second_leg", {}).get("trainumber"),
-                        "traintype": route.get("second_leg", {}).get("traintype"),
-                        "departtime": route.get("second_leg", {}).get("departtime"),
-                        "arrivetime": route.get("second_leg", {}).get("arrivetime"),
-                        "arrivestation": route.get("second_leg", {}).get("arrivestation"),
-                        "ticket_info": [
-                            {
-                                "seatname": seat.get("seatname"),
-                                "seatprice": seat.get("seatprice"),
-                                "seatinventory": seat.get("seatinventory")
-                            } for seat in route.get("second_leg", {}).get("ticket_info", [])[:2]  # 只包含前两种座位类型
-                        ]
-                    },
-                    "transfer_time": route.get("transfer_time"),
-                    "index": sample_data.index(route)  # 添加索引以便后续查找
-                }
-                simplified_samples.append(simplified)
-            
-            sample_json = json.dumps(simplified_samples, ensure_ascii=False)
-            logger.info(f"已准备{len(simplified_samples)}/{len(self.original_data)}条中转数据用于AI分析")
+            logger.info(f"使用模型: {self._config().model}")
             
-            # 构建提示
-            prompt = f"""
+            # 优先使用筛选计划在本地处理全部方案，提示长度与结果数量无关
+            planned = self._plan_filter("transfer", question, base)
+            if planned is not None:
+                return planned
+            
+            # 准备数据：全部中转方案编码为紧凑表格，并按token预算分块
+            header, lines = encode_transfer_table([(i, base.rows[i]) for i in base.indices])
+            chunks = pack_table(header, lines, self._config().filter_prompt_token_budget)
+            
+            def build_prompt(table):
+                return f"""
             我需要按以下条件筛选中转列车方案: "{question}"
             
-            中转方案数据格式示例：
-            {sample_json}
+            中转方案如下（表格，首行为表头，列以"|"分隔；座位列格式为"票价/余票"，时长单位为分钟）：
+{table}
             
             请分析筛选条件，并返回符合条件的中转方案。返回格式为JSON：
             {{
                 "analysis": "对筛选条件的理解和分析...",
-                "matched_routes": [0, 2, 5]  // 匹配的方案在原数组中的索引
+                "matched_routes": [0, 2, 5]  // 匹配方案的序号（表格第一列）
             }}
             
-            如果筛选条件涉及总价格，请查看total_price字段；
-            如果涉及总时间，请查看total_runtime字段（以分钟为单位）；
-            如果涉及车次号，请查看first_leg和second_leg中的trainumber字段；
-            如果涉及座位类型和价格，请查看ticket_info数组。
-            如果涉及中转站，请查看transfer_station字段,只有完全匹配才算符合条件。
+            如果筛选条件涉及总价格，请查看总价列；
+            如果涉及总时间，请查看总历时列（以分钟为单位）；
+            如果涉及车次号，请查看一程车次和二程车次列；
+            如果涉及座位类型和价格，请查看一程/二程的座位列。
+            如果涉及中转站，请查看中转站列,只有完全匹配才算符合条件。
+            表格可能只是全部方案的一部分，"最便宜""最快"等条件只需返回本表中最符合的方案，最终排序由程序完成。
             
             仅返回JSON，不要有其他文字。
             """
             
-            # 调用OpenAI API
-            logger.info(f"正在调用OpenAI API - 使用模型: {OPENAI_MODEL}")
+            indices = self._map_filter_chunks(chunks, build_prompt, "matched_routes")
+            if not indices:
+                # AI调用失败或没有找到匹配的，回退到手动筛选
+                logger.warning("AI未找到匹配的中转方案，尝试手动筛选")
+                return self._manual_filter_transfer(question, base)
             
-            try:
-                # 尝试多种API调用方式
-                result_text = ""
-                
-                try:
-                    # 新版API
-                    response = openai.ChatCompletion.create(
-                        model=OPENAI_MODEL,
-                        messages=[{"role": "user", "content": prompt}],
-                        temperature=0.3,
-                        max_tokens=1000
-                    )
-                    result_text = response.choices[0].message.content.strip()
-                except AttributeError:
-                    try:
-                        # 最新客户端格式
-                        response = openai.chat.completions.create(
-                            model=OPENAI_MODEL,
-                            messages=[{"role": "user", "content": prompt}],
-                            temperature=0.3,
-                            max_tokens=1000
-                        )
-                        result_text = response.choices[0].message.content.strip()
-                    except Exception as latest_error:
-                        # 旧版API
-                        response = openai.Completion.create(
-                            model=OPENAI_MODEL,
-                            prompt=prompt,
-                            temperature=0.3,
-                            max_tokens=1000
-                        )
-                        result_text = response.choices[0].text.strip()
-            
-                # 处理API响应
-                if not result_text:
-                    logger.warning("OpenAI返回了空响应")
-                    return self._manual_filter_transfer(question)
-                    
-                logger.info(f"OpenAI返回响应长度: {len(result_text)} 字符")
-                
-                # 去除markdown格式
-                if result_text.startswith("```"):
-                    pattern = r"```(?:json)?\s*([\s\S]*?)```"
-                    match = re.search(pattern, result_text)
-                    if match:
-                        result_text = match.group(1).strip()
-                
-                # 解析JSON响应
-                result_json = json.loads(result_text)
-                indices = result_json.get("matched_routes", [])
-                logger.info(f"AI分析: {result_json.get('analysis', '无分析')[:100]}...")
-                logger.info(f"匹配索引: {indices}")
-                
-                # 根据索引筛选 - 使用全部原始数据
-                if indices:
-                    # 需要确保索引有效
-                    valid_indices = [i for i in indices if 0 <= i < len(self.original_data)]
-                    filtered = [self.original_data[i] for i in valid_indices]
-                    logger.info(f"筛选结果: 保留{len(filtered)}/{len(self.original_data)}条中转方案")
-                    
-                    # 根据筛选条件确定排序方式
-                    if any(word in question for word in ["最便宜", "价格最低", "便宜", "低价", "最低", "总票价"]):
-                        logger.info("检测到价格相关筛选条件，对结果按价格排序")
-                        filtered.sort(key=lambda x: float(x.get('total_price', float('inf'))))
-                    elif any(word in question for word in ["最快", "时间最短", "耗时最少", "最短", "总时长"]):
-                        logger.info("检测到时间相关筛选条件，对结果按时间排序")
-                        filtered.sort(key=lambda x: int(x.get('total_runtime', float('inf'))))
-                        
-                    # 如果是要求最便宜/最快的一个，只返回第一个结果
-                    if "最" in question and filtered:
-                        if any(word in question for word in ["最便宜", "价格最低", "最低", "总票价最低"]):
-                            logger.info(f"根据'最便宜'条件，只返回价格最低的方案: {filtered[0].get('total_price')}元")
-                            return [filtered[0]]
-                        elif any(word in question for word in ["最快", "时间最短", "耗时最少", "总时长最短"]):
-                            logger.info(f"根据'最快'条件，只返回时间最短的方案: {filtered[0].get('total_runtime')}分钟")
-                            return [filtered[0]]
-                    
-                    return filtered
-                else:
-                    # 如果AI无法找到匹配的，回退到手动筛选
-                    logger.warning("AI未找到匹配的中转方案，尝试手动筛选")
-                    return self._manual_filter_transfer(question)
-                    
-            except Exception as api_error:
-                logger.error(f"API调用或解析失败: {api_error}")
-                logger.error(traceback.format_exc())
-                return self._manual_filter_transfer(question)
+            filtered = base.select(indices)
+            logger.info(f"筛选结果: 保留{len(filtered)}/{len(base)}条中转方案")
+            return order_filtered_results(filtered, question, transfer_order_keys(question))
                 
         except Exception as e:
             logger.error(f"AI筛选中转查询失败: {e}")
             logger.error(traceback.format_exc())
-            return self._manual_filter_transfer(question)
+            return self._manual_filter_transfer(question, base)
+
+    def _plan_filter(self, kind, question, base):
+        """用LLM编译的筛选计划在本地筛选base中的结果；计划按问题缓存，无法用计划表达时返回None"""
+        key = (kind, normalize_query(question))
+        plan = self.plan_cache.get(key)
+        if plan is not None:
+            stats = self.plan_cache.stats()
+            logger.info(f"筛选计划缓存命中: {question}，命中率: {stats['hit_ratio']:.1%}，"
+                        f"累计节省LLM时间: {stats['saved_seconds']:.1f}秒")
+        else:
+            start = time_module.perf_counter()
+            plan = self._llm_compile_plan(kind, question)
+            elapsed = time_module.perf_counter() - start
+            if plan is None:
+                return None
+            # 无法用计划表达的问题也缓存（记为False），下次直接走分块筛选
+            self.plan_cache.set(key, plan, cost=elapsed)
+            logger.info(f"筛选计划编译耗时: {elapsed:.2f}秒")
+        if plan is False:
+            return None
+
+        start = time_module.perf_counter()
+        result = plan.execute(base)
+        logger.info(f"本地执行筛选计划: {plan.describe()}，{len(base)}条中保留{len(result)}条，"
+                    f"耗时{(time_module.perf_counter() - start) * 1000:.2f}ms")
+        return result
+
+    def _llm_compile_plan(self, kind, question):
+        """让LLM把筛选问题翻译为FilterPlan；LLM调用失败返回None，问题无法表达时返回False"""
+        fields = "\n".join(f"            - {name}（{field_type}）：{desc}"
+                           for name, (field_type, desc, _) in PLAN_FIELDS[kind].items())
+        subject = "中转方案" if kind == "transfer" else "车次"
+        prompt = f"""
+            请把以下{subject}筛选问题翻译为筛选计划："{question}"
+            
+            可用字段：
+{fields}
+            可用运算符：{", ".join(PLAN_OPERATORS)}（in/not_in的value为列表，contains/startswith用于文字字段）
+            座位名称：{"、".join(PLAN_SEAT_NAMES)}；price、inventory字段可用seat指定座位
+            
+            请返回以下JSON格式结果（不要输出其他解释）：
+            {{
+                "supported": true,
+                "filters": [{{"field": "price", "seat": "二等座", "op": "<", "value": 500}}],
+                "sort": [{{"field": "departtime", "order": "asc"}}],
+                "limit": null
+            }}
+            
+            说明：
+            1. filters中的条件同时满足；"或"关系写成{{"any": [条件1, 条件2]}}
+            2. "上午"为departtime在06:00到12:00之间，"下午"为12:00到18:00，"晚上"为18:00之后
+            3. "最便宜""最早""最快"等只要一个结果时，按对应字段排序并设置limit为1
+            4. "有票"表示inventory>0
+            5. 问题无法用上述字段表达时，返回{{"supported": false}}
+            """
+        try:
+            result_text = self._chat_completion(prompt, temperature=0, max_tokens=500)
+        except Exception as e:
+            logger.error(f"筛选计划编译失败: {e}")
+            return None
+        if not result_text:
+            return None
+        text = result_text.strip()
+        if text.startswith("```"):
+            match = re.search(r"```(?:json)?\s*([\s\S]*?)```", text)
+            if match:
+                text = match.group(1).strip()
+        try:
+            raw_plan = json.loads(text)
+            if not raw_plan.get("supported", True):
+                logger.info(f"LLM认为问题无法用筛选计划表达: {question}")
+                return False
+            return FilterPlan.compile(kind, raw_plan)
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.warning(f"筛选计划无效，改用分块筛选: {e}，LLM返回: {text[:200]}")
+            return False
 
-    def _manual_filter_transfer(self, question):
+    def _map_filter_chunks(self, chunks, build_prompt, result_key):
+        """把各分块提示并发交给LLM筛选，按分块顺序合并匹配的序号
+
+        单个分块失败时跳过该块；全部失败时返回None。
+        """
+        if not chunks:
+            return None
+        deadline = self._current_deadline()  # 线程池中没有绑定消息，显式传入
+
+        def filter_chunk(chunk):
+            shown_indices, table, _ = chunk
+            result_text = self._chat_completion(build_prompt(table), temperature=0.3, max_tokens=1000,
+                                                deadline=deadline)
+            indices = parse_matched_indices(result_text, result_key, set(shown_indices))
+            if indices is None:
+                raise ValueError(f"无法解析LLM返回: {(result_text or '')[:200]}")
+            return indices
+
+        start = time_module.monotonic()
+        total_tokens = sum(tokens for _, _, tokens in chunks)
+        logger.info(f"开始AI分块筛选: {len(chunks)}块, 共{sum(len(c[0]) for c in chunks)}条数据, 表格约{total_tokens} tokens")
+        if len(chunks) == 1:
+            tasks = [(chunks[0], None)]
+        else:
+            executor = self._executor("llm", self._config().llm_max_workers)
+            tasks = [(chunk, executor.submit(filter_chunk, chunk)) for chunk in chunks]
+
+        merged = []
+        succeeded = 0
+        for chunk, future in tasks:
+            try:
+                indices = future.result() if future else filter_chunk(chunk)
+            except Exception as e:
+                logger.error(f"分块筛选失败（序号{chunk[0][0]}-{chunk[0][-1]}）: {e}")
+                continue
+            succeeded += 1
+            merged.extend(indices)
+
+        logger.info(f"AI分块筛选完成: 成功{succeeded}/{len(chunks)}块, 匹配{len(merged)}条, "
+                    f"耗时{time_module.monotonic() - start:.2f}秒")
+        return merged if succeeded else None
+
+    def _manual_filter_transfer(self, question, base):
         """针对中转查询结果的手动筛选"""
         logger.info(f"手动筛选中转查询结果: {question}")
         
-        # 始终使用原始数据作为筛选基础
-        data_to_filter = self.original_data
-        logger.info(f"基于{len(data_to_filter)}条原始数据进行筛选")
+        # 在当前结果视图上筛选（筛选和排序只生成序号数组）
+        data_to_filter = base
+        logger.info(f"基于{len(data_to_filter)}条数据进行筛选")
         
         # 筛选逻辑 - 中转站相关
         if any(station in question for station in MAJOR_STATIONS):
@@ -1043,12 +1020,7 @@ class TicketQuery(Plugin):
                     
             if specified_station:
                 logger.info(f"筛选中转站为{specified_station}的方案")
-                filtered = []
-                for route in data_to_filter:
-                    station = route.get('transfer_station')
-                    logger.info(f"检查路线中转站: {station}")
-                    if station == specified_station:
-                        filtered.append(route)
+                filtered = data_to_filter.filter(lambda route: route.get('transfer_station') == specified_station)
                 
                 logger.info(f"找到{len(filtered)}个经过{specified_station}的中转方案")
                 return filtered
@@ -1058,7 +1030,7 @@ class TicketQuery(Plugin):
             logger.info("检测到价格相关筛选条件")
             
             # 按总价排序
-            sorted_routes = sorted(data_to_filter, key=lambda x: float(x.get('total_price', float('inf'))))
+            sorted_routes = data_to_filter.sort(lambda x: float(x.get('total_price', float('inf'))))
             logger.info(f"按总价排序完成，前3个方案的价格: " + 
                        ", ".join([f"{route.get('total_price', 'N/A')}元" for route in sorted_routes[:3]]))
             
@@ -1066,9 +1038,9 @@ class TicketQuery(Plugin):
             if any(word in question for word in ["最便宜", "价格最低", "最低", "总票价最低"]):
                 if sorted_routes:
                     logger.info(f"找到最便宜的中转方案，总价: {sorted_routes[0].get('total_price')}元")
-                    return [sorted_routes[0]]
+                    return sorted_routes[:1]
                 else:
-                    return []
+                    return sorted_routes
             else:
                 logger.info(f"按总价排序，找到{len(sorted_routes)}个方案")
                 return sorted_routes
@@ -1078,7 +1050,7 @@ class TicketQuery(Plugin):
             logger.info("检测到时间相关筛选条件")
             
             # 按总时间排序
-            sorted_routes = sorted(data_to_filter, key=lambda x: int(x.get('total_runtime', float('inf'))))
+            sorted_routes = data_to_filter.sort(lambda x: int(x.get('total_runtime', float('inf'))))
             logger.info(f"按总时长排序完成，前3个方案的时长(分钟): " + 
                        ", ".join([f"{route.get('total_runtime', 'N/A')}" for route in sorted_routes[:3]]))
             
@@ -1089,9 +1061,9 @@ class TicketQuery(Plugin):
                     hours = total_minutes // 60
                     mins = total_minutes % 60
                     logger.info(f"找到最快的中转方案，总时长: {hours}小时{mins}分钟")
-                    return [sorted_routes[0]]
+                    return sorted_routes[:1]
                 else:
-                    return []
+                    return sorted_routes
             else:
                 logger.info(f"按总时长排序，找到{len(sorted_routes)}个方案")
                 return sorted_routes
@@ -1102,26 +1074,26 @@ class TicketQuery(Plugin):
             
             # 是否要求最短换乘时间
             if any(word in question for word in ["最短", "最少"]):
-                sorted_routes = sorted(data_to_filter, key=lambda x: int(x.get('transfer_time', float('inf'))))
+                sorted_routes = data_to_filter.sort(lambda x: int(x.get('transfer_time', float('inf'))))
                 if sorted_routes:
                     logger.info(f"找到换乘时间最短的方案: {sorted_routes[0].get('transfer_time')}分钟")
-                    return [sorted_routes[0]]
+                    return sorted_routes[:1]
                 
             # 是否要求最长换乘时间（可能是为了在中转站游玩）
             elif any(word in question for word in ["最长", "最多"]):
-                sorted_routes = sorted(data_to_filter, key=lambda x: int(x.get('transfer_time', 0)), reverse=True)
+                sorted_routes = data_to_filter.sort(lambda x: int(x.get('transfer_time', 0)), reverse=True)
                 if sorted_routes:
                     logger.info(f"找到换乘时间最长的方案: {sorted_routes[0].get('transfer_time')}分钟")
-                    return [sorted_routes[0]]
+                    return sorted_routes[:1]
         
         # 筛选逻辑 - 车次号相关
         elif "车次" in question or "班次" in question:
-            for route in data_to_filter:
+            def matches_train(route):
                 first_train = route.get('first_leg', {}).get('trainumber', '')
                 second_train = route.get('second_leg', {}).get('trainumber', '')
-                
-                if first_train in question or second_train in question:
-                    filtered.append(route)
+                return bool(first_train) and first_train in question or bool(second_train) and second_train in question
+            
+            filtered = data_to_filter.filter(matches_train)
                     
             if filtered:
                 logger.info(f"按车次号筛选，找到{len(filtered)}个匹配方案")
@@ -1131,14 +1103,14 @@ class TicketQuery(Plugin):
         if "线路" in question or "方案" in question:
             if "最低" in question or "最便宜" in question:
                 logger.info("检测到通用价格相关筛选条件")
-                sorted_routes = sorted(data_to_filter, key=lambda x: float(x.get('total_price', float('inf'))))
+                sorted_routes = data_to_filter.sort(lambda x: float(x.get('total_price', float('inf'))))
                 
                 if "最" in question:
                     if sorted_routes:
                         logger.info(f"找到最便宜的中转方案，总价: {sorted_routes[0].get('total_price')}元")
-                        return [sorted_routes[0]]
+                        return sorted_routes[:1]
                     else:
-                        return []
+                        return sorted_routes
                 else:
                     return sorted_routes
             
@@ -1147,15 +1119,118 @@ class TicketQuery(Plugin):
                 for station in MAJOR_STATIONS:
                     if station in question:
                         logger.info(f"检测到通用中转站筛选条件: {station}")
-                        filtered = [route for route in data_to_filter if route.get('transfer_station') == station]
+                        filtered = data_to_filter.filter(lambda route: route.get('transfer_station') == station)
                         if filtered:
                             logger.info(f"找到{len(filtered)}个经过{station}的中转方案")
                             return filtered
         
-        # 默认返回原始数据
-        logger.info("未识别到明确的筛选条件，返回原始数据")
+        # 默认返回筛选前的数据
+        logger.info("未识别到明确的筛选条件，返回筛选前的数据")
         return data_to_filter
 
+    def _handle_watch_command(self, e_context):
+        """订阅某车次的余票变化：查询一次作为基准，之后由SeatWatcher定时轮询并推送变化"""
+        match = WATCH_COMMAND_PATTERN.match(self.content)
+        if not match:
+            self._send_error("请按格式订阅：订阅 车次 出发地 终点地 日期 [座位]（例：订阅 G1 北京 上海 2024-06-05 二等座）", e_context)
+            return
+        channel = e_context.econtext.get("channel")
+        if channel is None or not hasattr(channel, "send"):
+            self._send_error("当前通道不支持主动推送消息，无法订阅余票", e_context)
+            return
+        
+        config = self._config()
+        session_id = self._current_session().session_id
+        train_number = match.group("train").upper()
+        if len(self.watcher.subscriptions(session_id)) >= config.watch_max_per_session:
+            self._send_error(f"每个会话最多订阅{config.watch_max_per_session}个车次，请先取消部分订阅", e_context)
+            return
+        try:
+            date = datetime.strptime(match.group("date"), "%Y-%m-%d").strftime("%Y-%m-%d")
+        except ValueError:
+            self._send_error("日期格式错误，请使用如 2024-06-05 的格式", e_context)
+            return
+        from_loc, to_loc = self._validate_locations(e_context, match.group("from"), match.group("to"))
+        if not from_loc:
+            return
+        
+        seat = match.group("seat")
+        if seat:
+            seat = next((name for name in PLAN_SEAT_NAMES if seat in name or name in seat), seat)
+        
+        # 查询一次，确认车次存在并作为后续比较的基准；基准不能用过期的旧结果，否则第一次轮询会误报变化
+        key = (train_ticket_type(train_number), from_loc, to_loc, date)
+        trains = self.engine.fetch_tickets(*key, deadline=self._current_deadline(), allow_stale=False)
+        if trains is None:
+            self._send_error("查询车次失败，请稍后重试", e_context)
+            return
+        train = next((item for item in trains if str(item.get("trainumber", "")).upper() == train_number), None)
+        if train is None:
+            self._send_error(f"未找到{date}从{from_loc}到{to_loc}的{train_number}次列车", e_context)
+            return
+        seats = {item.get("seatname"): inventory_count(item.get("seatinventory"))
+                 for item in train.get("ticket_info") or []}
+        if seat and seat not in seats:
+            self._send_error(f"{train_number}次列车没有{seat}，可选座位：{'、'.join(seats)}", e_context)
+            return
+        try:
+            departs_at = datetime.strptime(f"{date} {train.get('departtime')}", "%Y-%m-%d %H:%M").timestamp()
+        except (TypeError, ValueError):
+            departs_at = datetime.strptime(date, "%Y-%m-%d").timestamp() + 86400
+        if departs_at <= time_module.time():
+            self._send_error(f"{train_number}次列车已发车，无法订阅", e_context)
+            return
+        
+        self.watcher.configure(config.watch_interval, config.watch_jitter, config.watch_max_inflight)
+        subscription = WatchSubscription(session_id, train_number, seat, e_context["context"], channel, departs_at)
+        self.watcher.subscribe(key, subscription, trains)
+        logger.info(f"新增余票订阅: {session_id} {key} {subscription.describe()}，当前轮询线路{self.watcher.route_count()}条")
+        
+        current = "、".join(f"{name}{inventory_text(count)}" for name, count in seats.items()
+                           if not seat or name == seat)
+        reply = Reply()
+        reply.type = ReplyType.TEXT
+        reply.content = (f"✅已订阅【{train_number}】{from_loc}→{to_loc} {date} {seat or '全部座位'}\n"
+                         f"当前余票：{current}\n"
+                         f"余票变化时会通知你，发车后自动取消。发送【取消订阅 {train_number}】可取消")
+        e_context["reply"] = reply
+        e_context.action = EventAction.BREAK_PASS
+
+    def _handle_watch_list(self, e_context):
+        """查看或取消本会话的余票订阅"""
+        session_id = self._current_session().session_id
+        match = UNWATCH_COMMAND_PATTERN.match(self.content)
+        if match:
+            train_number = (match.group("train") or "").upper() or None
+            removed = self.watcher.unsubscribe(session_id, train_number)
+            content = f"已取消{removed}个订阅" if removed else "没有找到对应的订阅"
+        else:
+            subscriptions = self.watcher.subscriptions(session_id)
+            if subscriptions:
+                content = "【我的订阅】\n" + "\n".join(
+                    f"{i}. {sub.describe()} {key[1]}→{key[2]} {key[3]}"
+                    for i, (key, sub) in enumerate(subscriptions, 1))
+            else:
+                content = "当前没有余票订阅"
+        reply = Reply()
+        reply.type = ReplyType.TEXT
+        reply.content = content
+        e_context["reply"] = reply
+        e_context.action = EventAction.BREAK_PASS
+
+    def _poll_watch_route(self, key):
+        """订阅轮询：只使用未过期的缓存，避免用旧结果比较余票变化"""
+        return self.engine.fetch_tickets(*key, priority=PRIORITY_PREFETCH, allow_stale=False)
+
+    def _submit_watch_poll(self, func, *args):
+        self._executor("watch", self._config().watch_max_inflight).submit(func, *args)
+
+    def _deliver_watch(self, subscription, text):
+        reply = Reply()
+        reply.type = ReplyType.TEXT
+        reply.content = text
+        subscription.channel.send(reply, subscription.context)
+
     def _handle_transfer_query(self, e_context):
         """处理中转查询请求"""
         query = self.content.strip()
@@ -1164,97 +1239,64 @@ class TicketQuery(Plugin):
         # 去掉"中转"前缀
         if query.startswith("中转"):
             query = query[2:].strip()
-            
-        # 优先使用LLM解析中转查询
-        if USE_OPENAI and OPENAI_API_KEY:
+        
+        # 本地规则解析置信度足够时直接使用，否则优先使用LLM解析
+        parsed_result = None
+        rule_parsed = self._rule_parse_query(query)
+        if self._is_confident_parse(rule_parsed):
+            logger.info("本地规则解析中转查询成功，跳过LLM")
+        elif self._config().use_openai:
             logger.info("使用LLM解析中转查询")
             parsed_result = self._ai_parse_transfer_query(query)
-            
-            if parsed_result:
-                logger.info(f"LLM解析中转查询成功: {parsed_result}")
-                
-                # 解析结果格式: 车型 出发城市 目的城市 日期 [时间]
-                parts = parsed_result.split()
-                
-                if len(parts) >= 3:  # 至少需要车型、出发城市和目的城市
-                    ticket_type = parts[0]
-                    from_loc = parts[1]
-                    to_loc = parts[2]
-                    date = parts[3] if len(parts) >= 4 else datetime.now().strftime("%Y-%m-%d")
-                    time = parts[4] if len(parts) >= 5 else None
-                    
-                    logger.info(f"解析结果: 车型={ticket_type}, 出发地={from_loc}, 目的地={to_loc}, 日期={date}, 时间={time}")
-                    
-                    # 查找可能的中转站
-                    user_specified = None # 用户是否在查询中指定了中转站
-                    transfer_stations = self._find_transfer_stations(from_loc, to_loc, user_specified)
-                    
-                    if not transfer_stations:
-                        self._send_error(f"无法找到从{from_loc}到{to_loc}的合适中转站", e_context)
-                        return
-                    
-                    # 搜索所有中转路线
-                    transfer_routes = self._search_transfer_routes(ticket_type, from_loc, to_loc, transfer_stations, date, time)
-                    
-                    if not transfer_routes:
-                        self._send_error(f"未找到从{from_loc}到{to_loc}的中转路线", e_context)
-                        return
-                    
-                    # 保存查询结果
-                    self.original_data = transfer_routes
-                    self.total_data = transfer_routes
-                    self.is_transfer_query = True
-                    self.current_page = 1
-                    
-                    # 格式化响应
-                    page_data = transfer_routes[:20]  # 限制显示条数
-                    reply_content = self._format_transfer_response(page_data)
-                    
-                    reply = Reply()
-                    reply.type = ReplyType.TEXT
-                    reply.content = reply_content
-                    e_context["reply"] = reply
-                    e_context.action = EventAction.BREAK_PASS
-                    return
-                else:
-                    logger.warning(f"LLM解析结果不完整: {parsed_result}")
-            else:
+            if not parsed_result:
                 logger.warning("LLM解析中转查询失败")
         
-        # 如果LLM解析失败或不可用，尝试使用传统解析方法
-        logger.info("尝试使用传统方法解析中转查询")
-        result = self._parse_natural_transfer_query(query)
+        # LLM解析失败或不可用时使用规则解析结果
+        if not parsed_result and rule_parsed:
+            parsed_result = (rule_parsed["ticket_type"], rule_parsed["from_loc"], rule_parsed["to_loc"],
+                             rule_parsed["date"], rule_parsed["time"], rule_parsed["transfer_station"])
         
-        if not result:
+        if not parsed_result:
             self._send_error("无法理解查询，请使用正确格式：中转+车型 出发城市 目的城市 日期 [时间]", e_context)
             return
-            
-        ticket_type, from_loc, to_loc, date, time = result
+        
+        # 解析结果格式: (车型, 出发城市, 目的城市, 日期, 时间, 指定中转站)
+        ticket_type, from_loc, to_loc, date, time, user_specified = parsed_result
+        date = date or datetime.now().strftime("%Y-%m-%d")
         logger.info(f"解析结果: 车型={ticket_type}, 出发地={from_loc}, 目的地={to_loc}, 日期={date}, 时间={time}")
         
-        # 处理剩余的逻辑与之前相同
-        user_specified = None
-        transfer_stations = self._find_transfer_stations(from_loc, to_loc, user_specified)
+        # 校验城市，未知站点直接提示，不发起网络请求
+        from_loc, to_loc, user_specified = self._validate_locations(e_context, from_loc, to_loc, user_specified)
+        if not from_loc:
+            return
+        
+        # 查找可能的中转站（用户在查询中指定了中转站时优先使用）
+        transfer_stations = self.engine.find_transfer_stations(from_loc, to_loc, user_specified)
         
         if not transfer_stations:
             self._send_error(f"无法找到从{from_loc}到{to_loc}的合适中转站", e_context)
             return
         
-        transfer_routes = self._search_transfer_routes(ticket_type, from_loc, to_loc, transfer_stations, date, time)
+        # 搜索所有中转路线，耗时预算用完时只返回已查到的方案
+        deadline = self._current_deadline()
+        transfer_routes = self.engine.search_transfer_routes(ticket_type, from_loc, to_loc, transfer_stations, date, time,
+                                                       deadline=deadline)
         
         if not transfer_routes:
-            self._send_error(f"未找到从{from_loc}到{to_loc}的中转路线", e_context)
+            if deadline.expired():
+                self._send_error("查询超时，请稍后重试", e_context)
+            else:
+                self._send_error(f"未找到从{from_loc}到{to_loc}的中转路线", e_context)
             return
         
         # 保存查询结果
-        self.original_data = transfer_routes
-        self.total_data = transfer_routes
-        self.is_transfer_query = True
-        self.current_page = 1
+        self._store_results(transfer_routes, is_transfer=True)
         
         # 格式化响应
         page_data = transfer_routes[:20]  # 限制显示条数
         reply_content = self._format_transfer_response(page_data)
+        if deadline.expired():
+            reply_content += "\n⏱查询时间有限，以上为部分中转站的方案"
         
         reply = Reply()
         reply.type = ReplyType.TEXT
@@ -1263,60 +1305,46 @@ class TicketQuery(Plugin):
         e_context.action = EventAction.BREAK_PASS
 
     def _ai_parse_query(self, query):
-        """使用OpenAI解析自然语言查询"""
-        if not USE_OPENAI or not OPENAI_API_KEY:
+        """使用OpenAI解析自然语言查询（结果按当天日期缓存）"""
+        if not self._config().use_openai:
             return None
-            
+        return self._cached_parse("direct", query, self._llm_parse_query)
+
+    def _ai_parse_transfer_query(self, query):
+        """使用OpenAI解析中转查询（结果按当天日期缓存）"""
+        return self._cached_parse("transfer", query, self._llm_parse_transfer_query)
+
+    def _cached_parse(self, kind, query, parse_func):
+        """查询解析缓存，未命中时调用LLM并记录耗时；解析失败的结果不缓存"""
+        key = (kind, normalize_query(query), datetime.now().strftime("%Y-%m-%d"))
+        cached = self.parse_cache.get(key)
+        if cached is not None:
+            stats = self.parse_cache.stats()
+            logger.info(f"解析缓存命中: {query} -> {cached}，命中率: {stats['hit_ratio']:.1%}，"
+                        f"累计节省LLM时间: {stats['saved_seconds']:.1f}秒")
+            return cached
+        
+        start = time_module.perf_counter()
+        result = parse_func(query)
+        elapsed = time_module.perf_counter() - start
+        if result:
+            self.parse_cache.set(key, result, ttl=seconds_until_midnight(), cost=elapsed)
+        logger.info(f"LLM解析耗时: {elapsed:.2f}秒，解析缓存命中率: {self.parse_cache.hit_ratio():.1%}")
+        return result
+
+    def _llm_parse_query(self, query):
+        """调用LLM解析自然语言查询"""
         logger.info(f"使用LLM解析查询: {query}")
         
         try:
-            # 强制重新配置OpenAI
-            openai.api_key = OPENAI_API_KEY
-            openai.api_base = OPENAI_API_BASE
-            
-            # 获取当前日期信息，供提示中使用
-            now = datetime.now()
-            today_date = now.strftime("%Y-%m-%d")
-            tomorrow_date = (now + timedelta(days=1)).strftime("%Y-%m-%d")
-            day_after_tomorrow_date = (now + timedelta(days=2)).strftime("%Y-%m-%d")
-            
-            # 计算本周和下周的各天日期
-            weekday_today = now.weekday()  # 0是周一，6是周日
-            
-            # 计算本周各天的日期
-            this_week_dates = {}
-            for i in range(7):
-                day_offset = i - weekday_today  # 相对于今天的偏移
-                date = (now + timedelta(days=day_offset)).strftime("%Y-%m-%d")
-                this_week_dates[i] = date  # 0->周一, 1->周二, ...
-                
-            # 计算下周各天的日期
-            next_week_dates = {}
-            for i in range(7):
-                day_offset = i - weekday_today + 7  # 加7表示下一周
-                date = (now + timedelta(days=day_offset)).strftime("%Y-%m-%d")
-                next_week_dates[i] = date
-                
-            # 当前日期信息
-            current_date_info = f"""
-            今天是 {today_date}，是{['周一', '周二', '周三', '周四', '周五', '周六', '周日'][weekday_today]}
-            明天是 {tomorrow_date}
-            后天是 {day_after_tomorrow_date}
-            本周一是 {this_week_dates[0]}
-            本周二是 {this_week_dates[1]}
-            本周三是 {this_week_dates[2]}
-            本周四是 {this_week_dates[3]}
-            本周五是 {this_week_dates[4]}
-            本周六是 {this_week_dates[5]}
-            本周日是 {this_week_dates[6]}
-            下周一是 {next_week_dates[0]}
-            下周二是 {next_week_dates[1]}
-            下周三是 {next_week_dates[2]}
-            下周四是 {next_week_dates[3]}
-            下周五是 {next_week_dates[4]}
-            下周六是 {next_week_dates[5]}
-            下周日是 {next_week_dates[6]}
-            """
+            # 获取当前日期信息，供提示中使用（同一天内复用）
+            date_context = relative_dates(datetime.now().date())
+            today_date = date_context["today"]
+            tomorrow_date = date_context["tomorrow"]
+            day_after_tomorrow_date = date_context["day_after_tomorrow"]
+            this_week_dates = date_context["this_week"]
+            next_week_dates = date_context["next_week"]
+            current_date_info = date_context["table"]
             
             # 构建提示
             prompt = f"""
@@ -1346,89 +1374,12 @@ class TicketQuery(Plugin):
             解析结果：高铁 武汉 长沙 {next_week_dates[2]} 10:00
             """
             
-            # 尝试多种方式调用OpenAI API
-            result_text = ""
-            
-            # 标准Python库方法失败后尝试直接使用requests调用API
-            all_standard_methods_failed = False
-            
+            # 调用OpenAI API
             try:
-                # 第一种方式：标准ChatCompletion API
-                response = openai.ChatCompletion.create(
-                    model=OPENAI_MODEL,
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.3,
-                    max_tokens=50
-                )
-                result_text = response.choices[0].message.content.strip()
-                
-            except AttributeError as attr_error:
-                try:
-                    # 第二种方式：最新客户端格式
-                    response = openai.chat.completions.create(
-                        model=OPENAI_MODEL,
-                        messages=[{"role": "user", "content": prompt}],
-                        temperature=0.3,
-                        max_tokens=50
-                    )
-                    result_text = response.choices[0].message.content.strip()
-                    
-                except Exception as latest_error:
-                    try:
-                        # 第三种方式：旧版Completion API
-                        response = openai.Completion.create(
-                            model=OPENAI_MODEL,
-                            prompt=prompt,
-                            temperature=0.3,
-                            max_tokens=50
-                        )
-                        result_text = response.choices[0].text.strip()
-                    except Exception as old_api_error:
-                        all_standard_methods_failed = True
-            
+                result_text = self._chat_completion(prompt, temperature=0.3, max_tokens=50)
             except Exception as api_error:
                 logger.error(f"API调用失败: {api_error}")
-                all_standard_methods_failed = True
-                
-            # 如果所有标准方法都失败，尝试直接使用requests
-            if all_standard_methods_failed:
-                try:
-                    # 构建请求URL - 确保URL格式正确
-                    api_base = OPENAI_API_BASE
-                    # 移除末尾的斜杠以避免双斜杠
-                    if api_base.endswith("/"):
-                        api_base = api_base[:-1]
-                    
-                    # 检查是否需要添加版本路径
-                    if "v1" not in api_base.split("/")[-1]:
-                        api_url = f"{api_base}/chat/completions"
-                    else:
-                        api_url = f"{api_base}/chat/completions"
-                    
-                    # 构建请求头
-                    headers = {
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {OPENAI_API_KEY}"
-                    }
-                    
-                    # 构建请求数据
-                    payload = {
-                        "model": OPENAI_MODEL,
-                        "messages": [{"role": "user", "content": prompt}],
-                        "temperature": 0.3,
-                        "max_tokens": 50
-                    }
-                    
-                    response = requests.post(api_url, headers=headers, json=payload, timeout=30)
-                    
-                    # 检查响应状态
-                    if response.status_code == 200:
-                        response_json = response.json()
-                        result_text = response_json["choices"][0]["message"]["content"].strip()
-                    else:
-                        logger.error(f"HTTP请求失败: {response.text}")
-                except Exception as req_error:
-                    logger.error(f"HTTP请求出错: {req_error}")
+                result_text = ""
             
             if not result_text:
                 return None
@@ -1490,7 +1441,7 @@ class TicketQuery(Plugin):
                 if not re.match(r"\d{1,2}:\d{2}", time_part):
                     # 处理自然语言时间表达
                     if time_part in ["上午", "下午", "晚上", "早上", "中午", "傍晚", "凌晨", "夜晚", "夜里"]:
-                        # 不做转换，保留原始表达，让_process_api_data方法处理
+                        # 不做转换，保留原始表达，让查询引擎的_process_api_data方法处理
                         pass
                     else:
                         # 尝试将模糊时间转换为特定时间点
@@ -1521,26 +1472,20 @@ class TicketQuery(Plugin):
             logger.error(f"OpenAI解析失败: {str(e)}")
             return None
 
-    def _ai_parse_transfer_query(self, query):
-        """使用OpenAI解析中转查询"""
+    def _llm_parse_transfer_query(self, query):
+        """调用LLM解析中转查询"""
         logger.info(f"使用OpenAI解析中转查询: {query}")
         
         try:
             # 配置OpenAI客户端
             logger.info(f"初始化OpenAI客户端...")
-            logger.info(f"API密钥: {OPENAI_API_KEY[:8]}...")
-            logger.info(f"API基础URL: {OPENAI_API_BASE}")
-            logger.info(f"使用模型: {OPENAI_MODEL}")
-            
-            # 强制重新配置OpenAI
-            openai.api_key = OPENAI_API_KEY
-            openai.api_base = OPENAI_API_BASE
+            logger.info(f"使用模型: {self._config().model}")
             
             # 获取当前日期
-            now = datetime.now()
-            today = now.strftime("%Y-%m-%d")
-            tomorrow = (now + timedelta(days=1)).strftime("%Y-%m-%d")
-            day_after_tomorrow = (now + timedelta(days=2)).strftime("%Y-%m-%d")
+            date_context = relative_dates(datetime.now().date())
+            today = date_context["today"]
+            tomorrow = date_context["tomorrow"]
+            day_after_tomorrow = date_context["day_after_tomorrow"]
             
             # 构建提示
             prompt = f"""
@@ -1570,44 +1515,9 @@ class TicketQuery(Plugin):
             """
             
             # 调用OpenAI API
-            logger.info(f"正在调用OpenAI API - 使用模型: {OPENAI_MODEL}")
+            logger.info(f"正在调用OpenAI API - 使用模型: {self._config().model}")
             
-            try:
-                # 新版API调用
-                logger.info("尝试使用新版OpenAI API (ChatCompletion)")
-                response = openai.ChatCompletion.create(
-                    model=OPENAI_MODEL,
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.3,
-                    max_tokens=500
-                )
-                logger.info("新版API调用成功!")
-                result_text = response.choices[0].message.content.strip()
-                
-            except AttributeError:
-                try:
-                    # 最新客户端格式
-                    logger.info("尝试使用最新客户端格式")
-                    response = openai.chat.completions.create(
-                        model=OPENAI_MODEL,
-                        messages=[{"role": "user", "content": prompt}],
-                        temperature=0.3,
-                        max_tokens=500
-                    )
-                    logger.info("最新客户端API调用成功!")
-                    result_text = response.choices[0].message.content.strip()
-                    
-                except Exception as latest_error:
-                    logger.warning(f"最新客户端API调用失败: {latest_error}")
-                    logger.info("尝试使用旧版OpenAI API (Completion)")
-                    response = openai.Completion.create(
-                        model=OPENAI_MODEL,
-                        prompt=prompt,
-                        temperature=0.3,
-                        max_tokens=500
-                    )
-                    logger.info("旧版API调用成功!")
-                    result_text = response.choices[0].text.strip()
+            result_text = self._chat_completion(prompt, temperature=0.3, max_tokens=500)
             
             # 检查并去除markdown代码块格式
             if result_text.startswith("```"):
@@ -1659,321 +1569,18 @@ class TicketQuery(Plugin):
             logger.error(traceback.format_exc())
             return None
 
-    def _parse_natural_transfer_query(self, query):
-        """解析自然语言中转查询"""
-        try:
-            logger.info(f"解析自然语言中转查询: {query}")
-            
-            # 1. 提取车型
-            ticket_type = "高铁"  # 默认高铁
-            if "高铁" in query:
-                ticket_type = "高铁"
-            elif "动车" in query:
-                ticket_type = "动车"
-            elif "火车" in query:
-                ticket_type = "普通"
-            
-            # 2. 提取城市 - 支持多种表达方式
-            # 匹配模式1：从A到B
-            location_pattern1 = r"从([\u4e00-\u9fa5]+)到([\u4e00-\u9fa5]+)"
-            # 匹配模式2：A到B / A至B / A去B
-            location_pattern2 = r"([\u4e00-\u9fa5]+)(?:到|至|去)([\u4e00-\u9fa5]+)"
-            
-            # 预处理内容
-            time_keywords = ["今天", "明天", "后天", "下午", "上午", "晚上", "凌晨", "中午", "早上"]
-            cleaned_content = query
-            for keyword in time_keywords:
-                cleaned_content = cleaned_content.replace(keyword, " " + keyword + " ")
-                
-            # 查找城市
-            location_match = re.search(location_pattern1, cleaned_content)
-            if not location_match:
-                location_match = re.search(location_pattern2, cleaned_content)
-                
-            if not location_match:
-                logger.warning("自然语言解析: 未找到出发地和目的地")
-                return None
-                
-            from_city = location_match.group(1).strip()
-            to_city = location_match.group(2).strip()
-            
-            # 清除可能的额外文本和时间词
-            for keyword in time_keywords:
-                from_city = from_city.replace(keyword, "").strip()
-                to_city = to_city.replace(keyword, "").strip()
-                
-            # 清除可能的额外文本
-            to_city = to_city.split("的")[0].strip() if "的" in to_city else to_city
-            
-            logger.info(f"识别到城市: {from_city} -> {to_city}")
-            
-            # 3. 处理时间
-            now = datetime.now()
-            query_date = now.strftime("%Y-%m-%d")  # 默认今天
-            query_time = None
-            
-            # 处理日期
-            if "明天" in query:
-                query_date = (now + timedelta(days=1)).strftime("%Y-%m-%d")
-                logger.info(f"识别到日期: 明天 ({query_date})")
-            elif "后天" in query:
-                query_date = (now + timedelta(days=2)).strftime("%Y-%m-%d")
-                logger.info(f"识别到日期: 后天 ({query_date})")
-            else:
-                logger.info(f"使用默认日期: 今天 ({query_date})")
-                
-            # 处理具体时间
-            time_pattern = r"(\d{1,2})(?:点|时|:|：)(\d{0,2})(?:分|)|(\d{1,2})(?:点|时)"
-            time_match = re.search(time_pattern, query)
-            
-            if time_match:
-                if time_match.group(3):  # 匹配了"3点"这种格式
-                    hour = int(time_match.group(3))
-                    minute = 0
-                else:  # 匹配了"3:30"或"3点30分"这种格式
-                    hour = int(time_match.group(1))
-                    minute = int(time_match.group(2)) if time_match.group(2) else 0
-                
-                # 处理12小时制转24小时制
-                if "下午" in query or "晚上" in query:
-                    if hour < 12:
-                        hour += 12
-                        
-                query_time = f"{hour:02d}:{minute:02d}"
-                logger.info(f"提取到具体时间: {query_time}")
-            
-            # 如果没有提取到具体时间，则尝试提取时间段
-            if not query_time:
-                if "上午" in query:
-                    query_time = "09:00"
-                    logger.info("识别到时间段: 上午，设置为09:00")
-                elif "下午" in query and "晚" not in query:
-                    query_time = "14:00"
-                    logger.info("识别到时间段: 下午，设置为14:00")
-                elif "晚上" in query or "傍晚" in query:
-                    query_time = "19:00"
-                    logger.info("识别到时间段: 晚上，设置为19:00")
-            
-            # 返回解析结果
-            if from_city and to_city:
-                return ticket_type, from_city, to_city, query_date, query_time
-            else:
-                return None
-                
-        except Exception as e:
-            logger.error(f"自然语言中转查询解析失败: {e}")
-            logger.error(traceback.format_exc())
-            return None
-
-    def _find_transfer_stations(self, from_loc, to_loc, user_specified=None):
-        """确定中转站"""
-        logger.info(f"寻找从{from_loc}到{to_loc}的中转站")
-        
-        # 1. 如果用户指定了中转站，优先使用
-        if user_specified:
-            logger.info(f"使用用户指定的中转站: {user_specified}")
-            return [user_specified]
-            
-        # 2. 查找预定义的中转站
-        key = (from_loc, to_loc)
-        if key in TRANSFER_STATIONS:
-            logger.info(f"使用预定义的中转站: {TRANSFER_STATIONS[key]}")
-            return TRANSFER_STATIONS[key]
-            
-        # 3. 使用主要枢纽站作为候选中转站
-        # 实际应用中，这里可以调用API查询更精确的中转站
-        # 为了简化，这里暂时使用主要枢纽站中的前5个
-        # 在实际实现中，应该根据地理位置和线路优化选择
-        logger.info("没有预定义中转站，使用主要枢纽站作为候选")
-        return MAJOR_STATIONS[:5]
-
-    def _search_transfer_routes(self, ticket_type, from_loc, to_loc, transfer_stations, date, time=None):
-        """查询中转路线"""
-        logger.info(f"开始查询中转路线: {from_loc} -> [中转] -> {to_loc}")
-        
-        all_routes = []
-        min_transfer_time = 30  # 最小换乘时间（分钟）
-        max_transfer_time = 180  # 最大换乘时间（分钟）
-        
-        for transfer_station in transfer_stations:
-            logger.info(f"查询经由 {transfer_station} 的中转路线")
-            
-            # 查询第一段: 出发地 -> 中转站
-            first_leg = self.get_ticket_info(ticket_type, from_loc, transfer_station, date, time)
-            if not first_leg:
-                logger.warning(f"未找到从 {from_loc} 到 {transfer_station} 的车次")
-                continue
-                
-            logger.info(f"找到从 {from_loc} 到 {transfer_station} 的车次数量: {len(first_leg)}")
-            
-            # 查询第二段: 中转站 -> 目的地
-            second_leg = self.get_ticket_info(ticket_type, transfer_station, to_loc, date, None)
-            if not second_leg:
-                logger.warning(f"未找到从 {transfer_station} 到 {to_loc} 的车次")
-                continue
-                
-            logger.info(f"找到从 {transfer_station} 到 {to_loc} 的车次数量: {len(second_leg)}")
-            
-            # 匹配合适的中转方案
-            for train1 in first_leg:
-                arrival_time = train1.get('arrivetime', '')
-                if not arrival_time:
-                    continue
-                    
-                arrival_time_obj = datetime.strptime(arrival_time, "%H:%M").time()
-                arrival_minutes = arrival_time_obj.hour * 60 + arrival_time_obj.minute
-                
-                for train2 in second_leg:
-                    depart_time = train2.get('departtime', '')
-                    if not depart_time:
-                        continue
-                        
-                    depart_time_obj = datetime.strptime(depart_time, "%H:%M").time()
-                    depart_minutes = depart_time_obj.hour * 60 + depart_time_obj.minute
-                    
-                    # 计算换乘时间（分钟）
-                    # 如果第二段车次时间早于第一段，则认为是第二天的车次
-                    transfer_minutes = depart_minutes - arrival_minutes
-                    if transfer_minutes < 0:
-                        # 跨天情况，加上24小时
-                        transfer_minutes += 24 * 60
-                        
-                    # 判断换乘时间是否合理
-                    if min_transfer_time <= transfer_minutes <= max_transfer_time:
-                        # 计算总价格（以二等座为例）
-                        total_price = self._calculate_total_price(train1, train2)
-                        
-                        # 计算总时间
-                        total_runtime = self._calculate_total_runtime(train1, train2, transfer_minutes)
-                        
-                        route = {
-                            'first_leg': train1,
-                            'second_leg': train2,
-                            'transfer_station': transfer_station,
-                            'transfer_time': transfer_minutes,
-                            'total_price': total_price,
-                            'total_runtime': total_runtime
-                        }
-                        all_routes.append(route)
-                        logger.info(f"找到可行的中转方案: {train1['trainumber']} -> {train2['trainumber']}, "
-                                  f"换乘时间: {transfer_minutes}分钟, 总价格: {total_price}元")
-        
-        # 按总时间排序
-        all_routes.sort(key=lambda x: x['total_runtime'])
-        logger.info(f"共找到{len(all_routes)}个可行的中转方案")
-        
-        # 返回前10个方案
-        return all_routes[:10]
-
-    def _calculate_total_price(self, train1, train2):
-        """计算两段行程的总价格（默认以二等座为参考）"""
-        try:
-            # 找出第一段的二等座价格，如果没有则使用一等座或商务座
-            price1 = 0
-            for seat in train1.get('ticket_info', []):
-                if seat.get('seatname') == '二等座':
-                    price1 = float(seat.get('seatprice', 0))
-                    break
-            if price1 == 0:
-                # 找不到二等座，尝试其他座位
-                for seat in train1.get('ticket_info', []):
-                    if seat.get('seatprice'):
-                        price1 = float(seat.get('seatprice', 0))
-                        break
-            
-            # 找出第二段的二等座价格
-            price2 = 0
-            for seat in train2.get('ticket_info', []):
-                if seat.get('seatname') == '二等座':
-                    price2 = float(seat.get('seatprice', 0))
-                    break
-            if price2 == 0:
-                # 找不到二等座，尝试其他座位
-                for seat in train2.get('ticket_info', []):
-                    if seat.get('seatprice'):
-                        price2 = float(seat.get('seatprice', 0))
-                        break
-                        
-            return price1 + price2
-        except Exception as e:
-            logger.error(f"计算总价格时出错: {e}")
-            return 0
-
-    def _calculate_total_runtime(self, train1, train2, transfer_minutes):
-        """计算总行程时间（分钟）"""
-        try:
-            # 解析第一段运行时间
-            runtime1_str = train1.get('runtime', '0小时0分钟')
-            runtime1 = self._convert_runtime_to_minutes(runtime1_str)
-            
-            # 解析第二段运行时间
-            runtime2_str = train2.get('runtime', '0小时0分钟')
-            runtime2 = self._convert_runtime_to_minutes(runtime2_str)
-            
-            # 总时间 = 第一段时间 + 换乘时间 + 第二段时间
-            total_runtime = runtime1 + transfer_minutes + runtime2
-            return total_runtime
-        except Exception as e:
-            logger.error(f"计算总行程时间时出错: {e}")
-            return 0
-
     def _format_transfer_response(self, routes):
         """格式化中转查询结果"""
         if not routes:
             return "未找到合适的中转方案"
             
-        result = ["【中转查询结果】"]
-        
-        for idx, route in enumerate(routes, 1):
-            first_leg = route['first_leg']
-            second_leg = route['second_leg']
-            transfer_station = route['transfer_station']
-            transfer_time = route['transfer_time']
-            total_price = route['total_price']
-            
-            # 计算总时间，格式化为小时和分钟
-            total_minutes = route['total_runtime']
-            total_hours = total_minutes // 60
-            total_mins = total_minutes % 60
-            total_time_str = f"{total_hours}小时{total_mins}分钟"
-            
-            # 拼接结果
-            route_info = []
-            route_info.append(f"\n{idx}. 【总时长: {total_time_str}】 【总票价: ¥{total_price}】")
-            
-            # 第一段行程
-            route_info.append(f"① {first_leg.get('trainumber')} {first_leg.get('traintype')}: "
-                            f"{first_leg.get('departstation')}({first_leg.get('departtime')}) → "
-                            f"{transfer_station}({first_leg.get('arrivetime')})")
-            
-            # 换乘信息
-            transfer_hours = transfer_time // 60
-            transfer_mins = transfer_time % 60
-            route_info.append(f"   🔄 {transfer_station}站内换乘 {transfer_hours}小时{transfer_mins}分钟")
-            
-            # 第二段行程
-            route_info.append(f"② {second_leg.get('trainumber')} {second_leg.get('traintype')}: "
-                            f"{transfer_station}({second_leg.get('departtime')}) → "
-                            f"{second_leg.get('arrivestation')}({second_leg.get('arrivetime')})")
-            
-            # 票价信息
-            route_info.append("💰票价详情:")
-            route_info.append(f"   第一段: " + " | ".join([
-                f"{s.get('seatname', '未知')}：¥{s.get('seatprice', '未知')}（余{s.get('seatinventory', 0)}张）"
-                for s in first_leg.get('ticket_info', [])[:3]  # 只显示前3种席别
-            ]))
-            route_info.append(f"   第二段: " + " | ".join([
-                f"{s.get('seatname', '未知')}：¥{s.get('seatprice', '未知')}（余{s.get('seatinventory', 0)}张）"
-                for s in second_leg.get('ticket_info', [])[:3]  # 只显示前3种席别
-            ]))
-            
-            result.append("\n".join(route_info))
+        result = "【中转查询结果】\n\n" + self.renderer.render(routes)
         
         # 添加页脚
-        footer = "\n📌提示: 以上为系统推荐的最佳中转方案，按总耗时排序"
+        footer = "\n📌提示: 以上为系统推荐的最佳中转方案，综合总耗时、票价与换乘余量排序"
         footer += "\n💡如需指定中转站，请使用格式: 中转+经南京+高铁 成都 上海"
         
-        return "\n".join(result) + footer
+        return result + footer
 
     def _send_error(self, message, e_context):
         """发送错误信息"""
@@ -2009,7 +1616,7 @@ class TicketQuery(Plugin):
             
         return "\n\n".join(result)
 
-    def _process_query(self, e_context: EventContext):
+    def _process_query(self, e_context: EventContext, rule_parsed=None):
         """处理所有类型的查询请求"""
         query = self.content.strip()
         
@@ -2020,13 +1627,23 @@ class TicketQuery(Plugin):
         # 检查是否是标准格式查询（车型 出发地 目的地 日期 时间）
         parts = query.split()
         
-        # 优先使用LLM解析所有自然语言查询
-        if USE_OPENAI and OPENAI_API_KEY:
+        # 本地规则解析置信度足够时直接使用，否则优先使用LLM解析
+        if rule_parsed is None:
+            rule_parsed = self._rule_parse_query(query)
+        parsed_query = None
+        if self._is_confident_parse(rule_parsed):
+            parsed_query = self._format_parsed_query(rule_parsed)
+            logger.info(f"本地规则解析结果（跳过LLM）: {parsed_query}")
+        elif self._config().use_openai:
             parsed_query = self._ai_parse_query(query)
-            if parsed_query:
-                logger.info(f"解析结果: {parsed_query}")
-                self.content = parsed_query
-                parts = parsed_query.split()
+        if not parsed_query and rule_parsed:
+            # LLM不可用或解析失败时，使用置信度较低的规则解析结果
+            parsed_query = self._format_parsed_query(rule_parsed)
+        
+        if parsed_query:
+            logger.info(f"解析结果: {parsed_query}")
+            self.content = parsed_query
+            parts = parsed_query.split()
         
         # 检查是否满足标准格式
         if len(parts) < 3:
@@ -2036,212 +1653,74 @@ class TicketQuery(Plugin):
         # 已经是标准格式或经过处理后的查询
         return self._handle_main_query(e_context)
 
-    def _convert_runtime_to_minutes(self, runtime_str):
-        """将运行时长字符串转换为分钟数"""
-        try:
-            # 处理格式如 "4小时31分钟"
-            hours = 0
-            minutes = 0
-            hour_match = re.search(r"(\d+)小时", runtime_str)
-            if hour_match:
-                hours = int(hour_match.group(1))
-            minute_match = re.search(r"(\d+)分钟", runtime_str)
-            if minute_match:
-                minutes = int(minute_match.group(1))
-            return hours * 60 + minutes
-        except Exception as e:
-            logger.error(f"运行时间转换错误：{runtime_str}, {e}")
-            return 0
+    def _rule_parse_query(self, query):
+        """使用本地规则解析查询，并记录高置信度命中率"""
+        parsed = self.rule_parser.parse(query)
+        stats = self.rule_parse_stats
+        stats["total"] += 1
+        if self._is_confident_parse(parsed):
+            stats["confident"] += 1
+        logger.info(f"本地规则解析: {parsed}，高置信度命中率: {stats['confident']}/{stats['total']}")
+        return parsed
+
+    def _is_confident_parse(self, parsed):
+        return bool(parsed) and parsed["confidence"] >= self._config().rule_parse_threshold
 
-    def _ai_filter(self, question):
-        """使用OpenAI筛选普通查询结果"""
-        if not USE_OPENAI or not OPENAI_API_KEY:
+    @staticmethod
+    def _format_parsed_query(parsed):
+        """将解析结果转换为"车型 出发城市 目的城市 日期 [时间]"格式"""
+        parts = [parsed["ticket_type"], parsed["from_loc"], parsed["to_loc"], parsed["date"]]
+        if parsed.get("time"):
+            parts.append(parsed["time"])
+        return " ".join(parts)
+
+    def _ai_filter(self, question, base):
+        """使用OpenAI筛选普通查询结果（base中的车次分块并发筛选后合并）"""
+        if not self._config().use_openai:
             logger.warning("OpenAI配置无效，无法使用AI筛选")
             return None
             
         try:
-            # 配置OpenAI
-            logger.info(f"初始化OpenAI客户端...")
-            logger.info(f"API密钥前8位: {OPENAI_API_KEY[:8] if OPENAI_API_KEY else '未配置'}")
-            logger.info(f"API基础URL: {OPENAI_API_BASE}")
-            logger.info(f"使用模型: {OPENAI_MODEL}")
-            
-            # 强制重新配置OpenAI
-            openai.api_key = OPENAI_API_KEY
-            openai.api_base = OPENAI_API_BASE
-            
-            # 准备数据，始终使用原始数据，限制数量防止超出API限制
-            max_data_items = min(len(self.original_data), 30)
-            sample_data = self.original_data[:max_data_items]
-            
-            # 简化样本数据以适应token限制
-            simplified_samples = []
-            for train in sample_data:
-                simplified = {
-                    "trainumber": train.get("trainumber"),
-                    "traintype": train.get("traintype"),
-                    "departtime": train.get("departtime"),
-                    "arrivetime": train.get("arrivetime"),
-                    "runtime": train.get("runtime"),
-                    "departstation": train.get("departstation"),
-                    "arrivestation": train.get("arrivestation"),
-                    "ticket_info": [
-                        {
-                            "seatname": seat.get("seatname"),
-                            "seatprice": seat.get("seatprice"),
-                            "seatinventory": seat.get("seatinventory")
-                        } for seat in train.get("ticket_info", [])[:3]  # 只保留前三种座位类型
-                    ],
-                    "index": sample_data.index(train)  # 添加索引以便后续查找
-                }
-                simplified_samples.append(simplified)
-            
-            sample_json = json.dumps(simplified_samples, ensure_ascii=False)
-            logger.info(f"已准备{len(simplified_samples)}/{len(self.original_data)}条数据用于AI筛选")
+            logger.info(f"使用模型: {self._config().model}")
             
-            # 构建提示
-            prompt = f"""
+            # 优先使用筛选计划在本地处理全部车次，提示长度与结果数量无关
+            planned = self._plan_filter("train", question, base)
+            if planned is not None:
+                return planned
+            
+            # 准备数据：全部车次编码为紧凑表格，并按token预算分块
+            header, lines = encode_train_table([(i, base.rows[i]) for i in base.indices])
+            chunks = pack_table(header, lines, self._config().filter_prompt_token_budget)
+            
+            def build_prompt(table):
+                return f"""
             请根据以下筛选条件，从给定的列车数据中找出满足条件的车次："{question}"
             
             具体要求：
-            1. 返回完全符合条件的车次索引列表
+            1. 返回完全符合条件的车次序号列表
             2. 如果筛选条件包含价格相关（如最便宜、最贵），应当按价格排序
             3. 如果筛选条件包含时间相关（如最早、最晚、上午、下午），应当按出发时间筛选
             4. 如果条件包含座位偏好（如二等座、一等座、商务座），应当筛选相应票种
             5. 如果条件包含余票要求，应当检查对应座位的余票情况
+            6. 表格可能只是全部车次的一部分，"最便宜""最晚"等条件只需返回本表中最符合的车次，最终排序由程序完成
             
-            车次信息如下（JSON格式）：
-            {sample_json}
+            车次信息如下（表格，首行为表头，列以"|"分隔；座位列格式为"票价/余票"，历时单位为分钟）：
+{table}
             
             请返回以下JSON格式结果（不要输出其他解释）：
             {{
-                "matched_indices": [索引列表],
-                "explanation": "简要解释为什么选中这些车次",
-                "is_sorted": true/false,
-                "sort_criteria": "排序依据（如价格、时间等）"
+                "matched_indices": [序号列表（表格第一列）],
+                "explanation": "简要解释为什么选中这些车次"
             }}
             """
             
-            # 调用OpenAI
-            try:
-                logger.info("开始调用OpenAI API进行筛选...")
-                result_text = ""
-                
-                try:
-                    # 标准ChatCompletion API
-                    response = openai.ChatCompletion.create(
-                        model=OPENAI_MODEL,
-                        messages=[{"role": "user", "content": prompt}],
-                        temperature=0.3,
-                        max_tokens=1000
-                    )
-                    result_text = response.choices[0].message.content.strip()
-                    
-                except AttributeError:
-                    try:
-                        # 最新客户端格式
-                        response = openai.chat.completions.create(
-                            model=OPENAI_MODEL,
-                            messages=[{"role": "user", "content": prompt}],
-                            temperature=0.3,
-                            max_tokens=1000
-                        )
-                        result_text = response.choices[0].message.content.strip()
-                        
-                    except Exception as latest_error:
-                        logger.warning(f"最新API调用失败: {latest_error}")
-                        
-                        try:
-                            # 旧版API
-                            response = openai.Completion.create(
-                                model=OPENAI_MODEL,
-                                prompt=prompt,
-                                temperature=0.3,
-                                max_tokens=1000
-                            )
-                            result_text = response.choices[0].text.strip()
-                        except Exception as old_error:
-                            logger.error(f"所有API调用方法均失败: {old_error}")
-                            
-                            # 使用HTTP直接请求
-                            api_url = f"{OPENAI_API_BASE.rstrip('/')}/chat/completions"
-                            headers = {
-                                "Content-Type": "application/json",
-                                "Authorization": f"Bearer {OPENAI_API_KEY}"
-                            }
-                            payload = {
-                                "model": OPENAI_MODEL,
-                                "messages": [{"role": "user", "content": prompt}],
-                                "temperature": 0.3,
-                                "max_tokens": 1000
-                            }
-                            response = requests.post(api_url, headers=headers, json=payload, timeout=30)
-                            if response.status_code == 200:
-                                result_text = response.json()["choices"][0]["message"]["content"].strip()
-                            else:
-                                raise Exception(f"HTTP请求失败: {response.text}")
-                
-                except Exception as api_error:
-                    logger.error(f"API调用失败: {api_error}")
-                    return None
-                
-                if not result_text:
-                    logger.warning("OpenAI返回空结果")
-                    return None
-                    
-                logger.info(f"OpenAI返回结果: {result_text}")
-                
-                # 解析返回的JSON
-                try:
-                    result_json = json.loads(result_text)
-                    matched_indices = result_json.get("matched_indices", [])
-                    logger.info(f"解析到的匹配索引: {matched_indices}")
-                    
-                    # 根据索引获取原始数据
-                    filtered_data = []
-                    for idx in matched_indices:
-                        if 0 <= idx < len(sample_data):
-                            filtered_data.append(sample_data[idx])
-                    
-                    logger.info(f"筛选后的车次数量: {len(filtered_data)}")
-                    
-                    # 如果结果是排序的，确保保持排序
-                    if result_json.get("is_sorted", False):
-                        logger.info(f"结果已按{result_json.get('sort_criteria', '未知标准')}排序")
-                        return filtered_data
-                    
-                    return filtered_data
-                    
-                except json.JSONDecodeError:
-                    logger.error(f"JSON解析失败: {result_text}")
-                    
-                    # 如果JSON解析失败，尝试直接提取索引
-                    try:
-                        import re
-                        indices_match = re.search(r"matched_indices.*?(\[.*?\])", result_text, re.DOTALL)
-                        if indices_match:
-                            indices_str = indices_match.group(1)
-                            # 处理可能的格式问题
-                            indices_str = indices_str.replace("'", '"')
-                            matched_indices = json.loads(indices_str)
-                            
-                            # 根据索引获取原始数据
-                            filtered_data = []
-                            for idx in matched_indices:
-                                if 0 <= idx < len(sample_data):
-                                    filtered_data.append(sample_data[idx])
-                            
-                            logger.info(f"通过正则提取索引后，筛选出车次数量: {len(filtered_data)}")
-                            return filtered_data
-                    except Exception as regex_error:
-                        logger.error(f"正则提取失败: {regex_error}")
-                    
-                    return None
-                    
-            except Exception as e:
-                logger.error(f"调用OpenAI API失败: {e}")
-                logger.error(traceback.format_exc())
+            indices = self._map_filter_chunks(chunks, build_prompt, "matched_indices")
+            if indices is None:
                 return None
+            
+            filtered_data = base.select(indices)
+            logger.info(f"筛选后的车次数量: {len(filtered_data)}")
+            return order_filtered_results(filtered_data, question, train_order_keys(question))
                 
         except Exception as general_error:
             logger.error(f"AI筛选过程中发生错误: {general_error}")
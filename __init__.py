@@ -1 +1,8 @@
-from .TicketQuery import *
+from .ticket_engine import TicketEngine, QueryResult, TrainRecord, TransferRecord, SeatRecord
+
+try:
+    from .TicketQuery import *
+except ModuleNotFoundError as e:
+    # 没有dify-on-wechat时（作为库使用）只提供查询引擎
+    if (e.name or "").partition(".")[0] not in ("plugins", "bridge", "common"):
+        raise
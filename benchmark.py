@@ -0,0 +1,499 @@
+"""TicketQuery 性能基准脚本
+
+在 dify-on-wechat 项目根目录下运行：
+    python plugins/TicketQuery/benchmark.py import [--rounds 5]
+    python plugins/TicketQuery/benchmark.py parser
+    python plugins/TicketQuery/benchmark.py prompt [--trains 120]
+    python plugins/TicketQuery/benchmark.py render [--trains 2000] [--page-size 10]
+    python plugins/TicketQuery/benchmark.py transfer [--trains 300]
+    python plugins/TicketQuery/benchmark.py limiter [--rate 20] [--requests 60]
+    python plugins/TicketQuery/benchmark.py cache [--processes 4] [--routes 200]
+    python plugins/TicketQuery/benchmark.py http [--clients 8] [--requests 400]
+    python plugins/TicketQuery/benchmark.py memory [--routes 200] [--dates 7] [--trains 60]
+"""
+import argparse
+import http.client
+import importlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+PLUGIN_PACKAGE = "plugins.TicketQuery"
+
+# 在全新解释器中测量插件导入与初始化耗时，避免模块缓存影响结果
+IMPORT_PROBE = f"""
+import sys, time
+import plugins
+t0 = time.perf_counter()
+import {PLUGIN_PACKAGE} as pkg
+t1 = time.perf_counter()
+pkg.TicketQuery()
+t2 = time.perf_counter()
+heavy = [name for name in ("openai", "requests") if name in sys.modules]
+print(f"{{(t1 - t0) * 1000:.2f}} {{(t2 - t1) * 1000:.2f}} {{','.join(heavy) or '-'}}")
+"""
+
+
+# 模拟一个机器人进程：按随机顺序查询同一批线路，未命中时"请求API"并写入缓存
+CACHE_PROBE = f"""
+import importlib, random, sys, time
+import plugins
+module = importlib.import_module("{PLUGIN_PACKAGE}.ticket_engine")
+backend, path, routes, seed = sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4])
+if backend == "sqlite":
+    cache = module.SQLiteCache("车票查询", path, max_size=routes * 2, default_ttl=600)
+else:
+    cache = module.TTLCache("车票查询", max_size=routes * 2, default_ttl=600)
+keys = [("高铁", f"城市{{i}}", "上海", "2024-06-05") for i in range(routes)]
+random.Random(seed).shuffle(keys)
+payload = [{{"trainumber": f"G{{i}}", "ticket_info": [{{"seatname": "二等座", "seatprice": 553, "seatinventory": 10}}]}}
+           for i in range(30)]
+fetches = 0
+start = time.perf_counter()
+for key in keys:
+    if cache.get(key) is None:
+        fetches += 1
+        time.sleep(0.002)
+        cache.set(key, payload)
+stats = cache.stats()
+print(fetches, stats.get("remote_hits", 0), f"{{(time.perf_counter() - start) * 1000:.1f}}")
+"""
+
+
+# 自然语言查询语料，用于统计本地规则解析的高置信度命中率
+QUERY_CORPUS = [
+    "明天上午北京到上海的高铁",
+    "今天下午3点的高铁从北京到上海",
+    "查明天上午从北京到上海的高铁",
+    "高铁 北京 上海",
+    "高铁 北京 上海 2024-06-05",
+    "高铁 北京 上海 2024-06-05 09:00",
+    "动车 广州 深圳 明天",
+    "后天下午3点从成都去重庆的动车",
+    "下周三上午10点武汉到长沙的高铁",
+    "周五晚上杭州到南京的动车",
+    "下周一早上8点半从西安到郑州",
+    "6月8日南京去杭州的动车十点半左右",
+    "帮我看看后天从天津去济南的火车票",
+    "明天从沈阳到哈尔滨的普快",
+    "今晚8点北京到天津的高铁",
+    "深圳到广州 14:00之后的车",
+    "大后天中午长沙到武汉有什么车",
+    "这周六上午上海到苏州",
+    "2024年6月10日 重庆 成都 高铁",
+    "星期天下午从福州到厦门的动车",
+    "查一下青岛去济南的高铁",
+    "明天去上海的高铁",
+    "北京到上海周末的票",
+    "下个月初从北京去广州",
+    "国庆节成都到西安的火车",
+    "有没有明天早上北京到上海最便宜的",
+    "北京到上海的G1次列车还有票吗",
+    "月底回家的票",
+    "从合肥出发到南昌，明天下午",
+    "昆明到贵阳 动车 后天 09:30",
+]
+
+
+def _project_root():
+    """插件目录位于 <项目根目录>/plugins/TicketQuery"""
+    return os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _load_engine_module():
+    """导入插件的查询引擎模块（插件目录需位于<项目根目录>/plugins下）"""
+    root = _project_root()
+    if root not in sys.path:
+        sys.path.insert(0, root)
+    return importlib.import_module(f"{PLUGIN_PACKAGE}.ticket_engine")
+
+
+def bench_import(rounds):
+    """测量插件导入和实例化的启动开销"""
+    root = _project_root()
+    import_times = []
+    init_times = []
+    heavy_modules = set()
+    for _ in range(rounds):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_PROBE],
+            cwd=root, capture_output=True, text=True, check=True
+        ).stdout.strip().splitlines()[-1]
+        import_ms, init_ms, heavy = output.split()
+        import_times.append(float(import_ms))
+        init_times.append(float(init_ms))
+        if heavy != "-":
+            heavy_modules.update(heavy.split(","))
+
+    import_times.sort()
+    init_times.sort()
+    print(f"导入耗时(ms): 中位数 {import_times[len(import_times) // 2]:.2f}, 最小 {import_times[0]:.2f}")
+    print(f"初始化耗时(ms): 中位数 {init_times[len(init_times) // 2]:.2f}, 最小 {init_times[0]:.2f}")
+    print(f"启动阶段加载的重量级依赖: {', '.join(sorted(heavy_modules)) or '无'}")
+
+
+def bench_parser():
+    """统计本地规则解析在查询语料上的高置信度命中率（命中即跳过LLM）"""
+    module = _load_engine_module()
+    parser = module.RuleQueryParser(module.load_station_dictionary())
+    threshold = module.DEFAULT_TUNABLES["rule_parse_threshold"]
+
+    confident = 0
+    start = time.perf_counter()
+    for query in QUERY_CORPUS:
+        parsed = parser.parse(query)
+        hit = bool(parsed) and parsed["confidence"] >= threshold
+        confident += hit
+        summary = "未识别" if not parsed else (
+            f"{parsed['ticket_type']} {parsed['from_loc']}->{parsed['to_loc']} {parsed['date']} "
+            f"{parsed['time'] or ''} 置信度{parsed['confidence']}")
+        print(f"{'✓' if hit else '·'} {query} => {summary}")
+    elapsed = time.perf_counter() - start
+
+    print(f"高置信度命中率: {confident}/{len(QUERY_CORPUS)} ({confident / len(QUERY_CORPUS):.1%}), 阈值 {threshold}")
+    print(f"平均解析耗时: {elapsed / len(QUERY_CORPUS) * 1000:.3f}ms")
+
+
+def _synthetic_trains(count, seed=0):
+    """生成与车票API返回结构一致的模拟车次"""
+    rng = random.Random(seed)
+    seats = [("商务座", 1700), ("一等座", 930), ("二等座", 550), ("无座", 550)]
+    trains = []
+    for i in range(count):
+        depart = 6 * 60 + i * 900 // max(count, 1)
+        runtime = rng.randint(270, 390)
+        arrive = depart + runtime
+        trains.append({
+            "trainumber": f"G{i * 2 + 1}",
+            "traintype": "高铁",
+            "departstation": rng.choice(["北京南", "北京西"]),
+            "arrivestation": rng.choice(["上海虹桥", "上海"]),
+            "departtime": f"{depart // 60:02d}:{depart % 60:02d}",
+            "arrivetime": f"{arrive // 60 % 24:02d}:{arrive % 60:02d}",
+            "runtime": f"{runtime // 60}小时{runtime % 60}分钟",
+            "ticket_info": [
+                {"seatname": name, "seatprice": price + rng.randint(-30, 30),
+                 "seatinventory": rng.choice([0, 3, 21, 99]), "bookable": "有车票"}
+                for name, price in seats[:rng.randint(2, 4)]
+            ],
+        })
+    return trains
+
+
+def _legacy_json_prompt(trains):
+    """旧版逐条JSON的样本编码（前三种座位），用于对比"""
+    return json.dumps([{
+        "trainumber": train["trainumber"], "traintype": train["traintype"],
+        "departtime": train["departtime"], "arrivetime": train["arrivetime"], "runtime": train["runtime"],
+        "departstation": train["departstation"], "arrivestation": train["arrivestation"],
+        "ticket_info": [{"seatname": seat["seatname"], "seatprice": seat["seatprice"],
+                         "seatinventory": seat["seatinventory"]} for seat in train["ticket_info"][:3]],
+        "index": index,
+    } for index, train in enumerate(trains)], ensure_ascii=False)
+
+
+def bench_prompt(count):
+    """对比AI筛选提示中旧版JSON与紧凑表格的token数，以及token预算内能放入的车次数"""
+    module = _load_engine_module()
+    trains = _synthetic_trains(count)
+    budget = module.DEFAULT_TUNABLES["filter_prompt_token_budget"]
+    print(f"token计数方式: {'tiktoken' if module._token_encoder() else '估算'}")
+
+    legacy_rows = min(len(trains), 30)
+    legacy_tokens = module.estimate_tokens(_legacy_json_prompt(trains[:legacy_rows]))
+    start = time.perf_counter()
+    header, lines = module.encode_train_table(list(enumerate(trains[:legacy_rows])))
+    table_tokens = module.pack_table(header, lines, float("inf"))[0][2]
+    encode_ms = (time.perf_counter() - start) * 1000
+    print(f"{legacy_rows}条车次: JSON约{legacy_tokens} tokens, 表格约{table_tokens} tokens, "
+          f"压缩 {legacy_tokens / max(table_tokens, 1):.1f}x, 编码耗时 {encode_ms:.2f}ms")
+
+    header, lines = module.encode_train_table(list(enumerate(trains)))
+    chunks = module.pack_table(header, lines, budget)
+    print(f"{len(trains)}条车次, 预算{budget} tokens: 首个提示可容纳{len(chunks[0][0])}条（旧版固定30条），"
+          f"全部数据共需{len(chunks)}个提示")
+
+
+def bench_render(count, page_size):
+    """对比逐页重新格式化与预渲染+页面缓存在大结果集上来回翻页的耗时"""
+    module = _load_engine_module()
+    trains = _synthetic_trains(count)
+    pages = (len(trains) + page_size - 1) // page_size
+    # 先向后翻到最后一页，再向前翻回第一页
+    visits = list(range(1, pages + 1)) + list(range(pages, 0, -1))
+
+    start = time.perf_counter()
+    for page in visits:
+        offset = (page - 1) * page_size
+        "\n".join(f"{index}. {module.format_train_block(train)}"
+                  for index, train in enumerate(trains[offset:offset + page_size], offset + 1))
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    renderer = module.ResultRenderer()
+    renderer.load(trains)
+    load = time.perf_counter() - start
+    for page in visits:
+        renderer.page(page, page_size)
+    cached = time.perf_counter() - start
+
+    print(f"{len(trains)}条车次, {pages}页, 翻页{len(visits)}次")
+    print(f"逐页格式化: 总计 {legacy * 1000:.2f}ms, 每页 {legacy / len(visits) * 1000:.3f}ms")
+    print(f"预渲染: 保存结果 {load * 1000:.2f}ms, 含翻页总计 {cached * 1000:.2f}ms, "
+          f"每页 {(cached - load) / len(visits) * 1000:.3f}ms, 页面缓存命中 {renderer.page_hits}/{len(visits)}")
+
+
+def _synthetic_legs(count, seed):
+    """生成全天随机发车的单段车次，模拟大型枢纽的中转数据"""
+    rng = random.Random(seed)
+    trains = _synthetic_trains(count, seed)
+    for train in trains:
+        depart = rng.randint(0, 24 * 60 - 1)
+        runtime = rng.randint(60, 360)
+        arrive = depart + runtime
+        train["departtime"] = f"{depart // 60:02d}:{depart % 60:02d}"
+        train["arrivetime"] = f"{arrive // 60 % 24:02d}:{arrive % 60:02d}"
+        train["runtime"] = f"{runtime // 60}小时{runtime % 60}分钟"
+    return trains
+
+
+def bench_transfer(count):
+    """对比逐对生成全部中转方案再排序与帕累托前沿排序的耗时和剪枝率"""
+    module = _load_engine_module()
+    defaults = module.DEFAULT_TUNABLES
+    min_transfer, max_transfer = defaults["min_transfer_time"], defaults["max_transfer_time"]
+    first_leg, second_leg = _synthetic_legs(count, 1), _synthetic_legs(count, 2)
+
+    start = time.perf_counter()
+    routes = []
+    for train1 in first_leg:
+        arrival = module._clock_minutes(train1["arrivetime"])
+        for train2 in second_leg:
+            transfer_minutes = (module._clock_minutes(train2["departtime"]) - arrival) % (24 * 60)
+            if min_transfer <= transfer_minutes <= max_transfer:
+                routes.append({
+                    "first_leg": train1, "second_leg": train2, "transfer_time": transfer_minutes,
+                    "total_price": module._reference_price(train1) + module._reference_price(train2),
+                    "total_runtime": module._leg_runtime(train1) + transfer_minutes + module._leg_runtime(train2),
+                })
+    routes.sort(key=lambda route: route["total_runtime"])
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ranker = module.TransferRanker(min_transfer, max_transfer, weights=(
+        defaults["transfer_weight_runtime"], defaults["transfer_weight_price"], defaults["transfer_weight_slack"]),
+        limit=defaults["transfer_result_limit"])
+    ranker.add_station("枢纽", first_leg, second_leg)
+    top = ranker.top()
+    pareto = time.perf_counter() - start
+
+    print(f"每段{count}班车次, 可行组合{ranker.candidates}个")
+    print(f"全部生成后排序: {legacy * 1000:.2f}ms, 方案对象{len(routes)}个")
+    print(f"帕累托前沿: {pareto * 1000:.2f}ms, 前沿{len(ranker.frontier)}个, "
+          f"剪枝率{ranker.pruning_ratio():.1%}, 返回{len(top)}个")
+    fastest = routes[0]["total_runtime"] if routes else None
+    print(f"最短总耗时: {fastest}分钟（旧排序第一） / 前沿中{min((p[0] for p, _ in ranker.frontier), default=None)}分钟")
+
+
+def bench_limiter(rate, count):
+    """模拟高峰期混合负载：先涌入大量后台和扇出请求，再陆续到达交互查询，统计各优先级的排队时间"""
+    module = _load_engine_module()
+    limiter = module.RateLimiter(rate, burst=max(1, int(rate // 2)))
+    threads = []
+
+    def request(priority):
+        limiter.acquire(priority)
+
+    start = time.perf_counter()
+    for i in range(count):
+        priority = module.PRIORITY_PREFETCH if i % 2 else module.PRIORITY_FANOUT
+        threads.append(threading.Thread(target=request, args=(priority,)))
+        threads[-1].start()
+    for _ in range(count // 6):
+        time.sleep(1 / rate)
+        threads.append(threading.Thread(target=request, args=(module.PRIORITY_INTERACTIVE,)))
+        threads[-1].start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    print(f"速率 {rate}次/秒, 共{len(threads)}个请求, 实际吞吐 {len(threads) / elapsed:.1f}次/秒")
+    for name, stats in limiter.stats().items():
+        print(f"{name}: {stats['count']}个, 平均排队 {stats['avg_wait'] * 1000:.0f}ms, 最长 {stats['max_wait'] * 1000:.0f}ms")
+
+
+def bench_cache(processes, routes):
+    """多个进程同时查询同一批线路，对比进程内缓存与共享SQLite缓存的API请求次数和跨进程命中率"""
+    root = _project_root()
+    with tempfile.TemporaryDirectory() as directory:
+        for backend in ("memory", "sqlite"):
+            path = os.path.join(directory, "cache.db")
+            workers = [
+                subprocess.Popen([sys.executable, "-c", CACHE_PROBE, backend, path, str(routes), str(seed)],
+                                 cwd=root, stdout=subprocess.PIPE, text=True)
+                for seed in range(processes)
+            ]
+            results = [worker.communicate()[0].strip().splitlines()[-1].split() for worker in workers]
+            fetches = sum(int(fetched) for fetched, _, _ in results)
+            remote_hits = sum(int(remote) for _, remote, _ in results)
+            lookups = processes * routes
+            slowest = max(float(elapsed) for _, _, elapsed in results)
+            print(f"{backend}: {processes}个进程 x {routes}条线路, API请求 {fetches}次"
+                  f"（理想值{routes}）, 跨进程命中率 {remote_hits / lookups:.1%}, 最慢进程 {slowest:.0f}ms")
+
+
+def bench_http(clients, count):
+    """启动独立运行的HTTP服务（随机端口），多个客户端并发发送聊天消息，统计吞吐和延迟分布（不请求车票API）"""
+    plugin_dir = os.path.dirname(os.path.abspath(__file__))
+    if plugin_dir not in sys.path:
+        sys.path.insert(0, plugin_dir)
+    standalone = importlib.import_module("standalone")
+    service = standalone.StandaloneService()
+    server = standalone.make_server(service)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    latencies = []
+    lock = threading.Lock()
+
+    def client(index):
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        samples = []
+        for i in range(index, count, clients):
+            body = json.dumps({"session": f"bench-{index}", "text": "车票查询"}).encode("utf-8")
+            begin = time.perf_counter()
+            connection.request("POST", "/chat", body, {"Content-Type": "application/json"})
+            connection.getresponse().read()
+            samples.append(time.perf_counter() - begin)
+        connection.close()
+        with lock:
+            latencies.extend(samples)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    server.server_close()
+
+    latencies.sort()
+    percentile = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000
+    print(f"{clients}个客户端, 共{len(latencies)}个请求, 吞吐 {len(latencies) / elapsed:.0f}次/秒")
+    print(f"延迟: p50 {percentile(0.5):.2f}ms, p95 {percentile(0.95):.2f}ms, p99 {percentile(0.99):.2f}ms")
+
+
+def _route_payloads(routes, dates, count):
+    """模拟缓存中的车票结果：每条线路查询多个日期，同一线路各日期的时刻和票价相同，余票随机变化；
+    每个结果都单独序列化，解析后与真实的API响应一样不共用任何对象"""
+    payloads = []
+    for route in range(routes):
+        base = _synthetic_trains(count, seed=route)
+        rng = random.Random(route)
+        for _ in range(dates):
+            for train in base:
+                for seat in train["ticket_info"]:
+                    if rng.random() < 0.3:
+                        seat["seatinventory"] = rng.choice([0, 3, 21, 99])
+            payloads.append(json.dumps(base, ensure_ascii=False).encode("utf-8"))
+    return payloads
+
+
+def bench_memory(routes, dates, count):
+    """用tracemalloc统计缓存车票结果占用的内存：直接保存解析结果与写入前去重（TrainInterner）对比"""
+    module = _load_engine_module()
+    payloads = _route_payloads(routes, dates, count)
+    results = {}
+    for label in ("原始", "去重"):
+        def ingest(interner):
+            if label == "原始":
+                return [json.loads(payload) for payload in payloads]
+            return [interner.trains(json.loads(payload)) for payload in payloads]
+        
+        # 先在不跟踪内存分配时计时（tracemalloc会显著拖慢分配），再跟踪统计内存
+        start = time.perf_counter()
+        ingest(module.TrainInterner())
+        elapsed = time.perf_counter() - start
+        interner = module.TrainInterner()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        cached = ingest(interner)
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        results[label] = used
+        print(f"{label}: {len(cached)}条缓存结果, 共{used / 1024 / 1024:.1f}MB, 每条线路 {used / len(cached) / 1024:.1f}KB, "
+              f"解析耗时 {elapsed * 1000:.0f}ms")
+        if label == "去重":
+            print(f"去重统计: {interner.stats}")
+        del cached
+    print(f"内存减少 {1 - results['去重'] / results['原始']:.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TicketQuery 性能基准")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="插件导入/初始化耗时")
+    import_parser.add_argument("--rounds", type=int, default=5)
+
+    subparsers.add_parser("parser", help="本地规则解析命中率")
+
+    prompt_parser = subparsers.add_parser("prompt", help="AI筛选提示的token数对比")
+    prompt_parser.add_argument("--trains", type=int, default=120)
+
+    render_parser = subparsers.add_parser("render", help="结果渲染与翻页耗时")
+    render_parser.add_argument("--trains", type=int, default=2000)
+    render_parser.add_argument("--page-size", type=int, default=10)
+
+    transfer_parser = subparsers.add_parser("transfer", help="中转方案帕累托排序的耗时与剪枝率")
+    transfer_parser.add_argument("--trains", type=int, default=300)
+
+    limiter_parser = subparsers.add_parser("limiter", help="限流器各优先级的排队时间")
+    limiter_parser.add_argument("--rate", type=float, default=20)
+    limiter_parser.add_argument("--requests", type=int, default=60)
+
+    cache_parser = subparsers.add_parser("cache", help="多进程部署下共享缓存的命中率")
+    cache_parser.add_argument("--processes", type=int, default=4)
+    cache_parser.add_argument("--routes", type=int, default=200)
+
+    http_parser = subparsers.add_parser("http", help="独立运行HTTP服务的并发吞吐与延迟")
+    http_parser.add_argument("--clients", type=int, default=8)
+    http_parser.add_argument("--requests", type=int, default=400)
+
+    memory_parser = subparsers.add_parser("memory", help="缓存车票结果的内存占用（去重前后）")
+    memory_parser.add_argument("--routes", type=int, default=200)
+    memory_parser.add_argument("--dates", type=int, default=7)
+    memory_parser.add_argument("--trains", type=int, default=60)
+
+    args = parser.parse_args()
+    start = time.perf_counter()
+    if args.command == "import":
+        bench_import(args.rounds)
+    elif args.command == "parser":
+        bench_parser()
+    elif args.command == "prompt":
+        bench_prompt(args.trains)
+    elif args.command == "render":
+        bench_render(args.trains, args.page_size)
+    elif args.command == "transfer":
+        bench_transfer(args.trains)
+    elif args.command == "limiter":
+        bench_limiter(args.rate, args.requests)
+    elif args.command == "cache":
+        bench_cache(args.processes, args.routes)
+    elif args.command == "http":
+        bench_http(args.clients, args.requests)
+    elif args.command == "memory":
+        bench_memory(args.routes, args.dates, args.trains)
+    print(f"总耗时: {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""TicketQuery 独立运行入口
+
+不依赖 dify-on-wechat，在插件目录下直接运行（框架的 plugins、bridge、common.log 不可用时使用内置的替代模块）：
+    python standalone.py query 高铁 北京 上海 2024-06-05 [09:00]
+    python standalone.py transfer 高铁 成都 上海 2024-06-05 [--via 武汉]
+    python standalone.py chat "高铁 北京 上海 2024-06-05" "+最便宜的二等座"
+    python standalone.py serve [--host 127.0.0.1] [--port 8080]
+
+HTTP接口（serve，多线程处理请求）：
+    GET  /query?type=高铁&from=北京&to=上海&date=2024-06-05&time=09:00   直达查询，返回结构化记录
+    GET  /transfer?type=高铁&from=成都&to=上海&date=2024-06-05&via=武汉   中转查询
+    POST /chat  {"session": "u1", "text": "+最便宜的二等座"}              与聊天中相同的消息处理（含筛选、翻页）
+    GET  /stats                                                          缓存、限流和会话统计
+"""
+import argparse
+import importlib
+import importlib.util
+import json
+import logging
+import os
+import sys
+import types
+from enum import Enum
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _plugins_shim():
+    module = types.ModuleType("plugins")
+
+    class Event(Enum):
+        ON_RECEIVE_MESSAGE = 1
+        ON_HANDLE_CONTEXT = 2
+        ON_DECORATE_REPLY = 3
+        ON_SEND_REPLY = 4
+
+    class EventAction(Enum):
+        CONTINUE = 1
+        BREAK = 2
+        BREAK_PASS = 3
+
+    class EventContext:
+        def __init__(self, event, econtext=None):
+            self.event = event
+            self.econtext = econtext if econtext is not None else {}
+            self.action = EventAction.CONTINUE
+
+        def __getitem__(self, key):
+            return self.econtext[key]
+
+        def __setitem__(self, key, value):
+            self.econtext[key] = value
+
+        def __contains__(self, key):
+            return key in self.econtext
+
+        def get(self, key, default=None):
+            return self.econtext.get(key, default)
+
+    class Plugin:
+        def __init__(self):
+            self.handlers = {}
+
+    def register(**kwargs):
+        return lambda cls: cls
+
+    module.Event, module.EventAction, module.EventContext = Event, EventAction, EventContext
+    module.Plugin, module.register = Plugin, register
+    module.__all__ = ["Event", "EventAction", "EventContext", "Plugin", "register"]
+    return module
+
+
+def _context_shim():
+    module = types.ModuleType("bridge.context")
+
+    class ContextType(Enum):
+        TEXT = 1
+        VOICE = 2
+        IMAGE = 3
+
+    class Context:
+        def __init__(self, type=None, content=None, kwargs=None):
+            self.type = type
+            self.content = content
+            self.kwargs = kwargs or {}
+
+        def __getitem__(self, key):
+            return self.kwargs[key]
+
+        def __setitem__(self, key, value):
+            self.kwargs[key] = value
+
+        def __contains__(self, key):
+            return key in self.kwargs
+
+        def get(self, key, default=None):
+            return self.kwargs.get(key, default)
+
+    module.ContextType, module.Context = ContextType, Context
+    return module
+
+
+def _reply_shim():
+    module = types.ModuleType("bridge.reply")
+
+    class ReplyType(Enum):
+        TEXT = 1
+        VOICE = 2
+        IMAGE = 3
+        INFO = 9
+        ERROR = 10
+
+    class Reply:
+        def __init__(self, type=None, content=None):
+            self.type = type
+            self.content = content
+
+    module.ReplyType, module.Reply = ReplyType, Reply
+    return module
+
+
+def _log_shim():
+    module = types.ModuleType("common.log")
+    module.logger = logging.getLogger("TicketQuery")
+    return module
+
+
+FRAMEWORK_SHIMS = {
+    "plugins": _plugins_shim,
+    "bridge.context": _context_shim,
+    "bridge.reply": _reply_shim,
+    "common.log": _log_shim,
+}
+
+
+def install_framework_shims():
+    """框架模块无法导入时，注册最小替代实现；返回使用了替代实现的模块名"""
+    installed = []
+    for name, factory in FRAMEWORK_SHIMS.items():
+        try:
+            importlib.import_module(name)
+            continue
+        except ImportError:
+            pass
+        package = name.partition(".")[0]
+        if package != name and package not in sys.modules:
+            sys.modules[package] = types.ModuleType(package)
+        module = factory()
+        sys.modules[name] = module
+        if package != name:
+            setattr(sys.modules[package], name.partition(".")[2], module)
+        installed.append(name)
+    return installed
+
+
+def load_package(name="TicketQuery"):
+    """把插件目录作为顶层包导入（不需要所在的plugins包），返回包模块
+
+    查询引擎在包内的ticket_engine模块中，不依赖框架；插件类需要框架模块，导入前先注册替代实现。
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    install_framework_shims()
+    spec = importlib.util.spec_from_file_location(name, os.path.join(PLUGIN_DIR, "__init__.py"),
+                                                  submodule_search_locations=[PLUGIN_DIR])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[name] = package
+    try:
+        spec.loader.exec_module(package)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return package
+
+
+def to_json(value):
+    """把QueryResult等命名元组递归转换为可JSON序列化的结构"""
+    if hasattr(value, "_asdict"):
+        return {key: to_json(item) for key, item in value._asdict().items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json(item) for item in value]
+    return value
+
+
+class StandaloneService:
+    """独立运行时的查询服务：结构化查询走TicketEngine，聊天消息走插件的完整处理流程，两者共用同一个引擎"""
+
+    def __init__(self, config_path=None):
+        package = load_package()
+        self.plugin = package.TicketQuery(config_path)
+        self.engine = self.plugin.engine
+
+    def chat(self, session, text):
+        """按聊天消息处理一条文本，返回(回复类型, 回复内容)；不处理的消息返回(None, None)"""
+        plugins = sys.modules["plugins"]
+        context_module = sys.modules["bridge.context"]
+        context = context_module.Context(context_module.ContextType.TEXT, text,
+                                         {"session_id": session, "receiver": session, "isgroup": False})
+        e_context = plugins.EventContext(plugins.Event.ON_HANDLE_CONTEXT, {"context": context, "channel": None})
+        self.plugin.on_handle_context(e_context)
+        reply = e_context.econtext.get("reply")
+        if reply is None:
+            return None, None
+        return reply.type.name, reply.content
+
+    def stats(self):
+        stats = self.engine.stats()
+        stats.update({
+            "parse_cache": self.plugin.parse_cache.stats(),
+            "plan_cache": self.plugin.plan_cache.stats(),
+            "reply_queue": self.plugin.reply_queue_stats(),
+            "sessions": len(self.plugin.sessions),
+        })
+        return stats
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # 响应头和响应体分两次写出，关闭Nagle算法避免keep-alive连接上每个请求多等一次延迟ACK（约40ms）
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            logging.getLogger("TicketQuery").debug("%s - %s", self.address_string(), format % args)
+
+        def _send(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            try:
+                if url.path == "/stats":
+                    return self._send(200, service.stats())
+                if url.path not in ("/query", "/transfer"):
+                    return self._send(404, {"error": "未知接口"})
+                missing = [key for key in ("type", "from", "to") if not params.get(key)]
+                if missing:
+                    return self._send(400, {"error": f"缺少参数: {', '.join(missing)}"})
+                timeout = float(params["timeout"]) if params.get("timeout") else None
+                if url.path == "/query":
+                    result = service.engine.query(params["type"], params["from"], params["to"], params.get("date"),
+                                                  params.get("time", ""), timeout=timeout)
+                else:
+                    result = service.engine.search_transfers(params["type"], params["from"], params["to"],
+                                                             params.get("date"), params.get("time"),
+                                                             via=params.get("via"), timeout=timeout)
+                self._send(200, to_json(result))
+            except ValueError as e:
+                self._send(400, {"error": str(e)})
+            except Exception as e:
+                logging.getLogger("TicketQuery").error(f"处理请求失败: {self.path}, {e}")
+                self._send(500, {"error": str(e)})
+
+        def do_POST(self):
+            if urlparse(self.path).path != "/chat":
+                return self._send(404, {"error": "未知接口"})
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+                request = json.loads(self.rfile.read(length) or b"{}")
+                text = str(request["text"]).strip()
+            except (ValueError, KeyError):
+                return self._send(400, {"error": "请求格式: {\"session\": \"会话ID\", \"text\": \"消息内容\"}"})
+            reply_type, content = service.chat(str(request.get("session") or "standalone"), text)
+            self._send(200, {"type": reply_type, "reply": content})
+
+    return Handler
+
+
+def make_server(service, host="127.0.0.1", port=0):
+    """创建多线程HTTP服务（每个连接一个线程），port为0时使用随机端口"""
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    server.daemon_threads = True
+    return server
+
+
+def serve(service, host, port):
+    server = make_server(service, host, port)
+    print(f"TicketQuery 服务已启动: http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TicketQuery 独立运行（命令行/本地HTTP服务）")
+    parser.add_argument("--config", help="配置文件路径，默认使用插件目录下的config.json")
+    parser.add_argument("--log-level", default="WARNING", help="日志级别，默认WARNING")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    query_parser = subparsers.add_parser("query", help="直达查询")
+    transfer_parser = subparsers.add_parser("transfer", help="中转查询")
+    for sub in (query_parser, transfer_parser):
+        sub.add_argument("ticket_type")
+        sub.add_argument("from_loc")
+        sub.add_argument("to_loc")
+        sub.add_argument("date", nargs="?")
+        sub.add_argument("time", nargs="?", default="")
+        sub.add_argument("--timeout", type=float, help="总耗时预算（秒），默认使用query_budget配置")
+    transfer_parser.add_argument("--via", help="指定中转城市")
+
+    chat_parser = subparsers.add_parser("chat", help="按聊天消息依次处理（同一会话，可用于翻页和筛选）")
+    chat_parser.add_argument("messages", nargs="+")
+    chat_parser.add_argument("--session", default="standalone")
+
+    serve_parser = subparsers.add_parser("serve", help="启动本地HTTP服务")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8080)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="[%(levelname)s][%(asctime)s] %(message)s")
+    service = StandaloneService(args.config)
+
+    if args.command == "query":
+        result = service.engine.query(args.ticket_type, args.from_loc, args.to_loc, args.date, args.time,
+                                      timeout=args.timeout)
+        print(json.dumps(to_json(result), ensure_ascii=False, indent=1))
+    elif args.command == "transfer":
+        result = service.engine.search_transfers(args.ticket_type, args.from_loc, args.to_loc, args.date,
+                                                 args.time or None, via=args.via, timeout=args.timeout)
+        print(json.dumps(to_json(result), ensure_ascii=False, indent=1))
+    elif args.command == "chat":
+        for message in args.messages:
+            reply_type, content = service.chat(args.session, message)
+            print(f">>> {message}\n{content if content is not None else '（插件未处理该消息）'}\n")
+    elif args.command == "serve":
+        serve(service, args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
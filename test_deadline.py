@@ -0,0 +1,46 @@
+import types
+
+import pytest
+
+from . import ticket_engine
+from .ticket_engine import FAILED_LOOKUP, ConfigWatcher, Deadline, DeadlineExceeded, TicketEngine
+
+KEY = ("高铁", "北京", "上海", "2024-06-05")
+
+
+def expired_deadline():
+    deadline = Deadline(8)
+    deadline.expires_at = deadline.start  # 模拟预算已用完
+    return deadline
+
+
+def test_unlimited_deadline():
+    for deadline in (Deadline(), Deadline(0)):
+        assert deadline.remaining() == float("inf") and not deadline.expired()
+        assert deadline.timeout(15) == 15
+        deadline.check("车票API")
+
+
+def test_calls_get_the_smaller_of_their_timeout_and_the_remaining_budget():
+    deadline = Deadline(8)
+    assert 7 < deadline.timeout(30) <= 8
+    assert deadline.timeout(3) == 3
+
+
+def test_expired_deadline_skips_work():
+    deadline = expired_deadline()
+    assert deadline.expired() and deadline.timeout(15) == 0
+    with pytest.raises(DeadlineExceeded, match="跳过LLM调用"):
+        deadline.check("LLM调用")
+    assert issubclass(DeadlineExceeded, TimeoutError)
+
+
+def test_no_request_and_no_negative_cache_once_the_budget_is_spent(tmp_path, monkeypatch):
+    calls = []
+    requests = types.SimpleNamespace(get=lambda *args, **kwargs: calls.append(args))
+    monkeypatch.setattr(ticket_engine, "lazy_requests", lambda: requests)
+    engine = TicketEngine(ConfigWatcher(str(tmp_path / "config.json")))
+    assert engine.request_tickets(KEY, ticket_engine.PRIORITY_INTERACTIVE, expired_deadline()) is None
+    assert engine.fetch_tickets(*KEY, deadline=expired_deadline()) is None
+    assert calls == []
+    assert engine.ticket_cache.get(KEY) is not FAILED_LOOKUP and len(engine.ticket_cache) == 0
@@ -0,0 +1,75 @@
+import random
+
+import pytest
+
+from .ticket_engine import DEPARTURE_PERIODS, DepartureIndex, _clock_minutes, parse_departure_window
+
+TRAIN_TYPES = ["高铁", "动车", "普通"]
+
+
+def random_trains(seed, count=300):
+    rnd = random.Random(seed)
+    trains = []
+    for i in range(count):
+        if rnd.random() < 0.05:
+            departtime = rnd.choice(["", None, "--:--", "25:10", "待定"])
+        else:
+            departtime = f"{rnd.randrange(24):02d}:{rnd.choice([0, 5, 15, 30, 45, 59]):02d}"
+        trains.append({"trainumber": f"G{i}", "traintype": rnd.choice(TRAIN_TYPES), "departtime": departtime})
+    return trains
+
+
+def linear_scan(trains, train_type, window):
+    """逐条比较的参考实现：发车时间无法解析的车次总是保留"""
+    start, end = window
+    result = []
+    for train in trains:
+        if train["traintype"] != train_type:
+            continue
+        minutes = _clock_minutes(train["departtime"])
+        if minutes is None or not 0 <= minutes < 24 * 60:
+            result.append(train)
+        elif (start is None or minutes >= start) and (end is None or minutes <= end):
+            result.append(train)
+    return result
+
+
+QUERY_TIMES = list(DEPARTURE_PERIODS) + [
+    "00:00", "00:10", "06:30", "10:30", "10:30左右", "12:00", "23:45", "23:59",
+    "14:00之后", "14:00以后", "08:00之前", "8:00前", "00:00之后", "23:59之前",
+]
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("query_time", QUERY_TIMES)
+def test_window_matches_linear_scan(seed, query_time):
+    trains = random_trains(seed)
+    index = DepartureIndex(trains)
+    window = parse_departure_window(query_time)
+    assert window is not None
+    for train_type in TRAIN_TYPES:
+        found = index.window(train_type, *window)
+        expected = linear_scan(trains, train_type, window)
+        assert sorted(map(id, found)) == sorted(map(id, expected))
+        timed = [_clock_minutes(train["departtime"]) for train in found
+                 if train not in index.untimed.get(train_type, [])]
+        assert timed == sorted(timed)
+
+
+def test_parse_departure_window():
+    assert parse_departure_window("10:30") == (600, 660)
+    assert parse_departure_window("10:30左右") == (600, 660)
+    assert parse_departure_window("00:10") == (0, 40)
+    assert parse_departure_window("10:30", window_minutes=10) == (620, 640)
+    assert parse_departure_window("14:00之后") == (840, None)
+    assert parse_departure_window("8:00以前") == (None, 480)
+    assert parse_departure_window("下午") == DEPARTURE_PERIODS["下午"]
+    for query_time in ("", None, "25:00", "12:61", "明天", "下班后"):
+        assert parse_departure_window(query_time) is None
+
+
+def test_unknown_type_and_empty_index():
+    index = DepartureIndex([])
+    assert index.window("高铁", 0, 100) == []
+    trains = random_trains(1)
+    assert DepartureIndex(trains).window("磁悬浮") == []
@@ -0,0 +1,41 @@
+from .ticket_engine import ResultView, order_filtered_results, parse_matched_indices, train_order_keys, transfer_order_keys
+
+
+def train(number, depart, price, runtime="4小时"):
+    return {"trainumber": number, "departtime": depart, "runtime": runtime,
+            "ticket_info": [{"seatname": "二等座", "seatprice": price}, {"seatname": "一等座", "seatprice": price * 2}]}
+
+
+def numbers(view):
+    return [item["trainumber"] for item in view]
+
+
+def test_matched_indices_are_limited_to_the_chunk():
+    shown = {3, 4, 5}
+    assert parse_matched_indices('{"matched_indices": [5, 3, 9, "4", 3]}', "matched_indices", shown) == [5, 3, 4]
+    assert parse_matched_indices('```json\n{"matched_indices": [4]}\n```', "matched_indices", shown) == [4]
+    # JSON被截断时直接提取数组
+    assert parse_matched_indices('{"matched_indices": [3, 5], "reason": "便宜', "matched_indices", shown) == [3, 5]
+    assert parse_matched_indices("没有找到", "matched_indices", shown) is None
+    assert parse_matched_indices("", "matched_indices", shown) is None
+
+
+def test_merged_chunks_are_ordered_globally():
+    trains = [train("G1", "09:00", 600), train("G2", "07:00", 450), train("G3", "18:00", 450),
+              train("G4", "12:00", 500, runtime="3小时50分钟")]
+    view = ResultView(trains)
+    assert numbers(order_filtered_results(view, "最便宜的车", train_order_keys("最便宜的车"))) == ["G2", "G3"]
+    assert numbers(order_filtered_results(view, "最便宜的两班", train_order_keys(""))) == ["G2", "G3", "G4", "G1"]
+    assert numbers(order_filtered_results(view, "最晚的一班", train_order_keys(""))) == ["G3"]
+    assert numbers(order_filtered_results(view, "晚一点的车", train_order_keys(""))) == ["G3", "G4", "G1", "G2"]
+    assert numbers(order_filtered_results(view, "最快的", train_order_keys(""))) == ["G4"]
+    assert order_filtered_results(view, "有没有G字头", train_order_keys("")) is view
+
+
+def test_order_keys_use_the_named_seat():
+    keys = train_order_keys("一等座最便宜")
+    assert keys["price"](train("G1", "08:00", 300)) == 600
+    assert train_order_keys("")["price"](train("G1", "08:00", 300)) == 300
+    route = {"total_price": "880", "total_runtime": 400, "first_leg": {"departtime": "07:30"}}
+    keys = transfer_order_keys("")
+    assert (keys["price"](route), keys["runtime"](route), keys["depart"](route)) == (880.0, 400.0, 450)
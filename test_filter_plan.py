@@ -0,0 +1,70 @@
+import pytest
+
+from .ticket_engine import FilterPlan, ResultView, SQLiteCache, TTLCache, plan_decode, plan_encode
+
+
+def train(number, depart, prices, inventory=5, traintype="高铁"):
+    return {"trainumber": number, "traintype": traintype, "departtime": depart, "arrivetime": "23:00",
+            "runtime": "3小时", "ticket_info": [{"seatname": name, "seatprice": price, "seatinventory": inventory}
+                                             for name, price in prices.items()]}
+
+
+TRAINS = [
+    train("G1", "07:30", {"二等座": 553, "一等座": 933}),
+    train("D2", "09:10", {"二等座": 320}, traintype="动车"),
+    train("G3", "13:00", {"二等座": 480, "一等座": 800}, inventory="无"),
+    train("G5", "18:45", {"二等座": 600}),
+]
+
+
+def numbers(view):
+    return [item["trainumber"] for item in view]
+
+
+def test_filters_sort_and_limit():
+    plan = FilterPlan.compile("train", {
+        "filters": [{"field": "price", "seat": "二等座", "op": "<", "value": "590"},
+                    {"field": "departtime", "op": ">=", "value": "08:00"}],
+        "sort": [{"field": "price", "seat": "二等座", "order": "desc"}],
+        "limit": 1,
+    })
+    assert numbers(plan.execute(ResultView(TRAINS))) == ["G3"]
+
+
+def test_any_conditions_and_missing_fields():
+    plan = FilterPlan.compile("train", {"filters": [{"any": [
+        {"field": "traintype", "op": "==", "value": "动车"},
+        {"field": "price", "seat": "一等座", "op": "<=", "value": 900},
+    ]}], "sort": [{"field": "departtime", "order": "desc"}]})
+    # G5没有一等座，条件不成立而不是报错
+    assert numbers(plan.execute(ResultView(TRAINS))) == ["G3", "D2"]
+    plan = FilterPlan.compile("train", {"filters": [{"field": "inventory", "op": ">", "value": 0}]})
+    assert numbers(plan.execute(ResultView(TRAINS))) == ["G1", "D2", "G5"]
+
+
+@pytest.mark.parametrize("spec", [
+    {"filters": [{"field": "color", "op": "==", "value": "红"}]},
+    {"filters": [{"field": "price", "op": "~", "value": 1}]},
+    {"filters": [{"field": "departtime", "op": ">", "value": "傍晚"}]},
+    {"sort": [{"field": "nope"}]},
+    {"limit": 0},
+    ["not", "a", "plan"],
+])
+def test_invalid_plans_are_rejected(spec):
+    with pytest.raises(ValueError):
+        FilterPlan.compile("train", spec)
+
+
+def test_plan_round_trip_keeps_the_false_sentinel(tmp_path):
+    plan = FilterPlan.compile("transfer", {"filters": [{"field": "transfer_time", "op": ">=", "value": 40}]})
+    restored = plan_decode(plan_encode(plan))
+    assert (restored.kind, restored.filters, restored.sort) == ("transfer", plan.filters, plan.sort)
+    assert plan_decode(plan_encode(False)) is False
+
+    # 无法用计划表达的问题缓存为False，命中时不能被当作未命中
+    for cache in (TTLCache("筛选计划"),
+                  SQLiteCache("筛选计划", str(tmp_path / "cache.db"), encode=plan_encode, decode=plan_decode)):
+        cache.set(("train", "有没有靠窗的座位"), False)
+        assert cache.get(("train", "有没有靠窗的座位")) is False
+    assert SQLiteCache("筛选计划", str(tmp_path / "cache.db"), encode=plan_encode,
+                       decode=plan_decode).get(("train", "有没有靠窗的座位")) is False
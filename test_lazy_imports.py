@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+import types
+
+from . import ticket_engine
+from .ticket_engine import PluginConfig, lazy_openai
+
+HEAVY_MODULES = ("requests", "openai", "tiktoken")
+
+
+def test_importing_the_engine_loads_no_heavy_dependency():
+    package = __name__.rpartition(".")[0]
+    code = (f"import sys; import {package}.ticket_engine; "
+            f"print(','.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True)
+    assert output.stdout.strip() == ""
+
+
+def test_openai_client_is_created_once_per_key(monkeypatch):
+    created = []
+
+    class OpenAI:
+        def __init__(self, api_key, base_url):
+            created.append((api_key, base_url))
+
+    monkeypatch.setitem(sys.modules, "openai", types.SimpleNamespace(OpenAI=OpenAI))
+    monkeypatch.setattr(ticket_engine, "_openai_clients", {})
+    config = PluginConfig("sk-1", "https://example.com/v1")
+    _, client = lazy_openai(config)
+    assert lazy_openai(config)[1] is client
+    lazy_openai(PluginConfig("sk-2", "https://example.com/v1"))
+    assert created == [("sk-1", "https://example.com/v1"), ("sk-2", "https://example.com/v1")]
+
+
+def test_legacy_sdk_has_no_client(monkeypatch):
+    legacy = types.SimpleNamespace(ChatCompletion=object())
+    monkeypatch.setitem(sys.modules, "openai", legacy)
+    assert lazy_openai(PluginConfig("sk")) == (legacy, None)
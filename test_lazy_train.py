@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+from . import ticket_engine
+from .ticket_engine import (FAILED_LOOKUP, DepartureIndex, LazyTrain, _json_loads, _ticket_decode,
+                            _ticket_encode)
+
+TRAINS = [{"trainumber": f"G{i}", "traintype": "高铁" if i % 2 else "动车", "departtime": f"{6 + i:02d}:15",
+           "arrivetime": f"{10 + i:02d}:45", "departstation": "北京南", "arrivestation": "上海虹桥",
+           "ticket_info": [{"seatname": "二等座", "seatprice": 553 + i, "seatinventory": "有"}]}
+          for i in range(6)]
+
+
+def test_round_trip_is_lazy():
+    decoded = _ticket_decode(_ticket_encode(TRAINS))
+    assert all(type(train) is LazyTrain for train in decoded)
+    assert [train["trainumber"] for train in decoded] == [train["trainumber"] for train in TRAINS]
+    assert decoded[2].get("departtime") == "08:15"
+    assert not any(train.materialized for train in decoded)
+
+    assert decoded[3]["ticket_info"][0]["seatprice"] == 556
+    assert decoded[3].materialized and not decoded[2].materialized
+    assert [dict(train) for train in decoded] == TRAINS
+    assert len(decoded[0]) == len(TRAINS[0]) and decoded[0].get("missing", "默认") == "默认"
+
+
+def test_lazy_trains_can_be_encoded_again():
+    decoded = _ticket_decode(_ticket_encode(TRAINS))
+    decoded[1].materialize()  # 已解析和未解析的混在一起
+    assert [dict(train) for train in _ticket_decode(_ticket_encode(decoded))] == TRAINS
+
+
+def test_other_values():
+    assert _ticket_decode(_ticket_encode(FAILED_LOOKUP)) is FAILED_LOOKUP
+    assert _ticket_decode(_ticket_encode([])) == []
+    assert _ticket_decode(_ticket_encode({"code": 500})) == {"code": 500}
+
+
+def test_departure_index_does_not_materialize():
+    decoded = _ticket_decode(_ticket_encode(TRAINS))
+    index = DepartureIndex(decoded)
+    assert [train["trainumber"] for train in index.window("高铁", 8 * 60, 10 * 60)] == ["G3"]
+    assert not any(train.materialized for train in decoded)
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_json_loads_with_and_without_orjson(use_orjson, monkeypatch):
+    if not use_orjson:
+        monkeypatch.setattr(ticket_engine, "_orjson", lambda: None)
+    elif ticket_engine._orjson() is None:
+        pytest.skip("未安装orjson")
+    text = json.dumps({"data": TRAINS}, ensure_ascii=False)
+    assert _json_loads(text.encode()) == _json_loads(text) == {"data": TRAINS}
+    with pytest.raises(json.JSONDecodeError):
+        _json_loads(b'{"data": [')
@@ -0,0 +1,32 @@
+import time
+
+from .ticket_engine import TTLCache, normalize_query, seconds_until_midnight
+
+
+def test_normalized_queries_share_a_cache_key():
+    variants = ["明天 北京到上海的高铁？", "明天北京到上海的高铁", "明天，北京到上海的高铁!", "明天　北京到上海的高铁"]
+    assert {normalize_query(text) for text in variants} == {"明天北京到上海的高铁"}
+    assert normalize_query("Ｇ１２３ Beijing") == normalize_query("g123beijing")
+    assert normalize_query("北京到上海") != normalize_query("上海到北京")
+
+
+def test_parse_results_expire_at_midnight():
+    remaining = seconds_until_midnight()
+    assert 0 < remaining <= 24 * 3600
+    cache = TTLCache("自然语言解析")
+    cache.set("q", "高铁 北京 上海", ttl=remaining, cost=1.5)
+    assert cache.get("q") == "高铁 北京 上海"
+    cache.set("old", "昨天的解析", expire_at=time.time() - 1)
+    assert cache.get("old") is None and "old" not in cache._data
+
+
+def test_lru_eviction_and_stats():
+    cache = TTLCache("自然语言解析", max_size=2)
+    cache.set("a", 1, cost=2.0)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # a变为最近使用
+    cache.set("c", 3)
+    assert cache.get("b") is None and cache.get("c") == 3
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (2, 1, 2)
+    assert stats["saved_seconds"] == 2.0 and cache.hit_ratio() == 2 / 3
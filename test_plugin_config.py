@@ -0,0 +1,68 @@
+import json
+import os
+
+import pytest
+
+from .ticket_engine import DEFAULT_TUNABLES, ConfigWatcher, PluginConfig
+
+
+def test_values_are_coerced_to_the_default_types():
+    config = PluginConfig(page_size="20", query_budget="2.5", async_reply="off", session_store="Yes")
+    assert config.page_size == 20 and config.query_budget == 2.5
+    assert config.async_reply is False and config.session_store is True
+
+
+def test_invalid_values_fall_back_to_defaults():
+    config = PluginConfig(page_size="十", api_burst=None, watch_interval=[1])
+    assert config.page_size == DEFAULT_TUNABLES["page_size"]
+    assert config.api_burst == DEFAULT_TUNABLES["api_burst"]
+    assert config.watch_interval == DEFAULT_TUNABLES["watch_interval"]
+
+
+@pytest.mark.parametrize("name, value", [
+    ("page_size", 0), ("page_size", -3), ("reply_workers", 0), ("rule_parse_threshold", 1.5),
+    ("watch_jitter", 2), ("api_rate_limit", -1), ("query_budget", float("nan")),
+])
+def test_out_of_range_values_fall_back_to_defaults(name, value):
+    assert getattr(PluginConfig(**{name: value}), name) == pytest.approx(DEFAULT_TUNABLES[name])
+
+
+def test_boundary_values_are_kept():
+    config = PluginConfig(page_size=1, api_rate_limit=0, query_budget=0, rule_parse_threshold=1, watch_jitter=0.9)
+    assert (config.page_size, config.api_rate_limit, config.query_budget) == (1, 0, 0)
+    assert config.rule_parse_threshold == 1 and config.watch_jitter == 0.9
+
+
+def test_inverted_transfer_window_uses_defaults():
+    config = PluginConfig(min_transfer_time=200, max_transfer_time=60)
+    assert (config.min_transfer_time, config.max_transfer_time) == (
+        DEFAULT_TUNABLES["min_transfer_time"], DEFAULT_TUNABLES["max_transfer_time"])
+
+
+def test_snapshot_is_read_only():
+    with pytest.raises(AttributeError):
+        PluginConfig().page_size = 5
+
+
+def test_api_base_gets_the_version_once():
+    config = PluginConfig.from_dict({"open_ai_api_key": "sk", "open_ai_api_base": "https://example.com/v1"})
+    assert config.use_openai and config.api_base == "https://example.com/v1"
+    config = PluginConfig.from_dict({"open_ai_api_key": "sk", "open_ai_api_base": "https://example.com"})
+    assert config.api_base == "https://example.com/v1"
+    assert not PluginConfig.from_dict({}, {}).use_openai
+
+
+def test_watcher_reloads_and_keeps_the_last_good_snapshot(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps({"page_size": 5}), encoding="utf-8")
+    watcher = ConfigWatcher(str(path), check_interval=0)
+    first = watcher.current()
+    assert first.page_size == 5 and watcher.current() is first
+
+    path.write_text(json.dumps({"page_size": 8}), encoding="utf-8")
+    os.utime(path, ns=(1, 1))
+    assert watcher.current().page_size == 8
+
+    path.write_text("{broken", encoding="utf-8")
+    os.utime(path, ns=(2, 2))
+    assert watcher.current().page_size == 8
@@ -0,0 +1,51 @@
+from datetime import date, timedelta
+
+import pytest
+
+from .ticket_engine import DATE_RANGE_PATTERN, PriceCalendar, parse_date_range
+
+
+def train(number, seats):
+    return {"trainumber": number, "ticket_info": [{"seatname": name, "seatprice": price, "seatinventory": count}
+                                                  for name, price, count in seats]}
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("2024-06-05~2024-06-12", (date(2024, 6, 5), date(2024, 6, 12))),
+    ("2024-06-05至06-08", (date(2024, 6, 5), date(2024, 6, 8))),
+    ("2024-06-05～9", (date(2024, 6, 5), date(2024, 6, 9))),
+    ("2024-12-28~01-03", (date(2024, 12, 28), date(2025, 1, 3))),
+    ("2024-06-28~3", (date(2024, 6, 28), date(2024, 7, 3))),
+    ("2024-12-30~2", (date(2024, 12, 30), date(2025, 1, 2))),
+])
+def test_date_ranges(text, expected):
+    match = DATE_RANGE_PATTERN.search(f"高铁 北京 上海 {text}")
+    assert parse_date_range(match.group(1), match.group(2)) == expected
+
+
+def test_days_are_merged_into_summaries():
+    days = [date(2024, 6, 5) + timedelta(days=i) for i in range(4)]
+    calendar = PriceCalendar(days)
+    # 结果按完成顺序到达，不一定按日期顺序
+    calendar.add(days[2], [train("G1", [("二等座", 553, 0), ("一等座", 933, 2)]),
+                           train("G3", [("二等座", 480, "有")])])
+    calendar.add(days[0], [train("G5", [("二等座", 400, 0)])])
+    calendar.add(days[1], None)
+    calendar.add(days[3], [])
+
+    assert calendar.days[days[2]] == {"count": 2, "available": 2, "price": 480.0, "trainumber": "G3",
+                                      "seatname": "二等座", "sold_out_price": 553.0}
+    assert calendar.days[days[0]]["price"] is None and calendar.days[days[0]]["sold_out_price"] == 400.0
+    assert calendar.failed == {days[1]}
+    assert calendar.cheapest() == days[2]
+
+    lines = calendar.render("价格日历").split("\n")
+    assert lines[1].startswith("06-05") and "无余票（1班）" in lines[1]
+    assert "查询失败" in lines[2] and "¥480 G3 二等座 | 有票2/2班" in lines[3] and "无车次" in lines[4]
+    assert lines[-1].startswith("💰最便宜：06-07")
+
+
+def test_no_available_day_has_no_cheapest():
+    calendar = PriceCalendar([date(2024, 6, 5)])
+    calendar.add(date(2024, 6, 5), [train("G1", [("二等座", 553, 0)])])
+    assert calendar.cheapest() is None and "最便宜" not in calendar.render("价格日历")
@@ -0,0 +1,76 @@
+import threading
+import time
+
+from .ticket_engine import PRIORITY_FANOUT, PRIORITY_INTERACTIVE, PRIORITY_PREFETCH, RateLimiter
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.002)
+
+
+def test_queued_requests_leave_in_priority_then_arrival_order():
+    limiter = RateLimiter(rate=5, burst=1)
+    assert limiter.acquire() is not None  # 取走桶中唯一的令牌，之后的请求都要排队
+    order = []
+    lock = threading.Lock()
+
+    def request(name, priority):
+        limiter.acquire(priority, timeout=5)
+        with lock:
+            order.append(name)
+
+    arrivals = [("后台1", PRIORITY_PREFETCH), ("扇出1", PRIORITY_FANOUT), ("后台2", PRIORITY_PREFETCH),
+                ("交互1", PRIORITY_INTERACTIVE), ("扇出2", PRIORITY_FANOUT), ("交互2", PRIORITY_INTERACTIVE)]
+    threads = []
+    for name, priority in arrivals:
+        thread = threading.Thread(target=request, args=(name, priority))
+        thread.start()
+        threads.append(thread)
+        wait_for(lambda: limiter.queue_depth() == len(threads))
+    for thread in threads:
+        thread.join(5)
+
+    assert order == ["交互1", "交互2", "扇出1", "扇出2", "后台1", "后台2"]
+    stats = limiter.stats()
+    assert stats["交互"]["count"] == 3 and stats["扇出"]["count"] == 2 and stats["后台"]["count"] == 2
+
+
+def test_queue_timeout_releases_the_slot():
+    limiter = RateLimiter(rate=1, burst=1)
+    limiter.acquire()
+    assert limiter.acquire(PRIORITY_PREFETCH, timeout=0.05) is None
+    assert limiter.queue_depth() == 0
+    assert limiter.stats()["后台"]["timeouts"] == 1
+
+
+def test_zero_rate_disables_limiting():
+    limiter = RateLimiter(rate=0, burst=1)
+    start = time.monotonic()
+    assert all(limiter.acquire() == 0.0 for _ in range(100))
+    assert time.monotonic() - start < 0.5
+
+
+def test_reconfigure_while_requests_wait():
+    limiter = RateLimiter(rate=0.5, burst=1)
+    limiter.acquire()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(limiter.acquire(PRIORITY_FANOUT, timeout=5)))
+               for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    wait_for(lambda: limiter.queue_depth() == 3)
+
+    limiter.configure(0, 1)  # 热更新关闭限流：排队的请求全部放行
+    for thread in threads:
+        thread.join(5)
+    assert len(results) == 3 and None not in results
+    assert limiter.queue_depth() == 0
+
+    limiter.configure(5, 10)  # 重新开启后不受之前排队请求的影响
+    assert limiter.acquire(timeout=1) is not None
+    assert limiter.queue_depth() == 0
+    stats = limiter.stats()["扇出"]
+    assert stats["count"] == 3 and stats["timeouts"] == 0
@@ -0,0 +1,63 @@
+from .ticket_engine import ResultRenderer, ResultView, format_train_block, format_transfer_block
+
+
+def train(number, depart="08:00"):
+    return {"trainumber": number, "traintype": "高铁", "departstation": "北京南", "arrivestation": "上海虹桥",
+            "departtime": depart, "arrivetime": "12:30", "runtime": "4小时30分钟",
+            "ticket_info": [{"seatname": "二等座", "seatprice": 553, "seatinventory": 5}]}
+
+
+def counting_renderer():
+    calls = []
+
+    def format_block(item):
+        calls.append(item["trainumber"])
+        return item["trainumber"]
+
+    return ResultRenderer(format_block=format_block), calls
+
+
+def test_blocks_are_formatted_once_per_load():
+    renderer, calls = counting_renderer()
+    rows = [train(f"G{i}") for i in range(5)]
+    renderer.load(rows)
+    assert calls == ["G0", "G1", "G2", "G3", "G4"]
+    renderer.set_view(ResultView(rows).filter(lambda item: item["trainumber"] != "G1"))
+    assert renderer.page(1, 3) == "1. G0\n2. G2\n3. G3"
+    assert renderer.page(2, 3) == "4. G4"
+    assert len(calls) == 5
+
+
+def test_pages_are_cached_until_the_view_changes():
+    renderer, _ = counting_renderer()
+    rows = [train(f"G{i}") for i in range(5)]
+    renderer.load(rows)
+    first = renderer.page(1, 2)
+    assert renderer.page(1, 2) is first
+    assert (renderer.page_hits, renderer.page_misses) == (1, 1)
+    renderer.set_view([rows[4], rows[0]])  # 条目列表也会转换为视图
+    assert renderer.page(1, 2) == "1. G4\n2. G0"
+    assert renderer.page_misses == 2
+
+
+def test_page_is_capped_at_max_items():
+    renderer, _ = counting_renderer()
+    renderer.load([train(f"G{i}") for i in range(30)])
+    assert renderer.page(1, 30, max_items=3) == "1. G0\n2. G1\n3. G2"
+
+
+def test_items_outside_the_loaded_results_are_formatted_on_demand():
+    renderer, calls = counting_renderer()
+    renderer.load([train("G1")])
+    extra = train("D9")
+    assert renderer.render([extra, extra], start_index=5) == "5. D9\n6. D9"
+    assert calls == ["G1", "D9"]
+
+
+def test_default_templates():
+    block = format_train_block(train("G1"))
+    assert block.startswith("【G1】高铁\n") and "二等座：¥553（余5张）" in block
+    route = {"transfer_station": "南京", "transfer_time": 40, "total_price": 900, "total_runtime": 420,
+             "first_leg": train("G1"), "second_leg": train("D5", "13:10")}
+    text = format_transfer_block(route)
+    assert "南京" in text and "G1" in text and "D5" in text
@@ -0,0 +1,108 @@
+from array import array
+
+from .ticket_engine import ResultRenderer, ResultView, SeatIndex
+
+
+def trains(count=10):
+    return [{"trainumber": f"G{i}", "departtime": f"{8 + i:02d}:00",
+             "ticket_info": [{"seatname": "二等座", "seatprice": 500 - (i * 37) % 200, "seatinventory": i % 3}]}
+            for i in range(count)]
+
+
+def numbers(view):
+    return [train["trainumber"] for train in view]
+
+
+def price(train):
+    return train["ticket_info"][0]["seatprice"]
+
+
+def test_full_view_and_slicing():
+    rows = trains()
+    view = ResultView(rows)
+    assert view.is_full() and len(view) == 10 and view.position_set() is None
+    assert view[3] is rows[3]
+    page = view[2:5]
+    assert isinstance(page, ResultView) and page.rows is rows
+    assert page.indices.tolist() == [2, 3, 4]
+    assert not page.is_full()
+    assert view[8:20].indices.tolist() == [8, 9]
+    assert not view[20:]
+
+
+def test_composition_shares_rows():
+    rows = trains()
+    view = ResultView(rows)
+    available = view.filter(lambda train: train["ticket_info"][0]["seatinventory"] > 0)
+    cheapest = available.sort(price)[:3]
+    assert cheapest.rows is rows
+    assert numbers(cheapest) == [train["trainumber"] for train in sorted(
+        (t for t in rows if t["ticket_info"][0]["seatinventory"] > 0), key=price)[:3]]
+    # 在截取结果上继续筛选，序号仍指向原始结果
+    later = cheapest.filter(lambda train: train["departtime"] >= "12:00")
+    assert all(rows[i] is train for i, train in zip(later.indices, later))
+    assert set(later.indices) <= set(cheapest.indices)
+
+
+def test_sort_keeps_unknown_keys_last_and_is_stable():
+    rows = trains(6)
+    keys = {"G0": 3, "G1": None, "G2": 1, "G3": 3, "G4": None, "G5": 2}
+    view = ResultView(rows).sort(lambda train: keys[train["trainumber"]])
+    assert numbers(view) == ["G2", "G5", "G0", "G3", "G1", "G4"]
+    descending = ResultView(rows).sort(lambda train: keys[train["trainumber"]], reverse=True)
+    assert numbers(descending) == ["G0", "G3", "G5", "G2", "G1", "G4"]
+
+
+def test_select_and_of():
+    rows = trains()
+    assert ResultView(rows).select([7, 2, 99, -1]).indices.tolist() == [7, 2]
+    assert ResultView.of(rows, [rows[4], rows[1], {"trainumber": "X"}]).indices.tolist() == [4, 1]
+
+
+def test_seat_index_within_view():
+    rows = trains()
+    index = SeatIndex(rows)
+    base = ResultView(rows).filter(lambda train: train["departtime"] >= "12:00")
+    within = base.position_set()
+    cheapest = base.select(index.cheapest("二等座", k=2, within=within))
+    expected = sorted((t for t in base if t["ticket_info"][0]["seatinventory"] > 0), key=price)[:2]
+    assert numbers(cheapest) == numbers(expected)
+    assert set(index.with_inventory("二等座", within=within)) <= within
+
+
+def test_renderer_pages_follow_the_view():
+    rows = trains()
+    renderer = ResultRenderer(format_block=lambda train: train["trainumber"])
+    renderer.load(rows)
+    renderer.set_view(ResultView(rows, array("I", [9, 0, 5])))
+    assert renderer.page(1, 2) == "1. G9\n2. G0"
+    assert renderer.page(2, 2) == "3. G5"
+
+
+def test_seat_index_within_matches_a_full_scan():
+    rows = trains(200)
+    index = SeatIndex(rows)
+    order = sorted(range(200), key=lambda i: (price(rows[i]), i))
+    for size in (3, 40, 150):
+        within = set(range(0, 200, 200 // size))
+        expected = [i for i in order if i in within and rows[i]["ticket_info"][0]["seatinventory"] > 0]
+        assert index.with_inventory("二等座", within=within).tolist() == expected
+        # 视图中全部售罄时退回按票价排序的全部车次
+        cheapest = expected or [i for i in order if i in within]
+        for k in (1, 5, 500):
+            assert index.cheapest("二等座", k=k, within=within).tolist() == cheapest[:k]
+    assert index.cheapest("软卧", within={1, 2}).tolist() == []
+
+
+def test_seat_index_stops_after_k_hits():
+    class CountingSet(set):
+        lookups = 0
+
+        def __contains__(self, item):
+            CountingSet.lookups += 1
+            return super().__contains__(item)
+
+    rows = trains(200)
+    index = SeatIndex(rows)
+    index.cheapest("二等座", k=3, within=CountingSet(range(100)))
+    assert CountingSet.lookups < 20
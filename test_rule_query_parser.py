@@ -0,0 +1,27 @@
+from datetime import date
+
+from .ticket_engine import RuleQueryParser, load_station_dictionary
+
+TODAY = date(2024, 6, 3)  # 周一
+
+
+def parse(query):
+    return RuleQueryParser(load_station_dictionary()).parse(query, today=TODAY)
+
+
+def test_clock_and_hour_times():
+    assert parse("明天北京到上海8点")["time"] == "08:00"
+    assert parse("明天北京到上海8时30分")["time"] == "08:30"
+    assert parse("明天下午3点北京到上海")["time"] == "15:00"
+    assert parse("明天北京到上海十点半")["time"] == "10:30"
+
+
+def test_duration_is_not_a_clock_time():
+    assert parse("明天北京到上海3小时内到")["time"] is None
+    assert parse("北京到上海两个小时以内的高铁")["time"] is None
+
+
+def test_one_sided_time_bounds():
+    assert parse("深圳到广州 14:00之后的车")["time"] == "14:00之后"
+    assert parse("明天北京到上海8点以前")["time"] == "08:00之前"
+    assert parse("明天10点前往上海，从北京出发")["time"] == "10:00"
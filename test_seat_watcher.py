@@ -0,0 +1,121 @@
+import json
+import time
+import types
+
+from . import ticket_engine
+from .ticket_engine import ConfigWatcher, SeatWatcher, TicketEngine, WatchSubscription
+
+KEY = ("高铁", "北京", "上海", "2024-06-05")
+OTHER_KEY = ("高铁", "北京", "杭州", "2024-06-05")
+
+
+class Clock:
+    """手动推进的时钟，轮询时间不依赖真实等待"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_watcher(fetch, deliver=lambda subscription, text: None, submit=None, max_inflight=2):
+    clock = Clock()
+    watcher = SeatWatcher(fetch, deliver, submit or (lambda func, *args: func(*args)), interval=10, jitter=0,
+                          max_inflight=max_inflight, clock=clock, background=False)
+    return watcher, clock
+
+
+def step(watcher, clock, seconds=10):
+    clock.now += seconds
+    return watcher.run_pending()
+
+
+def subscription(clock, session_id="s1", train="G1", seat=None, lifetime=3600):
+    return WatchSubscription(session_id, train, seat, None, None, clock.now + lifetime)
+
+
+def train(number, inventory):
+    return {"trainumber": number, "ticket_info": [{"seatname": "二等座", "seatinventory": inventory}]}
+
+
+def test_resubscribe_keeps_a_single_poll_chain():
+    polls = []
+    watcher, clock = make_watcher(lambda key: polls.append(key) or [])
+    watcher.subscribe(KEY, subscription(clock))
+    watcher.unsubscribe("s1")
+    watcher.subscribe(KEY, subscription(clock))
+    watcher.subscribe(KEY, subscription(clock, "s2"))
+    assert len(watcher._heap) == 1
+
+    # 首次轮询在半个到一个间隔内，之后每个间隔一次
+    assert watcher.run_pending() is not None and polls == []
+    for count in range(1, 6):
+        assert step(watcher, clock) == 10
+        assert len(polls) == count and len(watcher._heap) == 1
+
+    watcher.unsubscribe("s1")
+    watcher.unsubscribe("s2")
+    assert step(watcher, clock) is None
+    assert len(polls) == 5
+    assert not watcher._heap and not watcher._scheduled
+
+
+def test_only_subscribed_changes_are_delivered():
+    inventories = iter([{"G1": 3, "G2": 1}, {"G1": 3, "G2": 0}])
+    delivered = []
+    watcher, clock = make_watcher(
+        lambda key: [train(number, count) for number, count in next(inventories).items()],
+        lambda sub, text: delivered.append((sub.session_id, text)))
+    watcher.subscribe(KEY, subscription(clock), trains=[train("G1", 0), train("G2", 5)])
+    step(watcher, clock)
+    step(watcher, clock)
+
+    assert len(delivered) == 1
+    session_id, text = delivered[0]
+    assert session_id == "s1" and "G1" in text and "G2" not in text
+    assert watcher.stats["polls"] == 2 and watcher.stats["notifications"] == 1
+
+
+def test_expired_subscriptions_end_the_chain():
+    polls = []
+    watcher, clock = make_watcher(lambda key: polls.append(key) or [])
+    watcher.subscribe(KEY, subscription(clock, lifetime=25))
+    step(watcher, clock)
+    step(watcher, clock)
+    assert step(watcher, clock) is None
+    assert len(polls) == 2 and watcher.stats["expired"] == 1
+    assert watcher.route_count() == 0 and not watcher._scheduled
+
+
+def test_polls_beyond_max_inflight_are_deferred():
+    submitted = []
+    watcher, clock = make_watcher(lambda key: [], submit=lambda func, *args: submitted.append((func, args)),
+                                  max_inflight=1)
+    watcher.subscribe(KEY, subscription(clock))
+    watcher.subscribe(OTHER_KEY, subscription(clock, "s2"))
+    step(watcher, clock)
+    assert len(submitted) == 1 and watcher.stats["deferred"] == 1
+
+    func, args = submitted.pop()
+    func(*args)  # 第一条线路轮询完成后，推迟的线路在下次到期时轮询
+    step(watcher, clock, 5)
+    assert len(submitted) == 1 and submitted[0][1] != args
+
+
+def test_baseline_fetch_skips_stale_cache(tmp_path, monkeypatch):
+    calls = []
+
+    def get(url, params=None, timeout=None):
+        calls.append(params)
+        body = json.dumps({"code": 200, "data": [train("G1", 5)]}).encode()
+        return types.SimpleNamespace(status_code=200, content=body, text=body.decode())
+
+    monkeypatch.setattr(ticket_engine, "lazy_requests", lambda: types.SimpleNamespace(
+        get=get, exceptions=types.SimpleNamespace(Timeout=TimeoutError, RequestException=OSError)))
+    engine = TicketEngine(ConfigWatcher(str(tmp_path / "config.json")))
+    engine.ticket_cache.set(KEY, [train("G1", 0)], expire_at=time.time() - 1, stale=600)
+
+    assert engine.fetch_tickets(*KEY)[0]["ticket_info"][0]["seatinventory"] == 0  # 查询可以先返回旧结果
+    baseline = engine.fetch_tickets(*KEY, allow_stale=False)
+    assert baseline[0]["ticket_info"][0]["seatinventory"] == 5 and len(calls) >= 1
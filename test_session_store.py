@@ -0,0 +1,78 @@
+import os
+import zlib
+
+import pytest
+
+from .ticket_engine import QuerySession, ResultView, SessionStore
+
+
+def trains(count=12):
+    return [{"trainumber": f"G{i}", "traintype": "高铁", "departstation": "北京南", "arrivestation": "上海虹桥",
+             "departtime": f"{6 + i:02d}:00", "arrivetime": f"{10 + i:02d}:30", "runtime": "4小时30分钟",
+             "ticket_info": [{"seatname": "二等座", "bookable": "有车票", "seatprice": 553 + i, "seatinventory": i},
+                             {"seatname": "一等座", "bookable": "无车票", "seatprice": 933, "seatinventory": 0}]}
+            for i in range(count)]
+
+
+def routes():
+    legs = trains(4)
+    return [{"first_leg": legs[i], "second_leg": legs[i + 1], "transfer_station": "南京",
+             "transfer_time": 40 + i, "total_price": 1100 + i, "total_runtime": 600 + i} for i in range(3)]
+
+
+def round_trip(session_id, state):
+    return SessionStore.decode(SessionStore.encode(session_id, state))
+
+
+def test_filtered_view_round_trip():
+    data = trains()
+    view = ResultView(data).filter(lambda train: train["ticket_info"][0]["seatinventory"] % 2).sort(
+        lambda train: -train["ticket_info"][0]["seatprice"])
+    (query, is_transfer, page, restored, restored_view), session_id = round_trip(
+        "group-1", ("高铁 北京 上海", False, 2, data, view))
+    assert (session_id, query, is_transfer, page) == ("group-1", "高铁 北京 上海", False, 2)
+    assert restored == data
+    assert restored_view.rows is restored
+    assert restored_view.indices.tolist() == view.indices.tolist()
+
+
+def test_full_view_and_transfer_round_trip():
+    data = routes()
+    state, _ = round_trip("s", (None, True, 1, data, ResultView(data)))
+    assert state[3] == data and state[4].is_full()
+
+    session = QuerySession.restore("s", state)
+    assert session.is_transfer_query and session.seat_index is None
+    assert session.renderer.page(1, 10).startswith("1. ")
+
+
+def test_restore_rebuilds_session():
+    data = trains()
+    view = ResultView(data)[3:7]
+    state, _ = round_trip("s", ("q", False, 1, data, view))
+    session = QuerySession.restore("s", state)
+    assert [train["trainumber"] for train in session.total_data] == ["G3", "G4", "G5", "G6"]
+    assert session.seat_index is not None and not session.dirty
+
+
+def test_invalid_views_are_rejected():
+    data = trains(3)
+    with pytest.raises(ValueError):
+        SessionStore.encode("s", ("q", False, 1, data, list(reversed(data))))
+    blob = SessionStore.encode("s", ("q", False, 1, data, ResultView(data)[:1]))
+    body = zlib.decompress(blob[len(SessionStore.MAGIC):]).replace(b'"view":[0]', b'"view":[7]')
+    with pytest.raises(ValueError):
+        SessionStore.decode(SessionStore.MAGIC + zlib.compress(body))
+    with pytest.raises(ValueError):
+        SessionStore.decode(b"XXXX" + blob[4:])
+
+
+def test_save_and_load(tmp_path):
+    store = SessionStore(str(tmp_path), lambda func, *args: func(*args))
+    data = trains()
+    store.save("u1", ("q", False, 3, data, ResultView(data)[5:]))
+    assert store.stats["saved"] == 1 and len(os.listdir(tmp_path)) == 1
+    query, _, page, restored, view = store.load("u1")
+    assert (query, page, restored) == ("q", 3, data)
+    assert view.indices.tolist() == list(range(5, 12))
+    assert store.load("u2") is None
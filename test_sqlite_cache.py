@@ -0,0 +1,50 @@
+import sqlite3
+import time
+
+from .ticket_engine import SQLiteCache, TTLCache, _ticket_decode, _ticket_encode
+
+TRAINS = [{"trainumber": "G1", "traintype": "高铁", "departtime": "08:00",
+           "ticket_info": [{"seatname": "二等座", "seatprice": 553, "seatinventory": 5}]}]
+
+
+def make_cache(path):
+    return SQLiteCache("车票查询", str(path), encode=_ticket_encode, decode=_ticket_decode)
+
+
+def test_hits_count_saved_time_in_both_layers(tmp_path):
+    path = tmp_path / "cache.db"
+    writer = make_cache(path)
+    writer.set("route", TRAINS, cost=0.5)
+    assert writer.get("route")[0]["trainumber"] == "G1"  # 进程内缓存命中
+    reader = make_cache(path)
+    assert reader.get("route")[0]["trainumber"] == "G1"  # 读取数据库
+    assert reader.get("route")[0]["trainumber"] == "G1"  # 进程内缓存命中
+    assert writer.stats()["saved_seconds"] == 0.5
+    assert reader.stats()["hits"] == 2 and reader.stats()["saved_seconds"] == 1.0
+
+
+def test_stale_entries(tmp_path):
+    cache = make_cache(tmp_path / "cache.db")
+    cache.set("route", TRAINS, expire_at=time.time() - 1, stale=60)
+    other = make_cache(tmp_path / "cache.db")
+    value, stale = other.get_stale("route")
+    assert stale and value[0]["trainumber"] == "G1"
+    assert other.get("route") is None
+
+
+def test_undecodable_row_is_a_miss_and_removed(tmp_path):
+    path = tmp_path / "cache.db"
+    make_cache(path).set("route", TRAINS)
+    with sqlite3.connect(path) as connection:
+        connection.execute("UPDATE cache_entries SET value = ?", (b"TQT1\xff\xff\xff\xffbroken",))
+    cache = make_cache(path)
+    assert cache.get_stale("route", "默认") == ("默认", False)
+    stats = cache.stats()
+    assert stats["errors"] == 1 and stats["misses"] == 1 and stats["size"] == 0
+
+
+def test_ttl_cache_lookup_reports_cost():
+    cache = TTLCache("测试")
+    cache.set("key", "value", cost=0.25)
+    assert cache._lookup("key", None, allow_stale=False) == ("value", False, 0.25)
+    assert cache._lookup("missing", None, allow_stale=False) == (None, False, 0.0)
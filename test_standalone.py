@@ -0,0 +1,73 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 替代模块会注册到sys.modules，在单独的解释器中运行，不影响其他测试
+SCRIPT = textwrap.dedent("""
+    import json, sys, threading, types, urllib.request
+    from urllib.parse import quote
+    sys.path.insert(0, sys.argv[1])
+    import standalone
+
+    service = standalone.StandaloneService(sys.argv[2])
+    engine_module = sys.modules["TicketQuery.ticket_engine"]
+    trains = [{"trainumber": "G1", "traintype": "高铁", "departstation": "北京南", "arrivestation": "上海虹桥",
+               "departtime": "09:00", "arrivetime": "13:30", "runtime": "4小时30分钟",
+               "ticket_info": [{"seatname": "二等座", "seatprice": 553, "seatinventory": 5}]}]
+
+    def get(url, params=None, timeout=None):
+        body = json.dumps({"code": 200, "data": trains}).encode()
+        return types.SimpleNamespace(status_code=200, content=body, text=body.decode())
+
+    engine_module.lazy_requests = lambda: types.SimpleNamespace(
+        get=get, exceptions=types.SimpleNamespace(Timeout=TimeoutError, RequestException=OSError))
+
+    server = standalone.make_server(service)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def request(path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        try:
+            with urllib.request.urlopen(base + quote(path, safe="/?=&"), data) as response:
+                return response.status, json.load(response)
+        except urllib.error.HTTPError as e:
+            return e.code, json.load(e)
+
+    print(json.dumps({
+        "query": request("/query?type=高铁&from=北京&to=上海&date=2099-06-05"),
+        "missing": request("/query?type=高铁&from=北京"),
+        "unknown": request("/nope"),
+        "chat": request("/chat", {"session": "u1", "text": "高铁 北京 上海 2099-06-05"}),
+        "ignored": request("/chat", {"session": "u2", "text": "今天天气不错"}),
+        "stats": request("/stats"),
+    }, ensure_ascii=False))
+""")
+
+
+def test_http_service(tmp_path):
+    config = tmp_path / "config.json"
+    config.write_text(json.dumps({"session_store": False, "async_reply": False}), encoding="utf-8")
+    output = subprocess.run([sys.executable, "-c", SCRIPT, PLUGIN_DIR, str(config)], cwd=str(tmp_path),
+                            capture_output=True, text=True, timeout=60)
+    assert output.returncode == 0, output.stderr
+    results = json.loads(output.stdout.strip().splitlines()[-1])
+
+    status, query = results["query"]
+    assert status == 200 and query["error"] is None
+    [record] = query["records"]
+    assert record["number"] == "G1" and record["runtime_minutes"] == 270 and record["seats"][0]["price"] == 553
+
+    assert results["missing"][0] == 400 and "to" in results["missing"][1]["error"]
+    assert results["unknown"][0] == 404
+
+    status, chat = results["chat"]
+    assert status == 200 and chat["type"] == "TEXT" and "G1" in chat["reply"]
+    assert results["ignored"] == [200, {"type": None, "reply": None}]
+
+    status, stats = results["stats"]
+    assert status == 200 and stats["sessions"] == 1 and stats["ticket_cache"]["hits"] >= 1
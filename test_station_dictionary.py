@@ -0,0 +1,44 @@
+import pytest
+
+from . import ticket_engine
+from .ticket_engine import STATION_FILE, ConfigWatcher, StationDictionary, TicketEngine
+
+STATION_JS = "var station_names ='@jji|晋江|JJS|jinjiang|jj|0|1234|泉州|||@bjn|北京南|VNP|beijingnan|bjn|1|0001|北京|||';"
+
+
+@pytest.fixture
+def engine(tmp_path):
+    return TicketEngine(ConfigWatcher(str(tmp_path / "config.json")))
+
+
+def test_bundled_dictionary_resolves_names_pinyin_and_aliases():
+    stations = StationDictionary.load(station_js_path=None)
+    assert not stations.complete
+    assert stations.resolve("北京南站").city == "北京"
+    assert stations.resolve("shanghai").city == "上海"
+    assert stations.resolve("晋江") is None
+    assert [station.city for _, _, station in stations.extract("明天北京到上海的高铁")] == ["北京", "上海"]
+
+
+def test_station_js_completes_the_dictionary(tmp_path):
+    path = tmp_path / "station_name.js"
+    path.write_text(STATION_JS, encoding="utf-8")
+    stations = StationDictionary.load(STATION_FILE, str(path))
+    assert stations.complete
+    assert stations.resolve("晋江").city == "泉州"
+    assert stations.resolve("jinjiang").city == "泉州"
+
+
+def test_unknown_names_pass_through_without_the_full_list(engine, monkeypatch):
+    monkeypatch.setattr(ticket_engine, "load_station_dictionary", lambda: StationDictionary.load(station_js_path=None))
+    assert engine.resolve_location("北京南") == "北京"
+    assert engine.resolve_location("虎门") == "虎门"
+
+
+def test_unknown_names_are_rejected_with_the_full_list(engine, tmp_path, monkeypatch):
+    path = tmp_path / "station_name.js"
+    path.write_text(STATION_JS, encoding="utf-8")
+    monkeypatch.setattr(ticket_engine, "load_station_dictionary", lambda: StationDictionary.load(STATION_FILE, str(path)))
+    assert engine.resolve_location("晋江") == "泉州"
+    assert engine.resolve_location("火星") is None
+    assert engine.query("高铁", "火星", "北京", "2024-06-05").error == "未识别的站点或城市：火星"
@@ -0,0 +1,57 @@
+import json
+
+from .ticket_engine import encode_train_table, encode_transfer_table, estimate_tokens, pack_table
+
+
+def train(number, seats, runtime="4小时30分钟"):
+    return {"trainumber": number, "traintype": "高铁", "departstation": "北京南", "arrivestation": "上海虹桥",
+            "departtime": "08:00", "arrivetime": "12:30", "runtime": runtime,
+            "ticket_info": [{"seatname": name, "seatprice": price, "seatinventory": count}
+                            for name, price, count in seats]}
+
+
+def test_train_table_uses_seat_columns():
+    header, lines = encode_train_table([
+        (0, train("G1", [("二等座", 553.0, 5), ("一等座", 933, "有")])),
+        (1, train("G3", [("商务座", 1748.5, 0)], runtime="04:31")),
+    ])
+    assert header == "序号|车次|类型|出发站|到达站|发车|到达|历时(分)|二等座|一等座|商务座"
+    assert lines == [
+        (0, "0|G1|高铁|北京南|上海虹桥|08:00|12:30|270|553/5|933/有|"),
+        (1, "1|G3|高铁|北京南|上海虹桥|08:00|12:30|271|||1748.5/0"),
+    ]
+
+
+def test_cells_cannot_break_the_table():
+    data = train("G1|G2", [])
+    data["departstation"] = "北京\n南"
+    _, [(_, line)] = encode_train_table([(7, data)])
+    assert line.split("|")[1:4] == ["G1/G2", "高铁", "北京 南"]
+
+
+def test_transfer_table_has_columns_per_leg():
+    route = {"transfer_station": "南京", "total_price": 1100.0, "total_runtime": 600, "transfer_time": 45,
+             "first_leg": train("G1", [("二等座", 300, 2)]), "second_leg": train("D5", [("一等座", 800, 1)])}
+    header, [(index, line)] = encode_transfer_table([(3, route)])
+    columns = header.split("|")
+    assert "一程二等座" in columns and "二程一等座" in columns and "一程一等座" not in columns
+    assert index == 3 and len(line.split("|")) == len(columns)
+
+
+def test_pack_table_respects_the_budget():
+    header, lines = encode_train_table([(i, train(f"G{i}", [("二等座", 500 + i, i)])) for i in range(40)])
+    budget = estimate_tokens(header) + 5 * (estimate_tokens(lines[0][1]) + 1) + 1
+    chunks = pack_table(header, lines, budget)
+    assert [index for indices, _, _ in chunks for index in indices] == list(range(40))
+    for indices, text, tokens in chunks:
+        assert text.split("\n")[0] == header and len(text.split("\n")) == len(indices) + 1
+        assert tokens <= budget
+    # 预算小于一行时每块仍放入一行
+    assert [len(indices) for indices, _, _ in pack_table(header, lines[:3], 1)] == [1, 1, 1]
+
+
+def test_table_is_much_shorter_than_json():
+    trains = [train(f"G{i}", [("二等座", 553, 5), ("一等座", 933, 2), ("商务座", 1748, 0)]) for i in range(20)]
+    header, lines = encode_train_table(list(enumerate(trains)))
+    table = "\n".join([header] + [line for _, line in lines])
+    assert estimate_tokens(table) * 2 < estimate_tokens(json.dumps(trains, ensure_ascii=False))
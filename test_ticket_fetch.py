@@ -0,0 +1,78 @@
+import json
+import time
+import types
+
+import pytest
+
+from . import ticket_engine
+from .ticket_engine import FAILED_LOOKUP, ConfigWatcher, TicketEngine
+
+KEY = ("高铁", "北京", "上海", "2024-06-05")
+
+
+def train(number, inventory):
+    return {"trainumber": number, "traintype": "高铁", "departtime": "08:00",
+            "ticket_info": [{"seatname": "二等座", "seatprice": 553, "seatinventory": inventory}]}
+
+
+class SyncExecutor:
+    """后台刷新改为同步执行，测试不依赖线程调度"""
+
+    def submit(self, func, *args):
+        func(*args)
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """按顺序返回预设响应的车票API，记录请求次数"""
+    state = types.SimpleNamespace(responses=[], calls=0)
+
+    def get(url, params=None, timeout=None):
+        state.calls += 1
+        status, body = state.responses.pop(0)
+        content = json.dumps(body).encode()
+        return types.SimpleNamespace(status_code=status, content=content, text=content.decode())
+
+    requests = types.SimpleNamespace(get=get, exceptions=types.SimpleNamespace(Timeout=TimeoutError,
+                                                                               RequestException=OSError))
+    monkeypatch.setattr(ticket_engine, "lazy_requests", lambda: requests)
+    return state
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = TicketEngine(ConfigWatcher(str(tmp_path / "config.json")))
+    engine.executor = lambda name, workers: SyncExecutor()
+    return engine
+
+
+def test_failed_lookups_are_negatively_cached(api, engine):
+    api.responses = [(500, {})]
+    assert engine.fetch_tickets(*KEY) is None
+    assert engine.ticket_cache.get(KEY) is FAILED_LOOKUP
+    assert engine.fetch_tickets(*KEY) is None
+    assert api.calls == 1 and engine.ticket_fetch_stats["negative_hits"] == 1
+
+
+def test_empty_results_are_cached_briefly(api, engine):
+    api.responses = [(200, {"code": 200, "data": []})]
+    assert engine.fetch_tickets(*KEY) == []
+    assert engine.fetch_tickets(*KEY) == [] and api.calls == 1
+
+
+def test_stale_results_are_served_while_refreshing(api, engine):
+    engine.ticket_cache.set(KEY, [train("G1", 0)], expire_at=time.time() - 1, stale=600)
+    api.responses = [(200, {"code": 200, "data": [train("G1", 7)]})]
+    assert engine.fetch_tickets(*KEY)[0]["ticket_info"][0]["seatinventory"] == 0
+    assert engine.ticket_fetch_stats["refreshes"] == 1 and api.calls == 1
+    assert engine.fetch_tickets(*KEY)[0]["ticket_info"][0]["seatinventory"] == 7
+    assert api.calls == 1
+
+
+def test_failed_refresh_keeps_the_stale_result(api, engine):
+    engine.ticket_cache.set(KEY, [train("G1", 0)], expire_at=time.time() - 1, stale=600)
+    api.responses = [(200, {"code": 500, "msg": "系统繁忙"})]
+    assert engine.fetch_tickets(*KEY)[0]["trainumber"] == "G1"
+    assert engine.ticket_fetch_stats["refresh_failures"] == 1
+    value, stale = engine.ticket_cache.get_stale(KEY)
+    assert stale and value[0]["trainumber"] == "G1"
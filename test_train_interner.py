@@ -0,0 +1,55 @@
+import json
+
+from .ticket_engine import LazyTrain, TrainInterner
+
+
+def parsed(number="G1", inventory=5, seats=("二等座", "一等座")):
+    """每次重新解析JSON，得到内容相同但互不共用的对象"""
+    return json.loads(json.dumps({
+        "trainumber": number, "traintype": "高铁", "departstation": "北京南", "arrivestation": "上海虹桥",
+        "departtime": "08:00", "ticket_info": [{"seatname": name, "seatprice": 553, "seatinventory": inventory}
+                                               for name in seats]}, ensure_ascii=False))
+
+
+def test_identical_trains_share_one_dict():
+    interner = TrainInterner()
+    first, second = interner.trains([parsed(), parsed()])
+    assert first is second and first == parsed()
+    assert interner.stats["shared_trains"] == 1
+
+
+def test_seats_layouts_and_strings_are_shared():
+    interner = TrainInterner()
+    g1 = interner.train(parsed("G1"))
+    g2 = interner.train(parsed("G2"))
+    g3 = interner.train(parsed("G3", inventory=0))
+    assert g1 is not g2 and g1["ticket_info"] is g2["ticket_info"]
+    assert g3["ticket_info"] is not g1["ticket_info"]
+    assert g1["departstation"] is g3["departstation"]
+    assert g3["ticket_info"][0]["seatname"] is g1["ticket_info"][0]["seatname"]
+    assert interner.stats["shared_layouts"] == 1
+
+
+def test_unhashable_fields_are_kept_but_not_shared():
+    interner = TrainInterner()
+    train = dict(parsed(), stops=["南京南", "苏州北"])
+    first, second = interner.train(train), interner.train(dict(train))
+    assert first == train and second == train and first is not second
+
+
+def test_table_resets_when_full():
+    interner = TrainInterner(max_entries=4)
+    for i in range(6):
+        interner.train(parsed(f"G{i}", seats=(f"座位{i}",)))
+    assert interner.stats["resets"] >= 1
+    assert interner.train(parsed("G9")) == parsed("G9")
+
+
+def test_routes_share_legs_and_lazy_trains_pass_through():
+    interner = TrainInterner()
+    routes = interner.routes([{"transfer_station": "南京", "first_leg": parsed("G1"), "second_leg": parsed("D5")},
+                              {"transfer_station": "南京", "first_leg": parsed("G1"), "second_leg": parsed("D7")}])
+    assert routes[0]["first_leg"] is routes[1]["first_leg"]
+    assert routes[0]["transfer_station"] is routes[1]["transfer_station"]
+    lazy = LazyTrain("G1", "高铁", "08:00", b"{}", 0, 2)
+    assert interner.train(lazy) is lazy
@@ -0,0 +1,78 @@
+import random
+
+import pytest
+
+from .ticket_engine import TransferRanker, _clock_minutes, _leg_runtime, _reference_price
+
+MIN_TRANSFER, MAX_TRANSFER = 30, 180
+
+
+def random_leg(rnd, prefix, count):
+    trains = []
+    for i in range(count):
+        depart = rnd.randrange(24 * 60)
+        runtime = rnd.randrange(60, 600, 10)
+        arrive = (depart + runtime) % (24 * 60)
+        trains.append({
+            "trainumber": f"{prefix}{i}",
+            "departtime": f"{depart // 60:02d}:{depart % 60:02d}",
+            "arrivetime": f"{arrive // 60:02d}:{arrive % 60:02d}",
+            "runtime": f"{runtime // 60}小时{runtime % 60}分钟",
+            # 票价取值较少，制造各维度相同的并列方案
+            "ticket_info": [{"seatname": "二等座", "seatprice": rnd.choice([200, 250, 300, 350])}],
+        })
+    return trains
+
+
+def brute_force_frontier(stations):
+    """逐对枚举全部可行组合，再两两比较求帕累托前沿"""
+    points = []
+    for station, first_leg, second_leg in stations:
+        for train1 in first_leg:
+            arrival = _clock_minutes(train1["arrivetime"])
+            for train2 in second_leg:
+                depart = _clock_minutes(train2["departtime"])
+                for offset in (0, 24 * 60):
+                    transfer = depart + offset - arrival
+                    if MIN_TRANSFER <= transfer <= MAX_TRANSFER:
+                        points.append((_leg_runtime(train1) + transfer + _leg_runtime(train2),
+                                       _reference_price(train1) + _reference_price(train2),
+                                       -(transfer - MIN_TRANSFER)))
+
+    def dominated(point):
+        return any(other != point and all(o <= p for o, p in zip(other, point)) for other in points)
+
+    return points, sorted(point for point in points if not dominated(point))
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_frontier_matches_brute_force(seed):
+    rnd = random.Random(seed)
+    stations = [(f"中转{k}", random_leg(rnd, "G", 40), random_leg(rnd, "D", 40)) for k in range(3)]
+    ranker = TransferRanker(MIN_TRANSFER, MAX_TRANSFER, limit=5)
+    for station in stations:
+        ranker.add_station(*station)
+
+    candidates, expected = brute_force_frontier(stations)
+    assert ranker.candidates == len(candidates)
+    assert sorted(point for point, _ in ranker.frontier) == expected
+
+
+def test_top_routes_come_from_the_frontier():
+    rnd = random.Random(42)
+    ranker = TransferRanker(MIN_TRANSFER, MAX_TRANSFER, weights=(1.0, 1.0, 0.2), limit=3)
+    ranker.add_station("武汉", random_leg(rnd, "G", 60), random_leg(rnd, "D", 60))
+    routes = ranker.top()
+    assert 0 < len(routes) <= 3
+    frontier = {(point[0], point[1]) for point, _ in ranker.frontier}
+    for route in routes:
+        assert (route["total_runtime"], route["total_price"]) in frontier
+        assert MIN_TRANSFER <= route["transfer_time"] <= MAX_TRANSFER
+        assert route["transfer_station"] == "武汉"
+
+
+def test_no_connection():
+    leg = random_leg(random.Random(0), "G", 5)
+    ranker = TransferRanker(MIN_TRANSFER, MAX_TRANSFER)
+    ranker.add_station("武汉", leg, [])
+    assert ranker.top() == [] and ranker.candidates == 0
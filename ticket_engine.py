@@ -0,0 +1,3356 @@
+"""TicketQuery 查询引擎：车票API请求、缓存、限流、查询解析、筛选和中转方案搜索
+
+不导入 dify-on-wechat 的模块，插件（TicketQuery.py）、独立运行入口和基准脚本都通过这里的 TicketEngine 等类使用。
+"""
+import re
+import os
+import json
+import logging
+from datetime import datetime, timedelta
+from collections import defaultdict, namedtuple, Counter, OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from array import array
+from bisect import bisect_left, bisect_right
+import hashlib
+import heapq
+import random
+import sqlite3
+import sys
+import threading
+import time as time_module
+import traceback
+import unicodedata
+import zlib
+
+try:
+    from common.log import logger
+except ImportError:  # 作为库使用、没有dify-on-wechat时
+    logger = logging.getLogger("TicketQuery")
+
+# OpenAI默认配置
+DEFAULT_OPENAI_API_BASE = "https://api.openai.com/v1"  # 默认API基础URL
+DEFAULT_OPENAI_MODEL = "gpt-3.5-turbo"  # 默认模型
+DEFAULT_OPENAI_API_VERSION = "v1"  # 默认API版本
+
+# 可在config.json中调整的运行参数及默认值
+DEFAULT_TUNABLES = {
+    "page_size": 10,             # 每页显示条数
+    "time_window_minutes": 30,   # 近似时间（如"10:30左右"）的前后窗口（分钟）
+    "min_transfer_time": 30,     # 最小换乘时间（分钟）
+    "max_transfer_time": 180,    # 最大换乘时间（分钟）
+    "transfer_hub_count": 5,     # 无预定义中转站时使用的枢纽站数量
+    "transfer_weight_runtime": 1.0, # 中转方案排序权重：总耗时
+    "transfer_weight_price": 1.0,   # 中转方案排序权重：总票价
+    "transfer_weight_slack": 0.2,   # 中转方案排序权重：换乘余量（越大越偏好宽裕的换乘）
+    "transfer_result_limit": 10,    # 返回的中转方案数量
+    "llm_timeout": 30,           # LLM调用超时（秒）
+    "api_timeout": 15,           # 车票API调用超时（秒）
+    "parse_cache_size": 1024,    # 自然语言解析结果缓存条数（缓存在当天午夜失效）
+    "rule_parse_threshold": 0.8, # 本地规则解析置信度不低于该值时跳过LLM
+    "strict_station_check": True, # 站点词典中找不到的城市直接拒绝，不请求车票API（仅在加载了全量站点文件时生效）
+    "filter_prompt_token_budget": 3000, # AI筛选时单次提示中车次表格的token预算
+    "llm_max_workers": 4,        # 分块筛选时并发调用LLM的最大线程数
+    "plan_cache_size": 512,      # 筛选计划缓存条数
+    "plan_cache_ttl": 86400,     # 筛选计划缓存有效期（秒）
+    "ticket_cache_size": 256,    # 车票API结果缓存条数
+    "ticket_cache_ttl": 120,     # 高铁/动车查询结果的缓存有效期（秒），余票变化较快，不宜过长
+    "ticket_cache_stale": 300,   # 高铁/动车结果过期后仍可先返回旧结果（同时后台刷新）的时间（秒），0表示不使用旧结果
+    "normal_train_cache_ttl": 300,     # 普通列车查询结果的缓存有效期（秒）
+    "normal_train_cache_stale": 900,   # 普通列车结果过期后仍可先返回旧结果的时间（秒）
+    "negative_cache_ttl": 60,    # 查询失败或没有车次的线路在此时间（秒）内不再重复请求，0表示不缓存
+    "api_rate_limit": 5.0,       # 车票API每秒最多请求数（进程内共享，0表示不限流）
+    "api_burst": 10,             # 车票API允许的突发请求数
+    "api_queue_timeout": 10,     # 请求排队等待令牌的最长时间（秒），超时视为查询失败
+    "max_date_range_days": 15,   # 日期范围查询最多覆盖的天数
+    "date_range_workers": 4,     # 日期范围查询的并发请求数
+    "batch_workers": 4,          # TicketEngine.query_many的并发查询数
+    "async_reply": True,         # 耗时查询先回复"正在查询"，在后台线程执行后通过channel.send发送结果
+    "reply_workers": 4,          # 异步查询的并发线程数
+    "reply_queue_limit": 32,     # 排队和执行中的异步查询上限，超过时提示稍后再试
+    "session_limit": 1000,       # 同时保留查询结果的会话数上限
+    "session_ttl": 3600,         # 会话查询结果的保留时间（秒），过期后需重新查询
+    "query_budget": 8.0,         # 单条消息的总耗时预算（秒），LLM和车票API调用共用，0表示不限制
+    "watch_interval": 300,       # 余票订阅的轮询间隔（秒），同一线路不论多少人订阅只轮询一次
+    "watch_jitter": 0.2,         # 轮询间隔的随机抖动比例，避免多条线路同时请求
+    "watch_max_inflight": 2,     # 同时进行的订阅轮询数上限
+    "watch_max_per_session": 5,  # 每个会话最多的订阅数
+    "session_store": True,       # 把会话的查询结果保存到插件目录下的sessions/，重启后仍可翻页和筛选
+    "session_store_max_mb": 50,  # 会话快照的总大小上限（MB），超过时删除最旧的快照
+    "session_store_ttl": 86400,  # 会话快照的保留时间（秒）
+    "cache_backend": "memory",   # 缓存后端：memory为进程内缓存，sqlite为多个机器人进程共享的缓存
+    "cache_path": "",            # sqlite缓存文件路径，留空时使用插件目录下的cache.db
+}
+
+# 数值配置项的取值范围(最小值, 最大值)，None表示不限；超出范围时使用默认值
+TUNABLE_RANGES = {
+    "page_size": (1, None),
+    "time_window_minutes": (0, None),
+    "min_transfer_time": (0, None),
+    "max_transfer_time": (0, None),
+    "transfer_hub_count": (0, None),
+    "transfer_weight_runtime": (0, None),
+    "transfer_weight_price": (0, None),
+    "transfer_weight_slack": (0, None),
+    "transfer_result_limit": (1, None),
+    "llm_timeout": (1, None),
+    "api_timeout": (1, None),
+    "parse_cache_size": (1, None),
+    "rule_parse_threshold": (0, 1),
+    "filter_prompt_token_budget": (1, None),
+    "llm_max_workers": (1, None),
+    "plan_cache_size": (1, None),
+    "plan_cache_ttl": (0, None),
+    "ticket_cache_size": (1, None),
+    "ticket_cache_ttl": (0, None),
+    "ticket_cache_stale": (0, None),
+    "normal_train_cache_ttl": (0, None),
+    "normal_train_cache_stale": (0, None),
+    "negative_cache_ttl": (0, None),
+    "api_rate_limit": (0, None),
+    "api_burst": (1, None),
+    "api_queue_timeout": (0, None),
+    "max_date_range_days": (1, None),
+    "date_range_workers": (1, None),
+    "batch_workers": (1, None),
+    "reply_workers": (1, None),
+    "reply_queue_limit": (1, None),
+    "session_limit": (1, None),
+    "session_ttl": (1, None),
+    "query_budget": (0, None),
+    "watch_interval": (1, None),
+    "watch_jitter": (0, 0.9),
+    "watch_max_inflight": (1, None),
+    "watch_max_per_session": (1, None),
+    "session_store_max_mb": (1, None),
+    "session_store_ttl": (1, None),
+}
+
+# 配置文件变化检查间隔（秒）
+CONFIG_CHECK_INTERVAL = 2.0
+
+# 预定义热门中转站映射
+TRANSFER_STATIONS = {
+    # 格式：("出发城市", "目的城市"): ["中转站1", "中转站2", ...]
+    ("成都", "上海"): ["武汉", "郑州", "南京"],
+    ("北京", "广州"): ["郑州", "武汉", "长沙"],
+    ("西安", "上海"): ["郑州", "合肥"],
+    ("北京", "成都"): ["郑州", "西安"],
+    ("广州", "北京"): ["武汉", "郑州"],
+    ("上海", "成都"): ["武汉", "重庆"],
+    ("深圳", "北京"): ["长沙", "武汉", "郑州"],
+    ("重庆", "上海"): ["武汉", "合肥"],
+    ("杭州", "成都"): ["武汉", "重庆"],
+    ("成都", "杭州"): ["重庆", "武汉"]
+}
+
+# 全国主要铁路枢纽站（用于动态计算中转）
+MAJOR_STATIONS = [
+    "北京", "上海", "广州", "深圳", "杭州", "南京", "武汉", 
+    "郑州", "西安", "成都", "重庆", "长沙", "合肥", "济南",
+    "天津", "沈阳", "哈尔滨", "太原", "兰州", "南昌", "昆明",
+    "福州", "厦门", "宁波", "青岛", "大连", "贵阳"
+]
+
+
+
+class PluginConfig:
+    """插件配置快照，创建后不再修改；配置变化时由ConfigWatcher整体替换"""
+
+    __slots__ = ("use_openai", "api_key", "api_base", "model", "api_version") + tuple(DEFAULT_TUNABLES)
+
+    def __init__(self, api_key=None, api_base=DEFAULT_OPENAI_API_BASE, model=DEFAULT_OPENAI_MODEL,
+                 api_version=DEFAULT_OPENAI_API_VERSION, **tunables):
+        values = {
+            "use_openai": bool(api_key),
+            "api_key": api_key,
+            "api_base": api_base,
+            "model": model,
+            "api_version": api_version,
+        }
+        for name, default in DEFAULT_TUNABLES.items():
+            value = tunables.get(name, default)
+            if isinstance(default, bool) and isinstance(value, str):
+                value = value.strip().lower() in ("1", "true", "yes", "on")
+            try:
+                values[name] = type(default)(value)
+            except (TypeError, ValueError):
+                logger.warning(f"配置项{name}的值无效: {value}，使用默认值{default}")
+                values[name] = default
+                continue
+            low, high = TUNABLE_RANGES.get(name, (None, None))
+            # 写成not (low <= x)，NaN也视为超出范围
+            if (low is not None and not low <= values[name]) or (high is not None and not values[name] <= high):
+                logger.warning(f"配置项{name}的值超出范围: {value}，使用默认值{default}")
+                values[name] = default
+        if values["min_transfer_time"] > values["max_transfer_time"]:
+            logger.warning(f"最小换乘时间{values['min_transfer_time']}大于最大换乘时间{values['max_transfer_time']}，"
+                           f"使用默认值")
+            values["min_transfer_time"] = DEFAULT_TUNABLES["min_transfer_time"]
+            values["max_transfer_time"] = DEFAULT_TUNABLES["max_transfer_time"]
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PluginConfig是只读快照，请通过ConfigWatcher重新加载")
+
+    @classmethod
+    def from_dict(cls, plugin_config, global_config=None):
+        """由插件配置构建快照，插件配置中没有API密钥时使用全局配置中的OpenAI设置"""
+        tunables = {k: plugin_config[k] for k in DEFAULT_TUNABLES if k in plugin_config}
+        
+        api_key = plugin_config.get("open_ai_api_key")
+        if api_key:
+            api_base = plugin_config.get("open_ai_api_base") or DEFAULT_OPENAI_API_BASE
+            api_version = plugin_config.get("open_ai_api_version", DEFAULT_OPENAI_API_VERSION)
+            # 检查API基础URL是否已包含API版本，不包含则补上（但不重复添加）
+            if not api_base.endswith(f"/{api_version}"):
+                if not api_base.endswith("/"):
+                    api_base += "/"
+                if not api_base.endswith(f"{api_version}/"):
+                    api_base += f"{api_version}"
+            return cls(api_key, api_base, plugin_config.get("open_ai_model", DEFAULT_OPENAI_MODEL),
+                       api_version, **tunables)
+        
+        if global_config is not None and global_config.get("open_ai_api_key"):
+            logger.info("插件配置中未找到OpenAI API密钥，使用全局配置")
+            return cls(global_config.get("open_ai_api_key"),
+                       global_config.get("open_ai_api_base") or DEFAULT_OPENAI_API_BASE,
+                       global_config.get("open_ai_model", DEFAULT_OPENAI_MODEL),
+                       **tunables)
+        
+        logger.warning("未找到有效的OpenAI API密钥")
+        return cls(**tunables)
+
+
+class ConfigWatcher:
+    """监视config.json的修改时间，变化时重新加载并原子替换配置快照
+
+    读取方直接使用current()返回的快照，无需加锁，也不会修改任何全局状态。
+    """
+
+    def __init__(self, config_path, check_interval=CONFIG_CHECK_INTERVAL):
+        self.config_path = config_path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._next_check = 0.0
+        self._snapshot = self._load()
+
+    def current(self):
+        """返回当前配置快照，到达检查间隔时顺带检查文件是否被修改"""
+        if time_module.monotonic() >= self._next_check:
+            self._check()
+        return self._snapshot
+
+    def _check(self):
+        # 只允许一个线程执行检查，其余线程继续使用旧快照
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = time_module.monotonic() + self.check_interval
+            mtime = self._stat_mtime()
+            if mtime != self._mtime:
+                logger.info(f"检测到配置文件变化，重新加载: {self.config_path}")
+                self._snapshot = self._load()
+        finally:
+            self._lock.release()
+
+    def _stat_mtime(self):
+        try:
+            return os.stat(self.config_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load(self):
+        self._mtime = self._stat_mtime()
+        plugin_config = {}
+        if self._mtime is not None:
+            try:
+                with open(self.config_path, 'r', encoding='utf-8') as f:
+                    plugin_config = json.load(f)
+            except Exception as e:
+                logger.error(f"配置文件读取失败: {e}")
+                # 文件写到一半或格式错误时保留旧快照
+                if getattr(self, "_snapshot", None) is not None:
+                    return self._snapshot
+        else:
+            logger.warning(f"插件配置文件不存在: {self.config_path}")
+        
+        global_config = None
+        if not plugin_config.get("open_ai_api_key"):
+            try:
+                from config import conf
+                global_config = conf()
+                if not hasattr(global_config, "get"):
+                    global_config = None
+            except Exception as e:
+                logger.warning(f"加载全局OpenAI配置失败: {e}")
+        
+        snapshot = PluginConfig.from_dict(plugin_config, global_config)
+        logger.info(f"配置加载完成，OpenAI状态: {'已启用' if snapshot.use_openai else '未启用'}, "
+                    f"模型: {snapshot.model}, 每页条数: {snapshot.page_size}")
+        return snapshot
+
+
+class CacheBackend:
+    """缓存后端接口
+
+    进程内的TTLCache和多进程共享的SQLiteCache实现同一组方法，插件中的车票、LLM解析、筛选计划缓存
+    通过cache_backend配置选择实现。过期（ttl/expire_at）、旧值保留（stale）和命中统计的语义相同。
+    """
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def get_stale(self, key, default=None):
+        """返回(值, 是否已过期)"""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None, expire_at=None, cost=0.0, stale=0):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def hit_ratio(self):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+
+class TTLCache(CacheBackend):
+    """线程安全的LRU缓存，每个条目有独立的过期时间（时间戳），并统计命中率
+
+    写入时可以附带该结果的获取成本（秒），命中时累计为节省的时间。
+    写入时指定stale后，条目过期后仍保留stale秒，期间get_stale可以取到旧值（stale-while-revalidate）。
+    """
+
+    def __init__(self, name, max_size=1024, default_ttl=300):
+        self.name = name
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self._data = OrderedDict()  # key -> (过期时间戳, 值, 获取成本, 旧值保留截止时间戳)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def get(self, key, default=None):
+        return self._lookup(key, default, allow_stale=False)[0]
+
+    def get_stale(self, key, default=None):
+        """返回(值, 是否已过期)；过期但仍在保留期内的条目返回旧值，由调用方决定是否刷新"""
+        value, stale, _ = self._lookup(key, default, allow_stale=True)
+        return value, stale
+
+    def _lookup(self, key, default, allow_stale):
+        """返回(值, 是否已过期, 获取成本)，未命中时成本为0"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                now = time_module.time()
+                if entry[0] > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    self.saved_seconds += entry[2]
+                    return entry[1], False, entry[2]
+                if entry[3] > now:
+                    if allow_stale:
+                        self._data.move_to_end(key)
+                        self.stale_hits += 1
+                        self.saved_seconds += entry[2]
+                        return entry[1], True, entry[2]
+                else:
+                    del self._data[key]
+            self.misses += 1
+            return default, False, 0.0
+
+    def set(self, key, value, ttl=None, expire_at=None, cost=0.0, stale=0):
+        if expire_at is None:
+            expire_at = time_module.time() + (self.default_ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expire_at, value, cost, expire_at + stale)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def hit_ratio(self):
+        """命中率，返回旧值的命中也计算在内"""
+        total = self.hits + self.stale_hits + self.misses
+        return (self.hits + self.stale_hits) / total if total else 0.0
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "backend": "memory",
+            "size": len(self._data),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hit_ratio(), 4),
+            "saved_seconds": round(self.saved_seconds, 3),
+        }
+
+
+@lru_cache(maxsize=1)
+def _orjson():
+    """安装了orjson时用它解析JSON（比标准库快数倍），否则返回None改用标准库"""
+    try:
+        import orjson
+        return orjson
+    except ImportError:
+        return None
+
+
+def _json_loads(data):
+    """解析JSON文本（bytes或str）；orjson的解析错误同样是json.JSONDecodeError"""
+    fast = _orjson()
+    if fast is not None:
+        return fast.loads(data)
+    return json.loads(data)
+
+
+def _json_encode(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _json_decode(blob):
+    return _json_loads(blob)
+
+
+class SQLiteCache(CacheBackend):
+    """多进程共享的缓存：同一台机器上的多个机器人进程共用一个SQLite（WAL模式）文件
+
+    条目按namespace区分不同用途的缓存，值由encode/decode序列化（默认紧凑JSON）；
+    本进程读到的条目同时放入进程内缓存，有效期内重复读取不再访问数据库。
+    remote_hits统计由其他进程写入的条目的命中数，即多进程共享节省的请求。
+    数据库出错时按未命中处理，不影响查询。
+    """
+
+    PRUNE_EVERY = 100  # 每写入多少次清理一次过期和超出上限的条目
+
+    def __init__(self, name, path, max_size=1024, default_ttl=300, encode=_json_encode, decode=_json_decode):
+        self.name = name
+        self.path = path
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self._encode = encode
+        self._decode = decode
+        self._local = TTLCache(name, max_size=max_size, default_ttl=default_ttl)
+        self._connections = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.remote_hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.saved_seconds = 0.0
+        self._connect()
+
+    def _connect(self):
+        connection = getattr(self._connections, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entries ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB, expire_at REAL, stale_until REAL, "
+                "cost REAL, origin INTEGER, PRIMARY KEY (namespace, key)) WITHOUT ROWID")
+            connection.execute("CREATE INDEX IF NOT EXISTS cache_entries_expiry "
+                               "ON cache_entries (namespace, stale_until)")
+            self._connections.connection = connection
+        return connection
+
+    @staticmethod
+    def _key(key):
+        return json.dumps(key, ensure_ascii=False, separators=(",", ":"))
+
+    def _count(self, counter, seconds=0.0):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            self.saved_seconds += seconds
+
+    def get(self, key, default=None):
+        value, stale = self.get_stale(key, default)
+        return default if stale else value
+
+    def get_stale(self, key, default=None):
+        value, _, cost = self._local._lookup(key, None, allow_stale=False)
+        if value is not None:
+            self._count("hits", cost)
+            return value, False
+        
+        db_key = self._key(key)
+        try:
+            row = self._connect().execute(
+                "SELECT value, expire_at, stale_until, cost, origin FROM cache_entries WHERE namespace = ? AND key = ?",
+                (self.name, db_key)).fetchone()
+        except sqlite3.Error as e:
+            self._count("errors")
+            logger.warning(f"读取共享缓存失败（{self.name}）: {e}")
+            row = None
+        now = time_module.time()
+        if row is None or row[2] <= now:
+            self._count("misses")
+            return default, False
+        
+        blob, expire_at, stale_until, cost, origin = row
+        try:
+            value = self._decode(blob)
+        except Exception as e:
+            # 条目损坏或由不兼容的版本写入：按未命中处理并删除，之后由正常查询重新写入
+            self._count("errors")
+            self._count("misses")
+            logger.warning(f"解析共享缓存条目失败（{self.name}），已删除: {e}")
+            try:
+                self._connect().execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?",
+                                        (self.name, db_key))
+            except sqlite3.Error:
+                pass
+            return default, False
+        if origin != os.getpid():
+            self._count("remote_hits")
+        if expire_at > now:
+            self._local.set(key, value, expire_at=expire_at, cost=cost, stale=stale_until - expire_at)
+            self._count("hits", cost)
+            return value, False
+        self._count("stale_hits", cost)
+        return value, True
+
+    def set(self, key, value, ttl=None, expire_at=None, cost=0.0, stale=0):
+        if expire_at is None:
+            expire_at = time_module.time() + (self.default_ttl if ttl is None else ttl)
+        self._local.set(key, value, expire_at=expire_at, cost=cost, stale=stale)
+        try:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.name, self._key(key), self._encode(value), expire_at, expire_at + stale, cost, os.getpid()))
+            with self._lock:
+                self._writes += 1
+                prune = self._writes % self.PRUNE_EVERY == 0
+            if prune:
+                self._prune(connection)
+        except sqlite3.Error as e:
+            self._count("errors")
+            logger.warning(f"写入共享缓存失败（{self.name}）: {e}")
+
+    def _prune(self, connection):
+        """删除已过保留期的条目，条目数仍超过上限时删除最早过期的条目"""
+        connection.execute("DELETE FROM cache_entries WHERE namespace = ? AND stale_until <= ?",
+                           (self.name, time_module.time()))
+        excess = len(self) - self.max_size
+        if excess > 0:
+            connection.execute(
+                "DELETE FROM cache_entries WHERE namespace = ? AND key IN ("
+                "SELECT key FROM cache_entries WHERE namespace = ? ORDER BY expire_at LIMIT ?)",
+                (self.name, self.name, excess))
+
+    def clear(self):
+        self._local.clear()
+        try:
+            self._connect().execute("DELETE FROM cache_entries WHERE namespace = ?", (self.name,))
+        except sqlite3.Error as e:
+            logger.warning(f"清空共享缓存失败（{self.name}）: {e}")
+
+    def __len__(self):
+        try:
+            return self._connect().execute("SELECT COUNT(*) FROM cache_entries WHERE namespace = ?",
+                                           (self.name,)).fetchone()[0]
+        except sqlite3.Error:
+            return len(self._local)
+
+    def hit_ratio(self):
+        """命中率，返回旧值的命中也计算在内"""
+        total = self.hits + self.stale_hits + self.misses
+        return (self.hits + self.stale_hits) / total if total else 0.0
+
+    def stats(self):
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "name": self.name,
+            "backend": "sqlite",
+            "size": len(self),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "remote_hits": self.remote_hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_ratio": round(self.hit_ratio(), 4),
+            "remote_hit_ratio": round(self.remote_hits / lookups, 4) if lookups else 0.0,
+            "saved_seconds": round(self.saved_seconds, 3),
+        }
+
+
+WEEKDAY_NAMES = ['周一', '周二', '周三', '周四', '周五', '周六', '周日']
+
+
+@lru_cache(maxsize=4)
+def relative_dates(today):
+    """按日期缓存LLM提示中使用的相对日期信息（今天/明天/本周X/下周X），同一天内只计算一次"""
+    weekday_today = today.weekday()  # 0是周一，6是周日
+    fmt = lambda d: d.strftime("%Y-%m-%d")
+    # 本周/下周各天的日期，下标0->周一, 1->周二, ...
+    this_week = tuple(fmt(today + timedelta(days=i - weekday_today)) for i in range(7))
+    next_week = tuple(fmt(today + timedelta(days=i - weekday_today + 7)) for i in range(7))
+    context = {
+        "today": fmt(today),
+        "tomorrow": fmt(today + timedelta(days=1)),
+        "day_after_tomorrow": fmt(today + timedelta(days=2)),
+        "weekday": weekday_today,
+        "this_week": this_week,
+        "next_week": next_week,
+    }
+    lines = [
+        f"今天是 {context['today']}，是{WEEKDAY_NAMES[weekday_today]}",
+        f"明天是 {context['tomorrow']}",
+        f"后天是 {context['day_after_tomorrow']}",
+    ]
+    lines += [f"本{name}是 {date}" for name, date in zip(WEEKDAY_NAMES, this_week)]
+    lines += [f"下{name}是 {date}" for name, date in zip(WEEKDAY_NAMES, next_week)]
+    context["table"] = "\n            ".join(lines)
+    return context
+
+
+def seconds_until_midnight():
+    """距离今天结束的秒数，用于让依赖当天日期的缓存在午夜失效"""
+    now = datetime.now()
+    midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    return (midnight - now).total_seconds()
+
+
+def normalize_query(query):
+    """归一化查询文本（全半角、大小写、空白与标点），提高缓存命中率"""
+    text = unicodedata.normalize("NFKC", query).lower()
+    return re.sub(r"[\s,.!?;:'\"，。！？；：、“”‘’~～]+", "", text)
+
+
+# 插件自带的站点词典，以及可选的12306全量站点文件（station_name.js，放在插件目录下即可自动加载）
+STATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stations.txt")
+STATION_JS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "station_name.js")
+
+Station = namedtuple("Station", ["name", "city", "pinyin", "abbr"])
+
+
+class StationTrie:
+    """紧凑前缀树：每个节点是一个dict，键None处保存以该节点结尾的值"""
+
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def insert(self, key, value):
+        node = self.root
+        for char in key:
+            node = node.setdefault(char, {})
+        if None not in node:
+            node[None] = value
+            self.size += 1
+
+    def get(self, key):
+        node = self.root
+        for char in key:
+            node = node.get(char)
+            if node is None:
+                return None
+        return node.get(None)
+
+    def longest_match(self, text, start):
+        """从start开始做最长匹配，返回(结束位置, 值)，没有匹配时返回None"""
+        node = self.root
+        match = None
+        for index in range(start, len(text)):
+            node = node.get(text[index])
+            if node is None:
+                break
+            if None in node:
+                match = (index + 1, node[None])
+        return match
+
+
+class StationDictionary:
+    """站点/城市词典：支持站名、城市名、全拼、简拼和别名，自由文本中一次扫描按最长匹配提取"""
+
+    def __init__(self, stations=(), complete=False):
+        self.trie = StationTrie()
+        self.abbreviations = {}
+        self.cities = set()
+        # 是否包含12306全量站点；自带词典只有地级市和主要车站，找不到的名称未必无效
+        self.complete = complete
+        self._add_all(stations)
+
+    def _add_all(self, entries):
+        entries = list(entries)
+        # 拼音/简拼存在重名时（如"苏州""宿州"）不作为检索键，避免误匹配
+        pinyin_count = Counter(station.pinyin for station, _ in entries if station.pinyin)
+        abbr_count = Counter(station.abbr for station, _ in entries if station.abbr)
+        for station, aliases in entries:
+            self.cities.add(station.city)
+            keys = [station.name, f"{station.name}站"] + list(aliases)
+            if station.name == station.city:
+                keys.append(f"{station.name}市")
+            if station.pinyin and pinyin_count[station.pinyin] == 1:
+                keys.append(station.pinyin)
+            if station.abbr and abbr_count[station.abbr] == 1:
+                self.abbreviations.setdefault(station.abbr, station)
+            for key in keys:
+                self.trie.insert(key, station)
+
+    @classmethod
+    def load(cls, path=STATION_FILE, station_js_path=STATION_JS_FILE):
+        entries = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                name, city, syllables, aliases = (line.split("|") + [""] * 4)[:4]
+                syllables = syllables.split()
+                station = Station(name, city or name, "".join(syllables), "".join(s[0] for s in syllables))
+                entries.append((station, [alias for alias in aliases.split(",") if alias]))
+        
+        complete = bool(station_js_path and os.path.exists(station_js_path))
+        if complete:
+            # 12306站点文件格式：@bjb|北京北|VAP|beijingbei|bjb|0|0357|北京|||@...
+            with open(station_js_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+            known = {station.name for station, _ in entries}
+            for record in content.split("@")[1:]:
+                fields = record.split("|")
+                if len(fields) < 5 or fields[1] in known:
+                    continue
+                city = fields[7] if len(fields) > 7 and fields[7] else fields[1]
+                entries.append((Station(fields[1], city, fields[3], fields[4]), []))
+                known.add(fields[1])
+        
+        dictionary = cls(entries, complete=complete)
+        logger.info(f"站点词典加载完成: {dictionary.trie.size}个检索键, {len(dictionary.cities)}个城市, "
+                    f"{'全量站点' if complete else '仅自带词典'}")
+        return dictionary
+
+    def resolve(self, name):
+        """精确查找站名/城市/拼音/简拼/别名，返回Station或None"""
+        if not name:
+            return None
+        key = unicodedata.normalize("NFKC", name).strip().lower()
+        return self.trie.get(key) or self.abbreviations.get(key)
+
+    def extract(self, text):
+        """单次扫描自由文本，按最长匹配返回[(起始位置, 结束位置, Station)]"""
+        text = text.lower()
+        matches = []
+        index = 0
+        while index < len(text):
+            match = self.trie.longest_match(text, index)
+            # 拼音只在完整单词时匹配，避免"shanghaitrain"之外的误命中
+            if match and text[index].isascii() and (
+                    (index > 0 and text[index - 1].isalpha() and text[index - 1].isascii())
+                    or (match[0] < len(text) and text[match[0]].isalpha() and text[match[0]].isascii())):
+                match = None
+            if match:
+                matches.append((index, match[0], match[1]))
+                index = match[0]
+            else:
+                index += 1
+        return matches
+
+
+@lru_cache(maxsize=1)
+def load_station_dictionary():
+    """首次使用时加载站点词典，之后复用"""
+    return StationDictionary.load()
+
+
+# 车型同义词（按出现在查询中的关键词识别），顺序即匹配优先级
+TICKET_TYPE_SYNONYMS = [
+    ("高铁", ["高铁", "高速铁路", "高速列车", "G字头"]),
+    ("动车", ["动车", "动车组", "D字头"]),
+    ("普通", ["普通火车", "普通列车", "普快", "特快", "快车", "绿皮", "火车", "普通", "K字头", "T字头", "Z字头"]),
+]
+
+# 不带具体钟点时保留的时间段词，由_process_api_data换算为时间范围
+PERIOD_WORDS = {
+    "凌晨": "凌晨", "早上": "早上", "早晨": "早晨", "上午": "上午", "中午": "中午",
+    "下午": "下午", "傍晚": "傍晚", "晚上": "晚上", "夜晚": "夜晚", "夜里": "夜里", "今晚": "晚上",
+}
+
+# 规则无法可靠处理、需要交给LLM的模糊日期表达
+VAGUE_DATE_WORDS = ["周末", "月底", "月初", "月中", "下个月", "下月", "节", "假期", "过几天", "最近"]
+
+RELATIVE_DAYS = [("大后天", 3), ("后天", 2), ("明天", 1), ("明日", 1), ("今天", 0), ("今日", 0), ("今晚", 0)]
+
+CHINESE_DIGITS = {"零": 0, "一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5,
+                  "六": 6, "七": 7, "八": 8, "九": 9}
+
+
+def parse_chinese_number(text):
+    """解析0-59范围内的阿拉伯数字或中文数字（如"十"、"十二"、"二十五"）"""
+    if text.isdigit():
+        return int(text)
+    if "十" in text:
+        tens, _, ones = text.partition("十")
+        value = (CHINESE_DIGITS.get(tens, 0) if tens else 1) * 10
+        return value + (CHINESE_DIGITS.get(ones, 0) if ones else 0)
+    return CHINESE_DIGITS.get(text)
+
+
+class RuleQueryParser:
+    """基于规则的本地查询解析器，解析直达和中转查询，并给出置信度
+
+    置信度足够高时可跳过LLM；城市从词典中按最长匹配提取。
+    """
+
+    NUM = r"[0-9零一二两三四五六七八九十]{1,3}"
+    ABS_DATE = re.compile(r"(\d{4})[-/.年](\d{1,2})[-/.月](\d{1,2})[日号]?")
+    MONTH_DAY = re.compile(r"(\d{1,2})月(\d{1,2})[日号]")
+    WEEKDAY = re.compile(r"(下下|下|这|本)?(?:周|星期|礼拜)([一二三四五六日天])")
+    CLOCK = re.compile(r"(\d{1,2})[:：](\d{2})")
+    # "时"前不能是"小"：时长（"3小时内""两个小时"）不是钟点
+    HOUR = re.compile(r"(" + NUM + r")(?:点|(?<!小)时)(半|一刻|三刻|(" + NUM + r")分?)?")
+    TRANSFER_PREFIX = ("途经", "经由", "经过", "经")
+    TRANSFER_SUFFIX = ("中转", "换乘")
+    FROM_PREFIX = ("从", "由", "自")
+    TO_PREFIX = ("到", "去", "至", "往", "抵", "→", "->", "开往", "前往", "发往", "回")
+    FROM_SUFFIX = ("出发", "始发", "发车", "到", "去", "至", "开往", "发往", "→", "->", "-")
+    APPROX_WORDS = ["左右", "前后", "附近"]
+    AFTER_WORDS = ("之后", "以后", "后")
+    BEFORE_WORDS = ("之前", "以前", "前")
+
+    def __init__(self, station_dictionary):
+        self.stations = station_dictionary
+
+    def find_cities(self, text):
+        """返回文本中出现的站点/城市列表[(起始位置, 结束位置, 所属城市)]"""
+        return [(start, end, station.city) for start, end, station in self.stations.extract(text)]
+
+    def parse(self, query, today=None):
+        """解析查询，返回包含车型、城市、日期、时间、中转站及置信度的字典；找不到两个城市时返回None"""
+        today = today or datetime.now().date()
+        text = unicodedata.normalize("NFKC", query).replace("+", " ")
+        confidence = 0.0
+
+        # 1. 车型
+        ticket_type = None
+        for standard, words in TICKET_TYPE_SYNONYMS:
+            if any(word in text for word in words):
+                ticket_type = standard
+                break
+        confidence += 0.15 if ticket_type else 0.05
+        ticket_type = ticket_type or "高铁"
+
+        # 2. 日期（识别后从文本中抹去，避免与时间、城市混淆）
+        date, text, date_explicit = self._extract_date(text, today)
+        if any(word in text for word in VAGUE_DATE_WORDS):
+            confidence -= 0.4
+        elif date_explicit or not re.search(r"\d+[日号]", text):
+            confidence += 0.1
+
+        # 3. 时间
+        time, text = self._extract_time(text)
+        query_text = text
+
+        # 4. 站点/城市（"经武汉""在郑州中转"中的城市为中转站）
+        transfer_station = None
+        cities = []
+        for start, end, city in self.find_cities(text):
+            if not transfer_station and (text[:start].endswith(self.TRANSFER_PREFIX)
+                                         or text[end:].lstrip("站 ").startswith(self.TRANSFER_SUFFIX)):
+                transfer_station = city
+            else:
+                cities.append((start, end, city))
+            text = text[:start] + " " * (end - start) + text[end:]
+
+        # 5. 出发地和目的地
+        from_loc, to_loc, explicit = self._assign_direction(query_text, cities)
+        if not from_loc or not to_loc or from_loc == to_loc:
+            return None
+        confidence += 0.6
+        confidence += 0.15 if explicit else 0.1
+        if len({city for _, _, city in cities}) > 2:
+            confidence -= 0.3
+
+        # 未被识别的数字（如"3号车厢"）说明还有规则没覆盖的信息
+        if re.search(r"\d", re.sub(r"[A-Za-z]\d+", "", text)):
+            confidence -= 0.2
+
+        return {
+            "ticket_type": ticket_type,
+            "from_loc": from_loc,
+            "to_loc": to_loc,
+            "date": date,
+            "time": time,
+            "transfer_station": transfer_station,
+            "confidence": round(max(0.0, min(confidence, 1.0)), 2),
+        }
+
+    def _extract_date(self, text, today):
+        fmt = lambda d: d.strftime("%Y-%m-%d")
+
+        def blank(match):
+            return text[:match.start()] + " " * (match.end() - match.start()) + text[match.end():]
+
+        match = self.ABS_DATE.search(text)
+        if match:
+            try:
+                date = datetime(int(match.group(1)), int(match.group(2)), int(match.group(3))).date()
+                return fmt(date), blank(match), True
+            except ValueError:
+                pass
+
+        match = self.MONTH_DAY.search(text)
+        if match:
+            try:
+                date = datetime(today.year, int(match.group(1)), int(match.group(2))).date()
+                if date < today:
+                    date = date.replace(year=today.year + 1)
+                return fmt(date), blank(match), True
+            except ValueError:
+                pass
+
+        match = self.WEEKDAY.search(text)
+        if match:
+            weekday = "一二三四五六日天".index(match.group(2))
+            weekday = min(weekday, 6)  # "天"与"日"相同
+            week_offset = {"下下": 14, "下": 7}.get(match.group(1), 0)
+            date = today + timedelta(days=weekday - today.weekday() + week_offset)
+            if not match.group(1) and date < today:
+                # 单说"周一"且本周一已过，指下一个周一
+                date += timedelta(days=7)
+            return fmt(date), blank(match), True
+
+        for word, offset in RELATIVE_DAYS:
+            index = text.find(word)
+            if index >= 0:
+                # "今晚"同时表示时间段，保留在文本中供时间解析
+                if word != "今晚":
+                    text = text[:index] + " " * len(word) + text[index + len(word):]
+                return fmt(today + timedelta(days=offset)), text, True
+
+        return fmt(today), text, False
+
+    def _extract_time(self, text):
+        period = next((word for word in PERIOD_WORDS if word in text), None)
+        hour = minute = None
+
+        match = self.CLOCK.search(text)
+        if match:
+            hour, minute = int(match.group(1)), int(match.group(2))
+        else:
+            match = self.HOUR.search(text)
+            if match:
+                hour = parse_chinese_number(match.group(1))
+                suffix = match.group(2) or ""
+                if suffix == "半":
+                    minute = 30
+                elif suffix == "一刻":
+                    minute = 15
+                elif suffix == "三刻":
+                    minute = 45
+                else:
+                    minute = parse_chinese_number(match.group(3)) if match.group(3) else 0
+
+        bound = ""
+        if match:
+            # 紧跟在钟点后的"之后""以前"等表示单侧时间范围（"前往""前后"不算）
+            tail = text[match.end():]
+            word = next((w for w in self.AFTER_WORDS if tail.startswith(w)), None)
+            if word:
+                bound = "之后"
+            elif not tail.startswith(("前往", "前后")):
+                word = next((w for w in self.BEFORE_WORDS if tail.startswith(w)), None)
+                bound = "之前" if word else ""
+            end = match.end() + len(word or "")
+            text = text[:match.start()] + " " * (end - match.start()) + text[end:]
+        if period:
+            text = text.replace(period, " " * len(period))
+
+        if hour is None or minute is None or hour > 24 or minute > 59:
+            return (PERIOD_WORDS[period] if period else None), text
+
+        # 12小时制转24小时制
+        if period in ("下午", "傍晚", "晚上", "夜晚", "夜里", "今晚") and hour < 12:
+            hour += 12
+        elif period == "中午" and hour < 6:
+            hour += 12
+        hour %= 24
+        return f"{hour:02d}:{minute:02d}{bound}", text
+
+    def _assign_direction(self, text, cities):
+        """根据"从""到""出发"等方向词确定出发地和目的地，没有方向词时按出现顺序"""
+        from_loc = to_loc = None
+        explicit = False
+        for start, end, name in cities:
+            before = text[:start].rstrip()
+            after = text[end:].lstrip()
+            if before.endswith(self.FROM_PREFIX) and not from_loc:
+                from_loc, explicit = name, True
+            elif before.endswith(self.TO_PREFIX) and not to_loc:
+                to_loc, explicit = name, True
+            elif after.startswith(self.FROM_SUFFIX) and not from_loc:
+                from_loc, explicit = name, True
+
+        remaining = [name for _, _, name in cities if name not in (from_loc, to_loc)]
+        if not from_loc and remaining:
+            from_loc = remaining.pop(0)
+        if not to_loc and remaining:
+            to_loc = remaining.pop(0)
+        return from_loc, to_loc, explicit
+
+
+# LLM筛选提示中表格的列分隔符
+TABLE_DELIMITER = "|"
+
+
+@lru_cache(maxsize=1)
+def _token_encoder():
+    """安装了tiktoken时使用其分词器精确计数，否则返回None改用估算"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+
+def estimate_tokens(text):
+    """估算文本的token数：中日韩字符约1个token，其余字符约4个一个token"""
+    encoder = _token_encoder()
+    if encoder is not None:
+        return len(encoder.encode(text))
+    cjk = sum(1 for ch in text if "\u2e80" <= ch <= "\u9fff" or "\uf900" <= ch <= "\uffef")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _runtime_minutes(runtime):
+    """把"4小时31分钟"、"04:31"之类的运行时长转换为分钟数，无法识别时返回原值"""
+    if runtime is None or isinstance(runtime, (int, float)):
+        return runtime
+    match = re.match(r"\s*(?:(\d+)小时)?\s*(?:(\d+)分钟?)?\s*$", runtime)
+    if match and (match.group(1) or match.group(2)):
+        return int(match.group(1) or 0) * 60 + int(match.group(2) or 0)
+    match = re.match(r"\s*(\d+):(\d{2})\s*$", runtime)
+    if match:
+        return int(match.group(1)) * 60 + int(match.group(2))
+    return runtime
+
+
+def _table_cell(value):
+    """表格单元格：空值留空，去掉会破坏表格结构的分隔符和换行"""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return f"{value:g}"
+    return str(value).replace(TABLE_DELIMITER, "/").replace("\n", " ")
+
+
+def _seat_columns(seat_lists):
+    """按首次出现的顺序收集座位类型，作为表格的列"""
+    columns = OrderedDict()
+    for seats in seat_lists:
+        for seat in seats or []:
+            if seat.get("seatname"):
+                columns[seat["seatname"]] = None
+    return list(columns)
+
+
+def _seat_cells(seats, columns):
+    """每种座位一个单元格，内容为"票价/余票"，该车次没有的座位留空"""
+    by_name = {seat.get("seatname"): seat for seat in seats or []}
+    cells = []
+    for name in columns:
+        seat = by_name.get(name)
+        cells.append(f"{_table_cell(seat.get('seatprice'))}/{_table_cell(seat.get('seatinventory'))}" if seat else "")
+    return cells
+
+
+def encode_train_table(indexed_trains):
+    """把(序号, 车次)列表编码为紧凑表格，返回(表头, [(序号, 行文本)])
+
+    相比逐条JSON，字段名只在表头出现一次，座位类型作为列，提示长度可缩小数倍。
+    """
+    columns = _seat_columns(train.get("ticket_info") for _, train in indexed_trains)
+    header = ["序号", "车次", "类型", "出发站", "到达站", "发车", "到达", "历时(分)"] + columns
+    lines = []
+    for index, train in indexed_trains:
+        cells = [index, train.get("trainumber"), train.get("traintype"),
+                 train.get("departstation"), train.get("arrivestation"),
+                 train.get("departtime"), train.get("arrivetime"), _runtime_minutes(train.get("runtime"))]
+        cells = [_table_cell(cell) for cell in cells] + _seat_cells(train.get("ticket_info"), columns)
+        lines.append((index, TABLE_DELIMITER.join(cells)))
+    return TABLE_DELIMITER.join(header), lines
+
+
+def encode_transfer_table(indexed_routes):
+    """把(序号, 中转方案)列表编码为紧凑表格，两程的座位类型分别作为列"""
+    first_columns = _seat_columns(route.get("first_leg", {}).get("ticket_info") for _, route in indexed_routes)
+    second_columns = _seat_columns(route.get("second_leg", {}).get("ticket_info") for _, route in indexed_routes)
+    header = (["序号", "中转站", "总价", "总历时(分)", "换乘(分)",
+               "一程车次", "一程类型", "出发站", "一程发车", "一程到达"]
+              + [f"一程{name}" for name in first_columns]
+              + ["二程车次", "二程类型", "二程发车", "二程到达", "到达站"]
+              + [f"二程{name}" for name in second_columns])
+    lines = []
+    for index, route in indexed_routes:
+        first_leg = route.get("first_leg", {})
+        second_leg = route.get("second_leg", {})
+        cells = ([_table_cell(cell) for cell in (
+                     index, route.get("transfer_station"), route.get("total_price"),
+                     route.get("total_runtime"), route.get("transfer_time"),
+                     first_leg.get("trainumber"), first_leg.get("traintype"), first_leg.get("departstation"),
+                     first_leg.get("departtime"), first_leg.get("arrivetime"))]
+                 + _seat_cells(first_leg.get("ticket_info"), first_columns)
+                 + [_table_cell(cell) for cell in (
+                     second_leg.get("trainumber"), second_leg.get("traintype"), second_leg.get("departtime"),
+                     second_leg.get("arrivetime"), second_leg.get("arrivestation"))]
+                 + _seat_cells(second_leg.get("ticket_info"), second_columns))
+        lines.append((index, TABLE_DELIMITER.join(cells)))
+    return TABLE_DELIMITER.join(header), lines
+
+
+def pack_table(header, lines, token_budget):
+    """按token预算把表格行切分成若干块，每块都带表头
+
+    返回[(序号列表, 表格文本, 估算token数)]；单行超出预算时也至少放入一行。
+    """
+    header_tokens = estimate_tokens(header) + 1
+    chunks = []
+    indices, texts, tokens = [], [header], header_tokens
+    for index, line in lines:
+        line_tokens = estimate_tokens(line) + 1
+        if indices and tokens + line_tokens > token_budget:
+            chunks.append((indices, "\n".join(texts), tokens))
+            indices, texts, tokens = [], [header], header_tokens
+        indices.append(index)
+        texts.append(line)
+        tokens += line_tokens
+    if indices:
+        chunks.append((indices, "\n".join(texts), tokens))
+    return chunks
+
+
+# 分块筛选合并后需要在本地统一排序的意图：(关键词, 排序键, 是否倒序, 说明)
+# 每个分块只能看到部分数据，"最便宜""最晚"等全局顺序必须在合并后重新计算
+RESULT_ORDERINGS = [
+    (("最便宜", "价格最低", "最低价", "便宜"), "price", False, "价格从低到高"),
+    (("最贵", "价格最高"), "price", True, "价格从高到低"),
+    (("最快", "时间最短", "耗时最少", "历时最短", "最短", "总时长"), "runtime", False, "耗时从短到长"),
+    (("最早", "首班", "早一点"), "depart", False, "出发时间从早到晚"),
+    (("最晚", "末班", "最后一班", "晚一点"), "depart", True, "出发时间从晚到早"),
+]
+
+# 表示只要"最X"那一班的关键词；问题中带数量（如"最便宜的三班"）时保留全部排序结果
+SUPERLATIVE_WORDS = ("最", "首班", "末班")
+RESULT_COUNT_PATTERN = re.compile(r"(前|[0-9几两二三四五六七八九十])\s*[个班趟条辆]|几班|哪些")
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _clock_minutes(clock):
+    """把"HH:MM"转换为当天分钟数"""
+    try:
+        hour, minute = str(clock).split(":")[:2]
+        return int(hour) * 60 + int(minute)
+    except (TypeError, ValueError):
+        return None
+
+
+# 时间段词对应的发车时间范围（分钟，含两端）
+DEPARTURE_PERIODS = {
+    "上午": (6 * 60, 12 * 60), "早上": (6 * 60, 12 * 60), "早晨": (6 * 60, 12 * 60), "凌晨": (6 * 60, 12 * 60),
+    "中午": (11 * 60, 13 * 60),
+    "下午": (12 * 60, 18 * 60),
+    "傍晚": (17 * 60, 19 * 60),
+    "晚上": (18 * 60, 23 * 60 + 59), "夜晚": (18 * 60, 23 * 60 + 59), "夜里": (18 * 60, 23 * 60 + 59),
+}
+
+# 查询时间："10:30"、"10:30左右"（近似时间），"14:00之后"、"8:00之前"（单侧范围）
+DEPARTURE_TIME_PATTERN = re.compile(r"^(\d{1,2})[:：](\d{2})\s*(之后|以后|后|之前|以前|前)?")
+
+
+@lru_cache(maxsize=256)
+def parse_departure_window(query_time, window_minutes=30):
+    """把查询时间换算为发车时间范围(起始分钟, 结束分钟)，含两端，None表示该侧不限；
+    没有时间条件或无法识别时返回None（不按时间筛选）"""
+    if not query_time:
+        return None
+    if query_time in DEPARTURE_PERIODS:
+        return DEPARTURE_PERIODS[query_time]
+    match = DEPARTURE_TIME_PATTERN.match(query_time.strip())
+    if not match:
+        return None
+    hour, minute, bound = int(match.group(1)), int(match.group(2)), match.group(3)
+    if hour > 23 or minute > 59:
+        return None
+    minutes = hour * 60 + minute
+    if bound in ("之后", "以后", "后"):
+        return minutes, None
+    if bound:
+        return None, minutes
+    return max(0, minutes - window_minutes), minutes + window_minutes
+
+
+class DepartureIndex:
+    """一条线路查询结果的发车时间索引：按车型分组，车次按发车分钟升序保存，另存分钟数组
+
+    时间段、近似时间和"某时之后"都是发车分钟上的区间，用二分查找定位，耗时O(log n + k)；
+    索引随车票缓存复用，同一线路换不同时间条件重复查询时不再逐条解析发车时间。
+    发车时间无法解析的车次不参与区间查找，总是保留（与逐条筛选时"格式错误不筛选"一致）。
+    """
+
+    def __init__(self, trains):
+        timed = defaultdict(list)
+        untimed = defaultdict(list)
+        for order, train in enumerate(trains):
+            minutes = _clock_minutes(train.get("departtime"))
+            if minutes is None or not 0 <= minutes < 24 * 60:
+                untimed[train.get("traintype")].append(train)
+            else:
+                timed[train.get("traintype")].append((minutes, order, train))
+        self.minutes = {}   # 车型 -> array('H')，升序的发车分钟
+        self.trains = {}    # 车型 -> 与minutes对应的车次
+        for train_type, entries in timed.items():
+            entries.sort(key=lambda entry: entry[:2])
+            self.minutes[train_type] = array("H", (entry[0] for entry in entries))
+            self.trains[train_type] = [entry[2] for entry in entries]
+        self.untimed = dict(untimed)
+        self.size = len(trains)
+
+    def window(self, train_type, start=None, end=None):
+        """该车型发车分钟在[start, end]内的车次（按发车时间升序），None表示该侧不限"""
+        minutes = self.minutes.get(train_type)
+        result = []
+        if minutes:
+            low = 0 if start is None else bisect_left(minutes, start)
+            high = len(minutes) if end is None else bisect_right(minutes, end)
+            result = self.trains[train_type][low:high]
+        return result + self.untimed.get(train_type, [])
+
+
+def train_order_keys(question):
+    """直达车次的排序键；问题里提到某种座位时按该座位的票价排序"""
+    def price(train):
+        seats = train.get("ticket_info") or []
+        named = [seat for seat in seats if seat.get("seatname") and seat["seatname"] in question]
+        prices = [_to_float(seat.get("seatprice")) for seat in (named or seats)]
+        prices = [value for value in prices if value is not None]
+        return min(prices) if prices else None
+
+    def runtime(train):
+        minutes = _runtime_minutes(train.get("runtime"))
+        return minutes if isinstance(minutes, (int, float)) else None
+
+    return {"price": price, "runtime": runtime, "depart": lambda train: _clock_minutes(train.get("departtime"))}
+
+
+def transfer_order_keys(question):
+    """中转方案的排序键"""
+    return {
+        "price": lambda route: _to_float(route.get("total_price")),
+        "runtime": lambda route: _to_float(route.get("total_runtime")),
+        "depart": lambda route: _clock_minutes(route.get("first_leg", {}).get("departtime")),
+    }
+
+
+def order_filtered_results(items, question, order_keys):
+    """按问题中的排序意图对合并后的结果（ResultView）做全局排序
+
+    "最X"类问题只保留并列第一的结果；没有排序意图时保持原顺序。缺少排序字段的条目排在最后。
+    """
+    for keywords, key_name, reverse, label in RESULT_ORDERINGS:
+        matched = next((word for word in keywords if word in question), None)
+        if not matched:
+            continue
+        key = order_keys[key_name]
+        ordered = items.sort(key, reverse=reverse)
+        if ordered and matched.startswith(SUPERLATIVE_WORDS) and not RESULT_COUNT_PATTERN.search(question):
+            best = key(ordered[0])
+            if best is not None:
+                ordered = ordered.filter(lambda item: key(item) == best)
+        logger.info(f"按'{matched}'对{len(items)}条结果全局排序（{label}），保留{len(ordered)}条")
+        return ordered
+    return items
+
+
+def parse_matched_indices(result_text, result_key, shown):
+    """从LLM返回中提取匹配序号，只保留本块提示中出现过的序号；无法解析时返回None"""
+    if not result_text:
+        return None
+    text = result_text.strip()
+    if text.startswith("```"):
+        match = re.search(r"```(?:json)?\s*([\s\S]*?)```", text)
+        if match:
+            text = match.group(1).strip()
+    try:
+        indices = json.loads(text).get(result_key, [])
+    except (json.JSONDecodeError, AttributeError):
+        # JSON不完整时尝试直接提取索引数组
+        match = re.search(rf"{result_key}.*?(\[.*?\])", text, re.DOTALL)
+        if not match:
+            return None
+        try:
+            indices = json.loads(match.group(1).replace("'", '"'))
+        except json.JSONDecodeError:
+            return None
+    result = []
+    for index in indices if isinstance(indices, list) else []:
+        try:
+            index = int(index)
+        except (TypeError, ValueError):
+            continue
+        if index in shown and index not in result:
+            result.append(index)
+    return result
+
+
+def inventory_count(value):
+    """余票数量，兼容"有""无""候补"等文字"""
+    if isinstance(value, (int, float)):
+        return value
+    text = str(value or "").strip()
+    if text.isdigit():
+        return int(text)
+    return 99 if text == "有" else 0
+
+
+def _seat_values(seats, seat_name, field):
+    """取指定座位（名称互相包含即可，如"二等"匹配"二等座"）的票价或余票；未指定座位时取全部座位"""
+    if seat_name:
+        seats = [seat for seat in seats or [] if seat.get("seatname")
+                 and (seat_name in seat["seatname"] or seat["seatname"] in seat_name)]
+    if field == "price":
+        values = [_to_float(seat.get("seatprice")) for seat in seats or []]
+    else:
+        values = [inventory_count(seat.get("seatinventory")) for seat in seats or []]
+    return [value for value in values if value is not None]
+
+
+def _train_seat_price(train, seat_name):
+    prices = _seat_values(train.get("ticket_info"), seat_name, "price")
+    return min(prices) if prices else None
+
+
+def _train_seat_inventory(train, seat_name):
+    counts = _seat_values(train.get("ticket_info"), seat_name, "inventory")
+    return max(counts) if counts else None
+
+
+def _route_seat_inventory(route, seat_name):
+    """中转方案的余票取两程中较少的一程"""
+    counts = [_train_seat_inventory(route.get(leg, {}), seat_name) for leg in ("first_leg", "second_leg")]
+    return None if None in counts else min(counts)
+
+
+# 筛选计划可用的字段：名称 -> (类型, 说明, 取值函数(条目, 座位名))
+PLAN_FIELDS = {
+    "train": {
+        "trainumber": ("str", "车次号，如G1", lambda t, s: t.get("trainumber")),
+        "traintype": ("str", "车型，如高铁、动车", lambda t, s: t.get("traintype")),
+        "departstation": ("str", "出发站", lambda t, s: t.get("departstation")),
+        "arrivestation": ("str", "到达站", lambda t, s: t.get("arrivestation")),
+        "departtime": ("time", "出发时间HH:MM", lambda t, s: t.get("departtime")),
+        "arrivetime": ("time", "到达时间HH:MM", lambda t, s: t.get("arrivetime")),
+        "runtime": ("num", "历时（分钟）", lambda t, s: _runtime_minutes(t.get("runtime"))),
+        "price": ("num", "票价（指定seat时为该座位，否则为最低票价）", _train_seat_price),
+        "inventory": ("num", "余票（指定seat时为该座位，否则为各座位最大值）", _train_seat_inventory),
+    },
+    "transfer": {
+        "transfer_station": ("str", "中转站", lambda r, s: r.get("transfer_station")),
+        "total_price": ("num", "总票价", lambda r, s: r.get("total_price")),
+        "total_runtime": ("num", "总历时（分钟）", lambda r, s: r.get("total_runtime")),
+        "transfer_time": ("num", "换乘等待时间（分钟）", lambda r, s: r.get("transfer_time")),
+        "first_trainumber": ("str", "第一程车次", lambda r, s: r.get("first_leg", {}).get("trainumber")),
+        "second_trainumber": ("str", "第二程车次", lambda r, s: r.get("second_leg", {}).get("trainumber")),
+        "departtime": ("time", "第一程出发时间HH:MM", lambda r, s: r.get("first_leg", {}).get("departtime")),
+        "arrivetime": ("time", "第二程到达时间HH:MM", lambda r, s: r.get("second_leg", {}).get("arrivetime")),
+        "inventory": ("num", "余票（两程中较少的一程，可指定seat）", _route_seat_inventory),
+    },
+}
+
+PLAN_OPERATORS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "in": lambda a, b: a in b,
+    "not_in": lambda a, b: a not in b,
+    "contains": lambda a, b: b in a,
+    "startswith": lambda a, b: a.startswith(b),
+}
+
+# 常见座位名称，写入计划提示中，使计划与具体查询结果无关、可以按问题缓存
+PLAN_SEAT_NAMES = ["商务座", "特等座", "一等座", "二等座", "高级软卧", "软卧", "动卧", "硬卧", "软座", "硬座", "无座"]
+
+
+class FilterPlan:
+    """LLM把筛选问题编译成的声明式计划：字段条件（且关系，any表示或关系）、排序键和条数限制
+
+    计划只依赖问题本身，在本地对全部查询结果执行，可以按问题缓存重复使用。
+    """
+
+    def __init__(self, kind, filters, sort, limit, spec=None):
+        self.kind = kind
+        self.filters = filters
+        self.sort = sort
+        self.limit = limit
+        self.spec = spec  # LLM返回的原始计划，用于在共享缓存中保存
+
+    @classmethod
+    def compile(cls, kind, plan):
+        """校验LLM返回的计划，字段或运算符不合法时抛出ValueError"""
+        if not isinstance(plan, dict):
+            raise ValueError("计划必须是JSON对象")
+        fields = PLAN_FIELDS[kind]
+
+        def compile_condition(condition):
+            if not isinstance(condition, dict):
+                raise ValueError(f"无效条件: {condition}")
+            if "any" in condition:
+                return ("any", [compile_condition(sub) for sub in condition["any"]])
+            field, op, value = condition.get("field"), condition.get("op"), condition.get("value")
+            if field not in fields:
+                raise ValueError(f"未知字段: {field}")
+            if op not in PLAN_OPERATORS:
+                raise ValueError(f"未知运算符: {op}")
+            if op in ("in", "not_in") and not isinstance(value, list):
+                value = [value]
+            return (field, op, cls._coerce(fields[field][0], value), condition.get("seat"))
+
+        filters = [compile_condition(condition) for condition in plan.get("filters") or []]
+        sort = []
+        for key in plan.get("sort") or []:
+            if not isinstance(key, dict) or key.get("field") not in fields:
+                raise ValueError(f"无效排序键: {key}")
+            sort.append((key["field"], key.get("seat"), str(key.get("order", "asc")).lower() == "desc"))
+        limit = plan.get("limit")
+        if limit is not None:
+            limit = int(limit)
+            if limit <= 0:
+                raise ValueError(f"无效条数限制: {limit}")
+        return cls(kind, filters, sort, limit, spec=plan)
+
+    @staticmethod
+    def _coerce(field_type, value):
+        """把计划中的比较值转换为字段类型：时间转为当天分钟数，数字转为浮点数"""
+        if isinstance(value, list):
+            return [FilterPlan._coerce(field_type, item) for item in value]
+        if field_type == "time":
+            minutes = _clock_minutes(value)
+            if minutes is None:
+                raise ValueError(f"无效时间: {value}")
+            return minutes
+        if field_type == "num":
+            number = _to_float(value)
+            if number is None:
+                raise ValueError(f"无效数字: {value}")
+            return number
+        return str(value)
+
+    def _value(self, item, field, seat):
+        field_type, _, getter = PLAN_FIELDS[self.kind][field]
+        value = getter(item, seat)
+        if value is None:
+            return None
+        if field_type == "time":
+            return _clock_minutes(value)
+        if field_type == "num":
+            return _to_float(value)
+        return str(value)
+
+    def _matches(self, item, condition):
+        if condition[0] == "any":
+            return any(self._matches(item, sub) for sub in condition[1])
+        field, op, expected, seat = condition
+        value = self._value(item, field, seat)
+        if value is None:
+            return False
+        try:
+            return PLAN_OPERATORS[op](value, expected)
+        except TypeError:
+            return False
+
+    def execute(self, items):
+        """对全部条目（ResultView）执行筛选、排序和条数限制，返回新的视图，不复制条目"""
+        result = items.filter(lambda item: all(self._matches(item, condition) for condition in self.filters))
+        # 多个排序键从次要到主要依次稳定排序，缺少字段的条目总在最后
+        for field, seat, reverse in reversed(self.sort):
+            result = result.sort(lambda item, field=field, seat=seat: self._value(item, field, seat), reverse=reverse)
+        if self.limit is not None:
+            result = result[:self.limit]
+        return result
+
+    def describe(self):
+        return f"条件{self.filters}，排序{self.sort}，限制{self.limit}"
+
+
+def plan_encode(plan):
+    """筛选计划缓存的序列化：保存原始计划，读取时重新编译；False表示无法用计划表达"""
+    return _json_encode(False if plan is False else {"kind": plan.kind, "spec": plan.spec})
+
+
+def plan_decode(blob):
+    value = _json_decode(blob)
+    return False if value is False else FilterPlan.compile(value["kind"], value["spec"])
+
+
+# 单页最多显示的条目数，避免消息过长
+MAX_RENDERED_ITEMS = 20
+
+
+def _seat_summary(seats):
+    """席位信息：各座位的票价与余票，以" | "分隔"""
+    return " | ".join(
+        f"{s.get('seatname', '未知')}：¥{s.get('seatprice', '未知')}（余{s.get('seatinventory', 0)}张）"
+        for s in seats
+    )
+
+
+def format_train_block(item):
+    """直达车次的文本块（不含序号，渲染时再加）"""
+    info = f"【{item.get('trainumber', '未知车次')}】{item.get('traintype', '未知类型')}\n"
+    info += f"   🚩出发站：{item.get('departstation', '未知')} ➔ 到达站：{item.get('arrivestation', '未知')}\n"
+    info += f"   ⏰时间：{item.get('departtime', '未知')} - {item.get('arrivetime', '未知')}（历时：{item.get('runtime', '未知')}\n"
+    seats = item.get('ticket_info', [])
+    if seats:
+        info += f"   💺席位：{_seat_summary(seats)}\n"
+    else:
+        info += "   ⚠️暂无余票信息\n"
+    return info
+
+
+def format_transfer_block(route):
+    """中转方案的文本块（不含序号，渲染时再加）"""
+    first_leg = route['first_leg']
+    second_leg = route['second_leg']
+    transfer_station = route['transfer_station']
+    transfer_time = route['transfer_time']
+    total_minutes = route['total_runtime']
+
+    route_info = [f"【总时长: {total_minutes // 60}小时{total_minutes % 60}分钟】 【总票价: ¥{route['total_price']}】"]
+    # 第一段行程
+    route_info.append(f"① {first_leg.get('trainumber')} {first_leg.get('traintype')}: "
+                      f"{first_leg.get('departstation')}({first_leg.get('departtime')}) → "
+                      f"{transfer_station}({first_leg.get('arrivetime')})")
+    # 换乘信息
+    route_info.append(f"   🔄 {transfer_station}站内换乘 {transfer_time // 60}小时{transfer_time % 60}分钟")
+    # 第二段行程
+    route_info.append(f"② {second_leg.get('trainumber')} {second_leg.get('traintype')}: "
+                      f"{transfer_station}({second_leg.get('departtime')}) → "
+                      f"{second_leg.get('arrivestation')}({second_leg.get('arrivetime')})")
+    # 票价信息，只显示前3种席别
+    route_info.append("💰票价详情:")
+    route_info.append(f"   第一段: {_seat_summary(first_leg.get('ticket_info', [])[:3])}")
+    route_info.append(f"   第二段: {_seat_summary(second_leg.get('ticket_info', [])[:3])}")
+    return "\n".join(route_info)
+
+
+class ResultView:
+    """查询结果的只读视图：共用同一份结果（rows），筛选、排序和截取只生成新的序号数组（array('I')）
+
+    视图可以链式组合（在筛选结果上再排序、截取），都不复制结果条目；翻页只切片序号数组。
+    """
+
+    __slots__ = ("rows", "indices")
+
+    def __init__(self, rows, indices=None):
+        self.rows = rows
+        self.indices = array("I", range(len(rows))) if indices is None else indices
+
+    @classmethod
+    def of(cls, rows, items):
+        """由条目列表构造视图（条目须来自rows），找不到的条目忽略"""
+        positions = {id(row): i for i, row in enumerate(rows)}
+        return cls(rows, array("I", (positions[id(item)] for item in items if id(item) in positions)))
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __bool__(self):
+        return len(self.indices) > 0
+
+    def __iter__(self):
+        rows = self.rows
+        return (rows[i] for i in self.indices)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return ResultView(self.rows, self.indices[key])
+        return self.rows[self.indices[key]]
+
+    def is_full(self):
+        """是否为全部结果的原顺序视图"""
+        indices = self.indices
+        return len(indices) == len(self.rows) and all(i == n for n, i in enumerate(indices))
+
+    def position_set(self):
+        """视图包含的序号集合，用于在索引结果中只保留视图内的条目；包含全部结果时返回None"""
+        positions = set(self.indices)
+        return None if len(positions) == len(self.rows) else positions
+
+    def select(self, positions):
+        """按rows中的序号选取条目（如LLM返回的序号），越界的序号忽略"""
+        size = len(self.rows)
+        return ResultView(self.rows, array("I", (i for i in positions if 0 <= i < size)))
+
+    def filter(self, predicate):
+        rows = self.rows
+        return ResultView(rows, array("I", (i for i in self.indices if predicate(rows[i]))))
+
+    def sort(self, key, reverse=False):
+        """稳定排序；key返回None的条目保持原顺序排在最后"""
+        rows = self.rows
+        known = []
+        unknown = []
+        for i in self.indices:
+            value = key(rows[i])
+            if value is None:
+                unknown.append(i)
+            else:
+                known.append((value, i))
+        known.sort(key=lambda pair: pair[0], reverse=reverse)
+        return ResultView(rows, array("I", [i for _, i in known] + unknown))
+
+
+class ResultRenderer:
+    """查询结果渲染器
+
+    保存查询结果时为每个条目生成一次文本块（按结果中的序号保存），筛选只切换视图、复用已有文本块；
+    拼接好的页面按(页码, 每页条数)缓存，翻页只需切片序号数组并拼接，或直接命中缓存。
+    """
+
+    def __init__(self, format_block=format_train_block, separator="\n"):
+        self.format_block = format_block
+        self.separator = separator
+        self._blocks = []      # 序号 -> 文本块
+        self._items = []
+        self._positions = None # id(条目) -> 序号，渲染条目列表时按需建立
+        self._extra = {}       # 不在已保存结果中的条目的文本块
+        self._view = ResultView([])
+        self._pages = {}
+        self.page_hits = 0
+        self.page_misses = 0
+
+    def load(self, items, format_block=None, separator=None):
+        """保存新的查询结果：预先生成全部条目的文本块"""
+        if format_block is not None:
+            self.format_block = format_block
+        if separator is not None:
+            self.separator = separator
+        self._items = items
+        self._blocks = [self.format_block(item) for item in items]
+        self._positions = None
+        self._extra = {}
+        self.set_view(ResultView(items))
+
+    def set_view(self, view):
+        """切换到筛选后的结果视图（ResultView，或来自已保存结果的条目列表），页面缓存随之失效"""
+        if not isinstance(view, ResultView):
+            view = ResultView.of(self._items, view)
+        self._view = view
+        self._pages = {}
+
+    def block(self, item):
+        if self._positions is None:
+            self._positions = {id(row): i for i, row in enumerate(self._items)}
+        position = self._positions.get(id(item))
+        if position is not None:
+            return self._blocks[position]
+        # 不在已保存结果中的条目按需生成；同时保存条目引用，保证id在渲染器生命周期内有效
+        entry = self._extra.get(id(item))
+        if entry is None:
+            entry = self._extra[id(item)] = (self.format_block(item), item)
+        return entry[0]
+
+    def render(self, items, start_index=1):
+        """按序号拼接条目的文本块；items为当前结果上的视图时直接按序号取文本块"""
+        if isinstance(items, ResultView) and items.rows is self._items:
+            blocks = (self._blocks[i] for i in items.indices)
+        else:
+            blocks = (self.block(item) for item in items)
+        return self.separator.join(f"{index}. {block}" for index, block in enumerate(blocks, start_index))
+
+    def page(self, page, page_size, max_items=MAX_RENDERED_ITEMS):
+        """渲染当前视图的第page页（从1开始），结果按页缓存"""
+        key = (page, page_size, max_items)
+        body = self._pages.get(key)
+        if body is not None:
+            self.page_hits += 1
+            return body
+        self.page_misses += 1
+        start = (page - 1) * page_size
+        page_items = self._view[start:start + page_size]
+        if len(page_items) > max_items:
+            logger.warning(f"结果过多({len(page_items)}条)，只显示前{max_items}条")
+            page_items = page_items[:max_items]
+        body = self.render(page_items, start + 1)
+        self._pages[key] = body
+        return body
+
+
+# 日期范围查询，如"高铁 北京 上海 2024-06-05~2024-06-12"，结束日期可省略年份或年月
+DATE_RANGE_PATTERN = re.compile(r"(\d{4}-\d{1,2}-\d{1,2})\s*[~～至]\s*(\d{4}-\d{1,2}-\d{1,2}|\d{1,2}-\d{1,2}|\d{1,2})")
+
+# 车型别名 -> 车票API使用的车型
+TICKET_TYPE_ALIASES = {
+    "普通火车": "普通", "火车": "普通", "普快": "普通", "特快": "普通", "快车": "普通", "特快列车": "普通",
+    "高速": "高铁", "高速铁路": "高铁", "高铁列车": "高铁", "高速列车": "高铁",
+    "动车组": "动车", "动车列车": "动车",
+}
+
+
+def normalize_ticket_type(ticket_type):
+    return TICKET_TYPE_ALIASES.get(ticket_type.lower(), ticket_type)
+
+
+def parse_date_range(start_text, end_text):
+    """解析日期范围，返回起止date；结束日期只写月日或日时沿用开始日期的年月"""
+    start = datetime.strptime(start_text, "%Y-%m-%d").date()
+    parts = end_text.split("-")
+    if len(parts) == 3:
+        end = datetime.strptime(end_text, "%Y-%m-%d").date()
+    elif len(parts) == 2:
+        end = start.replace(month=int(parts[0]), day=int(parts[1]))
+    else:
+        end = start.replace(day=int(parts[0]))
+    if end < start and len(parts) == 2:
+        # 跨年，如"2024-12-28~01-03"
+        end = end.replace(year=end.year + 1)
+    elif end < start and len(parts) == 1:
+        # 跨月，如"2024-06-28~3"
+        month = start.month % 12 + 1
+        end = datetime(start.year + (month == 1), month, int(parts[0])).date()
+    return start, end
+
+
+class PriceCalendar:
+    """多日期查询的价格日历：每天的结果到达后立即归并为一行摘要（最低价、有票车次数），不保留车次列表"""
+
+    def __init__(self, dates):
+        self.dates = list(dates)
+        self.days = {}    # 日期 -> 摘要
+        self.failed = set()
+
+    def add(self, date, trains):
+        """归并一天的查询结果；trains为None表示该日期查询失败"""
+        if trains is None:
+            self.failed.add(date)
+            return
+        summary = {"count": len(trains), "available": 0, "price": None, "trainumber": None,
+                   "seatname": None, "sold_out_price": None}
+        for train in trains:
+            has_ticket = False
+            for seat in train.get("ticket_info") or []:
+                price = _to_float(seat.get("seatprice"))
+                if price is None:
+                    continue
+                if inventory_count(seat.get("seatinventory")) > 0:
+                    has_ticket = True
+                    if summary["price"] is None or price < summary["price"]:
+                        summary.update(price=price, trainumber=train.get("trainumber"), seatname=seat.get("seatname"))
+                elif summary["sold_out_price"] is None or price < summary["sold_out_price"]:
+                    summary["sold_out_price"] = price
+            summary["available"] += has_ticket
+        self.days[date] = summary
+
+    def cheapest(self):
+        """有票日期中价格最低的一天"""
+        priced = [(summary["price"], date) for date, summary in self.days.items() if summary["price"] is not None]
+        return min(priced)[1] if priced else None
+
+    def render(self, title):
+        lines = [title]
+        for date in self.dates:
+            label = f"{date.strftime('%m-%d')} {WEEKDAY_NAMES[date.weekday()]}"
+            summary = self.days.get(date)
+            if summary is None:
+                lines.append(f"{label}  ⚠️查询失败")
+            elif not summary["count"]:
+                lines.append(f"{label}  无车次")
+            elif summary["price"] is None:
+                lines.append(f"{label}  ❌无余票（{summary['count']}班）")
+            else:
+                lines.append(f"{label}  ¥{summary['price']:g} {summary['trainumber']} {summary['seatname']}"
+                             f" | 有票{summary['available']}/{summary['count']}班")
+        best = self.cheapest()
+        if best is not None:
+            summary = self.days[best]
+            lines.append(f"\n💰最便宜：{best.strftime('%m-%d')} {WEEKDAY_NAMES[best.weekday()]} "
+                         f"¥{summary['price']:g}（{summary['trainumber']} {summary['seatname']}）")
+        return "\n".join(lines)
+
+
+# 可直接用座位索引回答的筛选问题（不调用LLM）：最便宜的若干班（可指定座位）、还有某种座位余票的车次
+SEAT_WORD = r"(?P<seat>[\u4e00-\u9fff]{1,4}?[座卧])"
+COUNT_WORD = r"(?:前)?(?P<count>\d+|[一两二三四五六七八九十]+)[班趟个]"
+CHEAPEST_PATTERNS = [
+    re.compile(rf"^(?:最便宜|价格最低|最低价|票价最低)的?(?:{COUNT_WORD})?的?{SEAT_WORD}?(?:车次|的车)?$"),
+    re.compile(rf"^{SEAT_WORD}(?:最便宜|价格最低|最低价|票价最低)的?(?:{COUNT_WORD})?(?:车次|的车)?$"),
+]
+AVAILABLE_PATTERNS = [
+    re.compile(rf"^(?:还有|有){SEAT_WORD}(?:票|余票)?的?(?:车|车次|列车)?$"),
+    re.compile(rf"^{SEAT_WORD}(?:还有票|有票|有余票)的?(?:车|车次|列车)?$"),
+]
+# 筛选默认在当前结果上继续进行；以这些词开头时回到全部查询结果（其后可以接新的筛选条件）
+RESET_FILTER_PATTERN = re.compile(r"^(?:全部结果|全部车次|全部方案|全部|重置|清除筛选|取消筛选)[\s，,:：]*")
+
+
+class SeatIndex:
+    """座位类型倒排索引，在保存查询结果时构建一次
+
+    by_price：座位 -> 按票价升序的车次序号；available：座位 -> 有余票、按票价升序的车次序号。
+    序号为车次在查询结果中的位置（array('I')），用于构造ResultView。
+    键ANY_SEAT对应每个车次的最低票价，因此"最便宜的k班"只需取前k项。
+    """
+
+    ANY_SEAT = "*"
+
+    def __init__(self, trains):
+        priced = defaultdict(list)     # 座位 -> [(票价, 原顺序)]
+        available = defaultdict(list)
+        for order, train in enumerate(trains):
+            cheapest = cheapest_available = None
+            for seat in train.get("ticket_info") or []:
+                price = _to_float(seat.get("seatprice"))
+                name = seat.get("seatname")
+                if price is None or not name:
+                    continue
+                priced[name].append((price, order))
+                cheapest = price if cheapest is None else min(cheapest, price)
+                if inventory_count(seat.get("seatinventory")) > 0:
+                    available[name].append((price, order))
+                    cheapest_available = price if cheapest_available is None else min(cheapest_available, price)
+            if cheapest is not None:
+                priced[self.ANY_SEAT].append((cheapest, order))
+            if cheapest_available is not None:
+                available[self.ANY_SEAT].append((cheapest_available, order))
+        self.by_price = {name: array("I", (order for _, order in sorted(entries)))
+                         for name, entries in priced.items()}
+        self.available = {name: array("I", (order for _, order in sorted(entries)))
+                          for name, entries in available.items()}
+        self._rank_cache = {}
+
+    def resolve_seat(self, text):
+        """把问题中的座位说法（如"二等"、"卧铺"）对应到结果中实际存在的座位名称"""
+        if not text:
+            return self.ANY_SEAT
+        if text in self.by_price:
+            return text
+        return next((name for name in self.by_price if name != self.ANY_SEAT and (text in name or name in text)), None)
+
+    def _within(self, table, seat, within, k=None):
+        """table[seat]中位于within内的前k个序号（k为None表示全部），保持票价顺序
+
+        沿按票价排好的序号顺序扫描，取满k个即停止；within远小于该座位的车次数时，
+        改为按各车次在该座位中的名次给within排序，不扫描整张表。
+        """
+        positions = table.get(seat)
+        if not positions:
+            return array("I")
+        if within is None:
+            return positions if k is None else positions[:k]
+        if len(within) * 4 < len(positions):
+            ranks = self._ranks(table, seat)
+            ranked = sorted((ranks[i], i) for i in within if i in ranks)
+            return array("I", (i for _, i in ranked[:k]))
+        result = array("I")
+        for i in positions:
+            if i in within:
+                result.append(i)
+                if len(result) == k:
+                    break
+        return result
+
+    def _ranks(self, table, seat):
+        """车次序号 -> 在table[seat]中的名次，首次用到时构建"""
+        key = (table is self.available, seat)
+        ranks = self._rank_cache.get(key)
+        if ranks is None:
+            ranks = self._rank_cache[key] = {position: rank for rank, position in enumerate(table[seat])}
+        return ranks
+
+    def cheapest(self, seat=ANY_SEAT, k=1, available_only=True, within=None):
+        """票价最低的k个车次的序号；默认只看有余票的座位，全部售罄时退回全部车次
+
+        within为车次序号集合时只在其中选取（在已筛选的结果上继续筛选），None表示全部车次。
+        """
+        if available_only:
+            available = self._within(self.available, seat, within, k)
+            if available:
+                return available
+        return self._within(self.by_price, seat, within, k)
+
+    def with_inventory(self, seat=ANY_SEAT, within=None):
+        """有该座位余票的车次序号（按票价升序），within同cheapest"""
+        return self._within(self.available, seat, within)
+
+
+def _reference_price(train):
+    """单段行程的参考票价：优先二等座，没有二等座时取第一个有价格的座位"""
+    seats = train.get('ticket_info', [])
+    try:
+        for seat in seats:
+            if seat.get('seatname') == '二等座' and seat.get('seatprice'):
+                return float(seat['seatprice'])
+        for seat in seats:
+            if seat.get('seatprice'):
+                return float(seat['seatprice'])
+    except (TypeError, ValueError) as e:
+        logger.error(f"解析票价时出错: {e}")
+    return 0.0
+
+
+def _leg_runtime(train):
+    """单段行程的运行时长（分钟），无法解析时按0计算"""
+    minutes = _runtime_minutes(train.get('runtime'))
+    return minutes if isinstance(minutes, (int, float)) else 0
+
+
+class TransferRanker:
+    """中转方案排序
+
+    在(总耗时, 总票价, 换乘余量)三个维度上增量维护帕累托前沿：被其他方案在各维度都不差、
+    且至少一项更好的方案直接丢弃，不生成方案对象也不参与排序；最后按权重从前沿中取前limit个。
+    第二程按发车时间排序后用二分查找定位可换乘的时间窗口，不再逐对比较。
+    """
+
+    def __init__(self, min_transfer_time, max_transfer_time, weights=(1.0, 1.0, 0.2), limit=10):
+        self.min_transfer_time = min_transfer_time
+        self.max_transfer_time = max_transfer_time
+        self.weights = weights
+        self.limit = limit
+        self.frontier = []  # [((总耗时, 总票价, -换乘余量), (第一程, 第二程, 中转站, 换乘时间))]
+        self.candidates = 0
+
+    def add_station(self, transfer_station, first_leg, second_leg):
+        """加入经由某个中转站的全部可行组合"""
+        seconds = []
+        for train in second_leg:
+            depart = _clock_minutes(train.get('departtime'))
+            if depart is not None:
+                seconds.append((depart, _leg_runtime(train), _reference_price(train), train))
+        seconds.sort(key=lambda entry: entry[0])
+        departs = [entry[0] for entry in seconds]
+
+        for train1 in first_leg:
+            arrival = _clock_minutes(train1.get('arrivetime'))
+            if arrival is None:
+                continue
+            runtime1 = _leg_runtime(train1)
+            price1 = _reference_price(train1)
+            # 第二程发车时间早于第一程到达时间的，视为次日车次
+            for offset in (0, 24 * 60):
+                low = arrival + self.min_transfer_time - offset
+                high = arrival + self.max_transfer_time - offset
+                if high < 0 or low >= 24 * 60:
+                    continue
+                for index in range(bisect_left(departs, low), bisect_right(departs, high)):
+                    depart, runtime2, price2, train2 = seconds[index]
+                    transfer_minutes = depart + offset - arrival
+                    point = (runtime1 + transfer_minutes + runtime2, price1 + price2,
+                             -(transfer_minutes - self.min_transfer_time))
+                    self._offer(point, (train1, train2, transfer_station, transfer_minutes))
+
+    def _offer(self, point, payload):
+        self.candidates += 1
+        survivors = []
+        for member in self.frontier:
+            other = member[0]
+            if all(o <= p for o, p in zip(other, point)):
+                # 已被前沿中的方案支配；各维度完全相同的并列方案都保留
+                if other != point:
+                    return
+            elif all(p <= o for p, o in zip(point, other)):
+                # 新方案支配该成员，将其移出前沿
+                continue
+            survivors.append(member)
+        survivors.append((point, payload))
+        self.frontier = survivors
+
+    def pruning_ratio(self):
+        return 1 - len(self.frontier) / self.candidates if self.candidates else 0.0
+
+    def top(self):
+        """按加权得分从前沿中取前limit个方案（各维度以前沿中的最优值归一化）"""
+        if not self.frontier:
+            return []
+        best_runtime = min(point[0] for point, _ in self.frontier) or 1
+        best_price = min(point[1] for point, _ in self.frontier) or 1
+        max_slack = max(-point[2] for point, _ in self.frontier) or 1
+        runtime_weight, price_weight, slack_weight = self.weights
+
+        def score(member):
+            runtime, price, neg_slack = member[0]
+            return (runtime_weight * runtime / best_runtime + price_weight * price / best_price
+                    + slack_weight * neg_slack / max_slack)
+
+        routes = []
+        for (runtime, price, _), (train1, train2, station, transfer_minutes) in heapq.nsmallest(
+                self.limit, self.frontier, key=score):
+            routes.append({
+                'first_leg': train1,
+                'second_leg': train2,
+                'transfer_station': station,
+                'transfer_time': transfer_minutes,
+                'total_price': price,
+                'total_runtime': runtime,
+            })
+        return routes
+
+
+# 负缓存标记：该线路最近一次查询失败
+FAILED_LOOKUP = object()
+
+
+class TrainInterner:
+    """车次数据写入缓存和会话前的去重
+
+    重复的字符串（站名、座位名、车型、"有车票"等）只保留一份；内容相同的座位字典和座位列表
+    在车次之间共用；内容完全相同的车次（如同一线路刷新后未变化的车次、多条中转方案中的同一程）
+    共用一个字典。车次字典在缓存和会话中只读，共用是安全的。
+    去重表的条目数超过max_entries时整体清空，重新积累。
+    """
+
+    def __init__(self, max_entries=50000):
+        self.max_entries = max_entries
+        self._seats = {}    # 座位字典内容 -> 共用的座位字典
+        self._layouts = {}  # 座位字典id序列 -> 共用的座位列表
+        self._trains = {}   # 车次字典内容 -> 共用的车次字典
+        self.stats = {"trains": 0, "shared_trains": 0, "seats": 0, "shared_seats": 0, "shared_layouts": 0,
+                      "resets": 0}
+
+    @staticmethod
+    def _value(value):
+        return sys.intern(value) if type(value) is str else value
+
+    def _share(self, table, key, value, counter):
+        try:
+            shared = table.setdefault(key, value)
+        except TypeError:
+            # 含有列表等不可哈希的字段，不参与共用
+            return value
+        if shared is not value:
+            self.stats[counter] += 1
+        return shared
+
+    def _compact(self, item):
+        return {sys.intern(key) if type(key) is str else key: self._value(value) for key, value in item.items()}
+
+    def seat(self, seat):
+        if not isinstance(seat, dict):
+            return seat
+        self.stats["seats"] += 1
+        key = tuple(seat.items())
+        try:
+            shared = self._seats.get(key)
+        except TypeError:
+            return seat
+        if shared is not None:
+            self.stats["shared_seats"] += 1
+            return shared
+        seat = self._compact(seat)
+        return self._share(self._seats, tuple(seat.items()), seat, "shared_seats")
+
+    def train(self, train):
+        """返回去重后的车次字典；非字典（如LazyTrain）原样返回"""
+        if type(train) is not dict:
+            return train
+        if len(self._seats) + len(self._trains) > self.max_entries:
+            self._seats, self._layouts, self._trains = {}, {}, {}
+            self.stats["resets"] += 1
+        self.stats["trains"] += 1
+        seats = train.get("ticket_info")
+        layout = None
+        if isinstance(seats, list):
+            layout = [self.seat(seat) for seat in seats]
+            layout = self._share(self._layouts, tuple(id(seat) for seat in layout), layout, "shared_layouts")
+        key = tuple((name, id(layout)) if name == "ticket_info" else (name, value) for name, value in train.items())
+        try:
+            shared = self._trains.get(key)
+        except TypeError:
+            shared = None
+        if shared is not None:
+            self.stats["shared_trains"] += 1
+            return shared
+        compact = self._compact(train)
+        if layout is not None:
+            compact["ticket_info"] = layout
+        # 表中的键也使用去重后的字符串，不持有原始字典中的字符串
+        key = tuple((name, id(layout)) if name == "ticket_info" else (name, value) for name, value in compact.items())
+        return self._share(self._trains, key, compact, "shared_trains")
+
+    def trains(self, trains):
+        return [self.train(train) for train in trains]
+
+    def routes(self, routes):
+        """中转方案：两程车次去重，方案本身的字段只做字符串去重"""
+        compacted = []
+        for route in routes:
+            route = self._compact(route)
+            for leg in ("first_leg", "second_leg"):
+                if isinstance(route.get(leg), dict):
+                    route[leg] = self.train(route[leg])
+            compacted.append(route)
+        return compacted
+
+
+# 进程内共享的车次去重表
+_train_interner = TrainInterner()
+
+
+class LazyTrain(Mapping):
+    """按需解析的车次记录，只读，用法与车次字典相同
+
+    筛选用到的字段（车次、车型、发车时间）在构造时给出；其余字段（座位、票价等）保存为
+    该车次的JSON字节，第一次访问时才解析，解析结果保留，之后的访问不再解析。
+    """
+
+    __slots__ = ("trainumber", "traintype", "departtime", "_buffer", "_start", "_end", "_data")
+
+    EAGER_FIELDS = ("trainumber", "traintype", "departtime")
+
+    def __init__(self, trainumber, traintype, departtime, buffer, start, end):
+        self.trainumber = trainumber
+        self.traintype = traintype
+        self.departtime = departtime
+        self._buffer = buffer
+        self._start = start
+        self._end = end
+        self._data = None
+
+    def materialize(self):
+        """返回完整的车次字典（首次调用时解析）"""
+        data = self._data
+        if data is None:
+            buffer = self._buffer
+            if buffer is None:
+                # 其他线程刚刚完成解析
+                return self._data
+            data = self._data = _train_interner.train(_json_loads(buffer[self._start:self._end]))
+            self._buffer = None
+        return data
+
+    @property
+    def materialized(self):
+        return self._data is not None
+
+    def get(self, key, default=None):
+        if key in LazyTrain.EAGER_FIELDS and self._data is None:
+            value = getattr(self, key)
+            return default if value is None else value
+        return self.materialize().get(key, default)
+
+    def __getitem__(self, key):
+        if key in LazyTrain.EAGER_FIELDS and self._data is None and getattr(self, key) is not None:
+            return getattr(self, key)
+        return self.materialize()[key]
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def __repr__(self):
+        return f"LazyTrain({self.trainumber}, {self.traintype}, {self.departtime}, materialized={self.materialized})"
+
+
+def _materialize(train):
+    """把LazyTrain转换为普通字典，其他值原样返回"""
+    return train.materialize() if type(train) is LazyTrain else train
+
+
+# 车票缓存的分段格式：文件头 + 4字节索引长度 + 索引JSON（每个车次的[车次, 车型, 发车时间, 结束位置]）
+# + 依次拼接的各车次JSON；读取时只解析索引，车次详情由LazyTrain按需解析
+TICKET_BLOB_MAGIC = b"TQT1"
+
+
+def _ticket_encode(value):
+    """车票缓存的序列化，负缓存标记保存为空值，车次列表按分段格式保存"""
+    if value is FAILED_LOOKUP:
+        return b""
+    if not isinstance(value, list) or not all(isinstance(train, (dict, LazyTrain)) for train in value):
+        return _json_encode(value)
+    index = []
+    rows = []
+    end = 0
+    for train in value:
+        row = _json_encode(_materialize(train))
+        end += len(row)
+        rows.append(row)
+        index.append([train.get("trainumber"), train.get("traintype"), train.get("departtime"), end])
+    header = _json_encode(index)
+    return b"".join([TICKET_BLOB_MAGIC, len(header).to_bytes(4, "big"), header] + rows)
+
+
+def _ticket_decode(blob):
+    if not blob:
+        return FAILED_LOOKUP
+    if not blob.startswith(TICKET_BLOB_MAGIC):
+        return _json_decode(blob)
+    offset = len(TICKET_BLOB_MAGIC) + 4
+    header_end = offset + int.from_bytes(blob[len(TICKET_BLOB_MAGIC):offset], "big")
+    trains = []
+    start = header_end
+    for trainumber, traintype, departtime, end in _json_loads(blob[offset:header_end]):
+        trains.append(LazyTrain(trainumber, traintype, departtime, blob, start, header_end + end))
+        start = header_end + end
+    return trains
+
+
+# 车票API请求优先级：数值越小越先获得令牌
+PRIORITY_INTERACTIVE = 0  # 用户直接发起的查询
+PRIORITY_FANOUT = 1       # 中转、日期范围等一次查询拆出的多个请求
+PRIORITY_PREFETCH = 2     # 后台预取、轮询
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "交互", PRIORITY_FANOUT: "扇出", PRIORITY_PREFETCH: "后台"}
+
+
+class RateLimiter:
+    """令牌桶限流器：按rate（次/秒）补充令牌，最多积累burst个
+
+    等待中的请求按(优先级, 到达顺序)排队，只有队首能取走令牌，因此高优先级请求总是先发出。
+    rate不大于0时不限流。
+    """
+
+    def __init__(self, rate, burst):
+        self._cond = threading.Condition()
+        self._waiters = []  # 堆：(优先级, 序号)
+        self._sequence = 0
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time_module.monotonic()
+        self._stats = {priority: {"count": 0, "wait": 0.0, "max_wait": 0.0, "timeouts": 0}
+                       for priority in PRIORITY_NAMES}
+
+    def configure(self, rate, burst):
+        """配置热更新时调整速率和桶容量，已积累的令牌不超过新容量；唤醒排队的请求按新配置重新计算等待时间"""
+        with self._cond:
+            if (rate, max(1, burst)) != (self.rate, self.burst):
+                self._refill()
+                self.rate = rate
+                self.burst = max(1, burst)
+                self._tokens = min(self._tokens, self.burst)
+                self._cond.notify_all()
+
+    def _refill(self):
+        now = time_module.monotonic()
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE, timeout=None):
+        """取得一个令牌，返回排队等待的秒数；超过timeout仍未取得时返回None"""
+        if self.rate <= 0:
+            return 0.0
+        with self._cond:
+            self._sequence += 1
+            ticket = (priority, self._sequence)
+            heapq.heappush(self._waiters, ticket)
+            start = time_module.monotonic()
+            try:
+                while True:
+                    self._refill()
+                    if self.rate <= 0:
+                        # 排队期间配置热更新关闭了限流，直接放行
+                        waited = time_module.monotonic() - start
+                        self._record(priority, waited)
+                        return waited
+                    if self._waiters[0] == ticket and self._tokens >= 1:
+                        self._tokens -= 1
+                        waited = time_module.monotonic() - start
+                        self._record(priority, waited)
+                        return waited
+                    delay = (1 - self._tokens) / self.rate if self._tokens < 1 else None
+                    if timeout is not None:
+                        remaining = timeout - (time_module.monotonic() - start)
+                        if remaining <= 0:
+                            self._stats[priority]["timeouts"] += 1
+                            return None
+                        delay = remaining if delay is None else min(delay, remaining)
+                    self._cond.wait(delay)
+            finally:
+                # 取得令牌、超时或出错都要离开队列，否则排在后面的请求永远轮不到
+                if self._waiters[0] == ticket:
+                    heapq.heappop(self._waiters)
+                else:
+                    self._waiters.remove(ticket)
+                    heapq.heapify(self._waiters)
+                # 让下一个排队的请求检查是否轮到自己
+                self._cond.notify_all()
+
+    def _record(self, priority, waited):
+        stats = self._stats[priority]
+        stats["count"] += 1
+        stats["wait"] += waited
+        stats["max_wait"] = max(stats["max_wait"], waited)
+
+    def queue_depth(self):
+        return len(self._waiters)
+
+    def stats(self):
+        """各优先级的请求数、平均/最大排队时间（秒）和超时次数"""
+        with self._cond:
+            return {
+                PRIORITY_NAMES[priority]: {
+                    "count": stats["count"],
+                    "avg_wait": round(stats["wait"] / stats["count"], 4) if stats["count"] else 0.0,
+                    "max_wait": round(stats["max_wait"], 4),
+                    "timeouts": stats["timeouts"],
+                }
+                for priority, stats in self._stats.items()
+            }
+
+
+# 进程内共享的车票API限流器，插件重新加载或多个实例时共用同一配额
+_api_rate_limiter = None
+_api_rate_limiter_lock = threading.Lock()
+
+
+def _api_limiter(config):
+    """获取（并按当前配置调整）共享的车票API限流器"""
+    global _api_rate_limiter
+    with _api_rate_limiter_lock:
+        if _api_rate_limiter is None:
+            _api_rate_limiter = RateLimiter(config.api_rate_limit, config.api_burst)
+        else:
+            _api_rate_limiter.configure(config.api_rate_limit, config.api_burst)
+        return _api_rate_limiter
+
+
+WATCH_COMMAND_PATTERN = re.compile(
+    r"^订阅\s*(?P<train>[A-Za-z]?\d{1,5})\s+(?P<from>\S+)\s+(?P<to>\S+)\s+(?P<date>\d{4}-\d{1,2}-\d{1,2})"
+    r"(?:\s+(?P<seat>\S+))?\s*$")
+UNWATCH_COMMAND_PATTERN = re.compile(r"^取消订阅\s*(?P<train>[A-Za-z]?\d{1,5})?\s*$")
+# 车次首字母对应的API车型，其余（Z/T/K及纯数字车次）为普通列车
+TRAIN_PREFIX_TYPES = {"G": "高铁", "C": "高铁", "D": "动车"}
+
+
+def train_ticket_type(train_number):
+    return TRAIN_PREFIX_TYPES.get(train_number[:1].upper(), "普通")
+
+
+def inventory_text(count):
+    if count is None:
+        return "未知"
+    if not count:
+        return "无票"
+    return "有票" if count >= 99 else f"余{count}张"
+
+
+class WatchSubscription:
+    """一个用户对某车次（某座位）余票的订阅，seat为None表示任意座位"""
+
+    __slots__ = ("session_id", "train", "seat", "context", "channel", "expires_at")
+
+    def __init__(self, session_id, train, seat, context, channel, expires_at):
+        self.session_id = session_id
+        self.train = train
+        self.seat = seat
+        self.context = context
+        self.channel = channel
+        self.expires_at = expires_at  # 发车时间戳，到达后订阅自动失效
+
+    def describe(self):
+        return f"{self.train} {self.seat or '任意座位'}"
+
+
+class SeatWatcher:
+    """余票订阅调度：同一线路（车型, 出发地, 目的地, 日期）每个间隔只轮询一次，不论有多少人订阅
+
+    每次轮询把各车次座位的余票与上一次快照比较，只把订阅车次和座位的变化推送给对应用户；
+    轮询时间带随机抖动，避免多条线路同时请求；同时进行的轮询数不超过max_inflight，
+    超出时稍后重试。订阅在发车后自动失效，没有订阅者的线路不再轮询。
+    fetch(key)返回线路的原始车次列表（失败时为None），deliver(subscription, text)推送消息，
+    submit(func, *args)把轮询任务提交到线程池。
+    clock返回当前时间戳；background为False时不启动调度线程，由调用方用run_pending()执行到期的轮询。
+    """
+
+    def __init__(self, fetch, deliver, submit, interval=300, jitter=0.2, max_inflight=2,
+                 clock=time_module.time, background=True):
+        self._fetch = fetch
+        self._deliver = deliver
+        self._submit = submit
+        self._clock = clock
+        self._background = background
+        self.configure(interval, jitter, max_inflight)
+        self._routes = {}      # key -> [WatchSubscription]
+        self._snapshots = {}   # key -> {(车次, 座位): 余票数}
+        self._heap = []        # (下次轮询时间, 序号, key)
+        self._scheduled = set()  # 已有轮询链的线路（堆中有条目或正在轮询），每条线路只保留一条
+        self._seq = 0
+        self._inflight = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self.stats = {"polls": 0, "failures": 0, "deferred": 0, "notifications": 0, "expired": 0}
+
+    def configure(self, interval, jitter, max_inflight):
+        self.interval = max(1.0, float(interval))
+        self.jitter = min(max(jitter, 0.0), 0.9)
+        self.max_inflight = max(1, max_inflight)
+
+    @staticmethod
+    def snapshot(trains):
+        """把车次列表整理为{(车次, 座位): 余票数}"""
+        return {
+            (train.get("trainumber"), seat.get("seatname")): inventory_count(seat.get("seatinventory"))
+            for train in trains or []
+            for seat in train.get("ticket_info") or []
+        }
+
+    def subscribe(self, key, subscription, trains=None):
+        """添加订阅；trains为订阅时查到的车次列表，作为后续比较的基准快照"""
+        with self._cond:
+            subscriptions = self._routes.setdefault(key, [])
+            subscriptions[:] = [sub for sub in subscriptions
+                                if (sub.session_id, sub.train, sub.seat)
+                                != (subscription.session_id, subscription.train, subscription.seat)]
+            subscriptions.append(subscription)
+            if trains is not None:
+                self._snapshots[key] = self.snapshot(trains)
+            if key not in self._scheduled:
+                # 新线路：首次轮询在一个间隔内随机分布；取消后很快重新订阅的线路沿用原来的轮询链
+                self._scheduled.add(key)
+                self._schedule(key, self.interval * random.uniform(0.5, 1.0))
+            if self._background and (self._thread is None or not self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run, name="TicketQuery-watch", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def unsubscribe(self, session_id, train=None):
+        """取消会话的订阅（train为None时取消全部），返回取消的订阅数"""
+        removed = 0
+        with self._cond:
+            for key in list(self._routes):
+                subscriptions = self._routes[key]
+                kept = [sub for sub in subscriptions
+                        if sub.session_id != session_id or (train and sub.train != train)]
+                removed += len(subscriptions) - len(kept)
+                self._set_route(key, kept)
+        return removed
+
+    def subscriptions(self, session_id):
+        """会话的全部订阅：[(key, subscription)]"""
+        with self._cond:
+            return [(key, sub) for key, subscriptions in self._routes.items()
+                    for sub in subscriptions if sub.session_id == session_id]
+
+    def route_count(self):
+        with self._cond:
+            return len(self._routes)
+
+    def _set_route(self, key, subscriptions):
+        if subscriptions:
+            self._routes[key] = subscriptions
+        else:
+            self._routes.pop(key, None)
+            self._snapshots.pop(key, None)
+
+    def _schedule(self, key, delay):
+        self._seq += 1
+        heapq.heappush(self._heap, (self._clock() + delay, self._seq, key))
+
+    def _next_delay(self):
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                key, delay = self._next_due()
+                if key is None:
+                    self._cond.wait(delay)
+                    continue
+            self._start_poll(key)
+
+    def run_pending(self):
+        """执行所有已到期的轮询，返回距下一次轮询的秒数（没有订阅线路时为None）"""
+        while True:
+            with self._cond:
+                key, delay = self._next_due()
+            if key is None:
+                return delay
+            self._start_poll(key)
+
+    def _next_due(self):
+        """取出下一条到期、需要轮询的线路，返回(key, None)；没有到期线路时返回(None, 距下次到期的秒数)
+
+        调用时需持有self._cond。没有订阅或订阅已全部失效的线路在这里结束轮询链。
+        """
+        while self._heap:
+            due, _, key = self._heap[0]
+            now = self._clock()
+            if due > now:
+                return None, due - now
+            heapq.heappop(self._heap)
+            if key not in self._routes:
+                # 线路已没有订阅，轮询链到此结束
+                self._scheduled.discard(key)
+                continue
+            
+            # 清理已发车的订阅
+            subscriptions = self._routes[key]
+            active = [sub for sub in subscriptions if sub.expires_at > now]
+            self.stats["expired"] += len(subscriptions) - len(active)
+            self._set_route(key, active)
+            if not active:
+                self._scheduled.discard(key)
+                logger.info(f"余票订阅线路已全部失效，停止轮询: {key}")
+                continue
+            
+            if self._inflight >= self.max_inflight:
+                self.stats["deferred"] += 1
+                self._schedule(key, min(5.0, self.interval))
+                continue
+            self._inflight += 1
+            return key, None
+        return None, None
+
+    def _start_poll(self, key):
+        try:
+            self._submit(self._poll, key)
+        except Exception as e:
+            logger.error(f"提交余票轮询任务失败: {e}")
+            self._finish_poll(key)
+
+    def _finish_poll(self, key):
+        with self._cond:
+            self._inflight -= 1
+            if key in self._routes:
+                self._schedule(key, self._next_delay())
+            else:
+                self._scheduled.discard(key)
+            self._cond.notify()
+
+    def _poll(self, key):
+        try:
+            trains = self._fetch(key)
+            with self._cond:
+                self.stats["polls"] += 1
+                if trains is None:
+                    self.stats["failures"] += 1
+                    return
+                if key not in self._routes:
+                    return
+                current = self.snapshot(trains)
+                previous = self._snapshots.get(key, {})
+                self._snapshots[key] = current
+                # 只比较两次都查到的车次座位，避免接口偶尔漏掉车次时误报
+                changes = {item: (previous[item], count) for item, count in current.items()
+                           if item in previous and previous[item] != count}
+                notices = []
+                for sub in self._routes[key]:
+                    lines = [f"{seat}：{inventory_text(old)} → {inventory_text(new)}"
+                             for (train, seat), (old, new) in changes.items()
+                             if train == sub.train and (sub.seat is None or seat == sub.seat)]
+                    if lines:
+                        notices.append((sub, lines))
+                self.stats["notifications"] += len(notices)
+            
+            logger.info(f"余票订阅轮询完成: {key}，变化{len(changes)}项，推送{len(notices)}条，统计: {self.stats}")
+            ticket_type, from_loc, to_loc, date = key
+            for sub, lines in notices:
+                text = f"🔔余票变化提醒\n【{sub.train}】{from_loc}→{to_loc} {date}\n" + "\n".join(lines)
+                try:
+                    self._deliver(sub, text)
+                except Exception as e:
+                    logger.error(f"推送余票变化失败（{sub.session_id}）: {e}")
+        except Exception as e:
+            logger.error(f"余票订阅轮询失败: {key}: {e}")
+            logger.error(traceback.format_exc())
+        finally:
+            self._finish_poll(key)
+
+
+class DeadlineExceeded(TimeoutError):
+    """本条消息的耗时预算已用完"""
+
+
+class Deadline:
+    """单条消息的总耗时预算
+
+    每次网络调用只使用剩余的时间（同时不超过该调用自身的超时配置），预算用完后不再发起新的请求。
+    budget为0或None时不限制总耗时。
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget or None
+        self.start = time_module.monotonic()
+        self.expires_at = self.start + self.budget if self.budget else None
+
+    def elapsed(self):
+        return time_module.monotonic() - self.start
+
+    def remaining(self):
+        if self.expires_at is None:
+            return float("inf")
+        return max(0.0, self.expires_at - time_module.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, limit):
+        """本次调用可用的超时时间：取调用自身的超时和剩余预算中较小的一个"""
+        return min(limit, self.remaining())
+
+    def check(self, what):
+        """预算已用完时抛出DeadlineExceeded，what说明被跳过的操作"""
+        if self.expired():
+            raise DeadlineExceeded(f"查询耗时已超过{self.budget}秒，跳过{what}")
+
+
+class QuerySession:
+    """单个会话（私聊或群聊）的查询状态：查询结果、筛选视图、分页位置和渲染缓存
+
+    同一会话的消息在lock下依次处理；pending为已提交、尚未完成的异步任务数；
+    dirty表示状态在上次保存快照后有修改。
+    """
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.original_query = None
+        self.original_data = []   # 原始查询结果，保存后不再修改
+        self.total_data = ResultView([])  # 当前筛选结果：原始查询结果上的序号视图
+        self.current_page = 1
+        self.is_transfer_query = False
+        self.seat_index = None    # 当前直达结果的座位索引
+        self.renderer = ResultRenderer()
+        self.lock = threading.RLock()
+        self.pending = 0
+        self.dirty = False
+
+    def load_results(self, items, is_transfer=False):
+        """保存新的查询结果（直达或中转），并预先生成每个条目的文本块"""
+        self.original_data = items
+        self.total_data = ResultView(items)
+        self.is_transfer_query = is_transfer
+        self.current_page = 1
+        if is_transfer:
+            self.renderer.load(items, format_transfer_block, separator="\n\n")
+            self.seat_index = None
+        else:
+            self.renderer.load(items, format_train_block, separator="\n")
+            self.seat_index = SeatIndex(items)
+        self.dirty = True
+
+    def view(self, indices=None):
+        """原始查询结果上的视图，indices为None时包含全部结果"""
+        return ResultView(self.original_data, indices)
+
+    def snapshot(self):
+        """需要持久化的状态：(原始查询, 是否中转, 当前页, 查询结果, 筛选结果)"""
+        return (self.original_query, self.is_transfer_query, self.current_page,
+                self.original_data, self.total_data)
+
+    @classmethod
+    def restore(cls, session_id, state):
+        """由快照状态重建会话，重新生成文本块和座位索引"""
+        query, is_transfer, page, data, view = state
+        session = cls(session_id)
+        session.load_results(data, is_transfer)
+        session.original_query = query
+        session.total_data = view
+        session.renderer.set_view(view)
+        session.current_page = page
+        session.dirty = False
+        return session
+
+
+class SessionStore:
+    """会话快照的本地存储，重启后翻页和筛选仍可继续
+
+    每个会话一个文件：文件头加zlib压缩的紧凑JSON，查询结果只保存一份，筛选视图保存为序号列表。
+    写入在后台线程中进行，同一会话排队期间只写最新的快照；读取在会话首次被访问时进行。
+    超过ttl的快照读取时丢弃，总大小超过max_bytes时删除最旧的快照。
+    """
+
+    MAGIC = b"TQS1"
+
+    def __init__(self, directory, submit, max_bytes=50 * 1024 * 1024, ttl=86400):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._submit = submit
+        self._pending = {}   # session_id -> 待写入的状态
+        self._lock = threading.Lock()
+        self._bytes = None   # 目录中快照的总大小，首次写入时统计
+        self._versions = {}  # session_id -> 本进程最后一次读写时快照文件的修改时间
+        self.stats = {"saved": 0, "loaded": 0, "expired": 0, "evicted": 0, "errors": 0}
+
+    def _path(self, session_id):
+        digest = hashlib.sha1(str(session_id).encode("utf-8")).hexdigest()[:24]
+        return os.path.join(self.directory, f"{digest}.bin")
+
+    @staticmethod
+    def encode(session_id, state):
+        """把(原始查询, 是否中转, 当前页, 查询结果, 筛选结果)编码为快照字节"""
+        query, is_transfer, page, data, view = state
+        if isinstance(view, ResultView) and view.rows is data:
+            view_indices = None if view.is_full() else view.indices.tolist()
+        elif view is data:
+            view_indices = None
+        else:
+            # 筛选结果总是查询结果上的视图，出现其他对象说明调用方有误，不保存错误的快照
+            raise ValueError(f"筛选结果不是查询结果上的视图（{type(view).__name__}），无法保存")
+        payload = {"id": session_id, "query": query, "transfer": is_transfer, "page": page,
+                   "data": data, "view": view_indices}
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return SessionStore.MAGIC + zlib.compress(body, 6)
+
+    @staticmethod
+    def decode(blob):
+        """解析快照字节，返回(原始查询, 是否中转, 当前页, 查询结果, 筛选结果)和会话ID"""
+        if not blob.startswith(SessionStore.MAGIC):
+            raise ValueError("快照文件头无效")
+        payload = _json_loads(zlib.decompress(blob[len(SessionStore.MAGIC):]))
+        data = payload["data"]
+        view = payload["view"]
+        # 恢复的查询结果与缓存中的车次共用字符串和座位结构，中转方案中重复的车次只保留一份
+        if payload["transfer"]:
+            data = _train_interner.routes(data)
+        else:
+            data = _train_interner.trains(data)
+        if view is None:
+            view = ResultView(data)
+        elif all(isinstance(i, int) and 0 <= i < len(data) for i in view):
+            view = ResultView(data, array("I", view))
+        else:
+            raise ValueError("快照中的筛选结果不是有效的序号列表")
+        return (payload["query"], payload["transfer"], payload["page"], data, view), payload["id"]
+
+    def save(self, session_id, state):
+        """在后台写入会话状态；排队中的旧状态直接被替换"""
+        with self._lock:
+            queued = session_id in self._pending
+            self._pending[session_id] = state
+        if not queued:
+            self._submit(self._write, session_id)
+
+    def _write(self, session_id):
+        with self._lock:
+            state = self._pending.pop(session_id, None)
+        if state is None:
+            return
+        path = self._path(session_id)
+        try:
+            blob = self.encode(session_id, state)
+            os.makedirs(self.directory, exist_ok=True)
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(blob)
+            os.replace(temp_path, path)
+            self._versions[session_id] = os.path.getmtime(path)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"保存会话快照失败（{session_id}）: {e}")
+            return
+        
+        with self._lock:
+            self.stats["saved"] += 1
+            if self._bytes is None:
+                self._bytes = sum(size for _, size, _ in self._scan())
+            else:
+                self._bytes += len(blob) - old_size
+            over_limit = self._bytes > self.max_bytes
+        if over_limit:
+            self._prune()
+
+    def load(self, session_id):
+        """读取会话快照，不存在、过期或损坏时返回None"""
+        path = self._path(session_id)
+        try:
+            modified = os.path.getmtime(path)
+        except OSError:
+            return None
+        try:
+            if time_module.time() - modified > self.ttl:
+                os.remove(path)
+                self.stats["expired"] += 1
+                return None
+            with open(path, "rb") as f:
+                state, stored_id = self.decode(f.read())
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning(f"读取会话快照失败（{session_id}），已忽略: {e}")
+            return None
+        if stored_id != session_id:
+            return None
+        self._versions[session_id] = modified
+        self.stats["loaded"] += 1
+        return state
+
+    def changed_elsewhere(self, session_id):
+        """快照是否被其他进程更新过（修改时间与本进程最后一次读写时不同）"""
+        try:
+            modified = os.path.getmtime(self._path(session_id))
+        except OSError:
+            return False
+        return self._versions.get(session_id) != modified
+
+    def _scan(self):
+        """列出目录中的快照：[(路径, 大小, 修改时间)]"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        entries = []
+        for name in names:
+            if not name.endswith(".bin"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _prune(self):
+        """删除过期的快照，仍超过大小上限时从最旧的开始删除，直到降到上限的80%"""
+        entries = sorted(self._scan(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        now = time_module.time()
+        evicted = 0
+        for path, size, modified in entries:
+            if now - modified <= self.ttl and total <= self.max_bytes * 0.8:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        with self._lock:
+            self._bytes = total
+            self.stats["evicted"] += evicted
+        logger.info(f"会话快照超过大小上限，已删除{evicted}个，剩余{total / 1024:.0f}KB")
+
+
+# 已创建的LLM客户端，按(API密钥, 基础URL)缓存，配置变化后自动使用新的客户端
+_openai_clients = {}
+
+
+def lazy_requests():
+    """按需导入requests，避免拖慢插件加载"""
+    import requests
+    return requests
+
+
+def lazy_openai(config):
+    """首次调用LLM时才导入openai；openai>=1.0时为当前配置创建（并缓存）客户端"""
+    import openai
+    if not hasattr(openai, "OpenAI"):
+        # 旧版SDK在每次调用时传入api_key/api_base，不修改模块全局设置
+        return openai, None
+    key = (config.api_key, config.api_base)
+    client = _openai_clients.get(key)
+    if client is None:
+        client = openai.OpenAI(api_key=config.api_key, base_url=config.api_base)
+        _openai_clients[key] = client
+        logger.info(f"OpenAI客户端已初始化 - 基础URL: {config.api_base}, 模型: {config.model}")
+    return openai, client
+
+# 高铁API基础URL
+BASE_URL_HIGHSPEEDTICKET = "https://api.pearktrue.cn/api/highspeedticket"
+
+SeatRecord = namedtuple("SeatRecord", ["name", "price", "inventory", "bookable"])
+TrainRecord = namedtuple("TrainRecord", ["number", "train_type", "from_station", "to_station", "depart_time",
+                                         "arrive_time", "runtime_minutes", "seats"])
+TransferRecord = namedtuple("TransferRecord", ["station", "transfer_minutes", "total_price", "total_runtime_minutes",
+                                               "first_leg", "second_leg"])
+# 一次查询的结果：records为TrainRecord（直达）或TransferRecord（中转）元组，error为失败原因，成功时为None
+QueryResult = namedtuple("QueryResult", ["ticket_type", "from_loc", "to_loc", "date", "time", "records", "error"])
+
+
+def train_record(train):
+    """把车票API返回的车次转换为TrainRecord"""
+    return TrainRecord(
+        number=train.get("trainumber"),
+        train_type=train.get("traintype"),
+        from_station=train.get("departstation"),
+        to_station=train.get("arrivestation"),
+        depart_time=train.get("departtime"),
+        arrive_time=train.get("arrivetime"),
+        runtime_minutes=_runtime_minutes(train.get("runtime")),
+        seats=tuple(SeatRecord(seat.get("seatname"), _to_float(seat.get("seatprice")),
+                               inventory_count(seat.get("seatinventory")), seat.get("bookable") == "有车票")
+                    for seat in train.get("ticket_info") or []),
+    )
+
+
+def transfer_record(route):
+    """把中转方案转换为TransferRecord"""
+    return TransferRecord(
+        station=route["transfer_station"],
+        transfer_minutes=route["transfer_time"],
+        total_price=route["total_price"],
+        total_runtime_minutes=route["total_runtime"],
+        first_leg=train_record(route["first_leg"]),
+        second_leg=train_record(route["second_leg"]),
+    )
+
+
+class TicketEngine:
+    """车票查询引擎：车票API请求、缓存、限流、时间筛选和中转方案搜索，不依赖聊天事件
+
+    插件通过它获取数据，其他服务和基准脚本也可以直接使用：
+        engine = TicketEngine()
+        result = engine.query("高铁", "北京", "上海", "2024-06-05")
+        results = engine.query_many([("高铁", "北京", "上海", "2024-06-05"), ("动车", "广州", "深圳")])
+        transfers = engine.search_transfers("高铁", "成都", "上海", "2024-06-05")
+    query/query_many/search_transfers返回QueryResult结构化记录；同一引擎上的并发查询共享缓存、线程池和限流。
+    """
+
+    def __init__(self, config_watcher=None):
+        if config_watcher is None:
+            config_watcher = ConfigWatcher(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json"))
+        self.config_watcher = config_watcher
+        # 车票API原始结果缓存，键为(车型, 出发地, 目的地, 日期)
+        self.ticket_cache = self.make_cache("车票查询", self._config().ticket_cache_size,
+                                            self._config().ticket_cache_ttl,
+                                            encode=_ticket_encode, decode=_ticket_decode)
+        # 车票结果的发车时间索引（进程内），键同车票缓存，值为(车票结果, DepartureIndex)
+        self._departure_indexes = TTLCache("发车时间索引", max_size=self._config().ticket_cache_size)
+        # 正在后台刷新的车票缓存键，同一线路同时只刷新一次
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
+        self.ticket_fetch_stats = {"negative_hits": 0, "refreshes": 0, "refresh_failures": 0}
+        # 按用途划分的线程池（LLM分块筛选、多日期查询、批量查询等），首次使用时创建
+        self._pools = {}
+        self._pool_lock = threading.Lock()
+
+    def _config(self):
+        """获取当前配置快照"""
+        return self.config_watcher.current()
+
+    def make_cache(self, name, max_size, default_ttl=300, encode=_json_encode, decode=_json_decode):
+        """按cache_backend配置创建缓存：memory为进程内缓存，sqlite为同一台机器上多个进程共享的缓存"""
+        config = self._config()
+        if config.cache_backend == "sqlite":
+            path = config.cache_path or os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache.db")
+            try:
+                return SQLiteCache(name, path, max_size=max_size, default_ttl=default_ttl, encode=encode, decode=decode)
+            except sqlite3.Error as e:
+                logger.error(f"创建共享缓存失败（{path}），改用进程内缓存: {e}")
+        elif config.cache_backend != "memory":
+            logger.warning(f"未知的缓存后端: {config.cache_backend}，使用进程内缓存")
+        return TTLCache(name, max_size=max_size, default_ttl=default_ttl)
+
+    def executor(self, name, workers):
+        """按用途复用的线程池（如LLM分块筛选、多日期查询），线程数配置修改后重新创建"""
+        workers = max(1, workers)
+        with self._pool_lock:
+            pool, size = self._pools.get(name, (None, 0))
+            if pool is None or size != workers:
+                if pool is not None:
+                    pool.shutdown(wait=False)
+                pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"TicketQuery-{name}")
+                self._pools[name] = (pool, workers)
+            return pool
+
+    def stats(self):
+        """引擎的运行统计：车票缓存、缓存刷新、API限流器和字符串驻留"""
+        return {
+            "ticket_cache": self.ticket_cache.stats(),
+            "ticket_fetch": dict(self.ticket_fetch_stats),
+            "rate_limiter": _api_limiter(self._config()).stats(),
+            "interner": dict(_train_interner.stats),
+        }
+
+    def resolve_location(self, location):
+        """用站点词典把站名、拼音、别名统一为所属城市；无法识别时原样返回
+
+        开启strict_station_check且加载了全量站点文件时，无法识别的名称返回None。只有自带词典时
+        县级市、区县车站（如晋江、虎门）都不在词典中，仍原样交给车票API查询。
+        """
+        stations = load_station_dictionary()
+        station = stations.resolve(location)
+        if station:
+            return station.city
+        if self._config().strict_station_check and stations.complete:
+            return None
+        logger.info(f"站点词典中没有'{location}'，原样查询")
+        return location
+
+    def _resolve_route(self, from_loc, to_loc):
+        """返回(出发城市, 到达城市, 错误信息)"""
+        resolved = [self.resolve_location(location) for location in (from_loc, to_loc)]
+        unknown = [location for location, city in zip((from_loc, to_loc), resolved) if city is None]
+        if unknown:
+            return from_loc, to_loc, f"未识别的站点或城市：{'、'.join(unknown)}"
+        return resolved[0], resolved[1], None
+
+    def query(self, ticket_type, from_loc, to_loc, date=None, time="", timeout=None, priority=PRIORITY_INTERACTIVE):
+        """查询直达车次，返回QueryResult（records为TrainRecord元组）
+
+        date默认为今天；time可以是"09:00"（前后time_window_minutes内）或"上午"等时段；
+        timeout为总耗时预算（秒），默认使用query_budget配置，0表示不限制。
+        """
+        ticket_type = normalize_ticket_type(ticket_type)
+        date = date or datetime.now().strftime("%Y-%m-%d")
+        from_loc, to_loc, error = self._resolve_route(from_loc, to_loc)
+        if error:
+            return QueryResult(ticket_type, from_loc, to_loc, date, time, (), error)
+        
+        deadline = Deadline(self._config().query_budget if timeout is None else timeout)
+        trains = self.get_ticket_info(ticket_type, from_loc, to_loc, date, time, priority, deadline)
+        if trains is None:
+            error = "查询超时" if deadline.expired() else "车票查询失败"
+        return QueryResult(ticket_type, from_loc, to_loc, date, time,
+                           tuple(train_record(train) for train in trains or ()), error)
+
+    def query_many(self, queries, workers=None, timeout=None):
+        """并发执行一批直达查询，按输入顺序返回QueryResult列表
+
+        每个查询是query的位置参数元组（车型, 出发地, 目的地[, 日期[, 时间]]）或关键字参数字典；
+        批量请求按扇出优先级限流，排队时让位于用户直接发起的查询。
+        """
+        queries = [dict(query) if isinstance(query, dict)
+                   else dict(zip(("ticket_type", "from_loc", "to_loc", "date", "time"), query))
+                   for query in queries]
+        executor = self.executor("batch", workers or self._config().batch_workers)
+        start = time_module.monotonic()
+        futures = [executor.submit(self.query, priority=PRIORITY_FANOUT,
+                                   **{"timeout": timeout, **query}) for query in queries]
+        results = []
+        for query, future in zip(queries, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.error(f"批量查询失败: {query}: {e}")
+                results.append(QueryResult(query.get("ticket_type"), query.get("from_loc"), query.get("to_loc"),
+                                           query.get("date"), query.get("time", ""), (), f"查询出错: {e}"))
+        failed = sum(1 for result in results if result.error)
+        logger.info(f"批量查询完成: {len(results)}个查询，失败{failed}个，耗时{time_module.monotonic() - start:.2f}秒，"
+                    f"车票缓存命中率：{self.ticket_cache.hit_ratio():.1%}")
+        return results
+
+    def search_transfers(self, ticket_type, from_loc, to_loc, date=None, time=None, via=None, timeout=None):
+        """搜索中转方案，返回QueryResult（records为按综合评分排序的TransferRecord元组）
+
+        via指定中转城市，默认使用预定义中转站或主要枢纽；耗时预算用完时返回已找到的方案，error为None。
+        """
+        ticket_type = normalize_ticket_type(ticket_type)
+        date = date or datetime.now().strftime("%Y-%m-%d")
+        from_loc, to_loc, error = self._resolve_route(from_loc, to_loc)
+        if not error and via:
+            via = self.resolve_location(via)
+            if via is None:
+                error = "未识别的中转站"
+        if error:
+            return QueryResult(ticket_type, from_loc, to_loc, date, time, (), error)
+        
+        deadline = Deadline(self._config().query_budget if timeout is None else timeout)
+        stations = self.find_transfer_stations(from_loc, to_loc, via)
+        routes = self.search_transfer_routes(ticket_type, from_loc, to_loc, stations, date, time, deadline=deadline)
+        if not routes:
+            error = "查询超时" if deadline.expired() else "未找到合适的中转方案"
+        return QueryResult(ticket_type, from_loc, to_loc, date, time,
+                           tuple(transfer_record(route) for route in routes), error)
+
+    def get_ticket_info(self, ticket_type, from_loc, to_loc, date, time="", priority=PRIORITY_INTERACTIVE,
+                        deadline=None):
+        """调用票务API获取数据；priority决定限流排队时的先后（交互查询优先于中转扇出和后台请求），
+        deadline为耗时预算，未传入时不限时；返回原始车次字典列表，失败时返回None"""
+        logger.info(f"开始查询车票信息：{ticket_type} {from_loc}->{to_loc} 日期：{date} 时间：{time}")
+        
+        raw_data = self.fetch_tickets(ticket_type, from_loc, to_loc, date, priority, deadline)
+        if raw_data is None:
+            return None
+        
+        index = self._departure_index((ticket_type, from_loc, to_loc, date), raw_data)
+        filtered_trains = self._process_api_data(raw_data, ticket_type, time, index)
+        logger.info(f"筛选后剩余{len(filtered_trains)}条数据")
+        
+        if not filtered_trains:
+            logger.warning("筛选后没有符合条件的车次")
+        return filtered_trains
+
+    def fetch_tickets(self, ticket_type, from_loc, to_loc, date, priority=PRIORITY_INTERACTIVE, deadline=None,
+                      allow_stale=True):
+        """请求车票API，返回未经筛选的原始车次列表；结果短期缓存，同一线路和日期不重复请求
+
+        缓存过期但仍在容忍期内时立即返回旧结果，同时在后台刷新一次；allow_stale为False时
+        （如余票订阅需要比较余票变化）不使用旧结果，直接请求API。
+        查询失败或没有车次的线路写入短期负缓存，有效期内直接返回，不再请求API。
+        """
+        key = (ticket_type, from_loc, to_loc, date)
+        if allow_stale:
+            cached, stale = self.ticket_cache.get_stale(key)
+        else:
+            cached, stale = self.ticket_cache.get(key), False
+        if cached is FAILED_LOOKUP:
+            with self._refresh_lock:
+                self.ticket_fetch_stats["negative_hits"] += 1
+            logger.info(f"车票负缓存命中：{ticket_type} {from_loc}->{to_loc} {date} 最近查询失败，暂不重复请求")
+            return None
+        if cached is not None:
+            if stale:
+                logger.info(f"车票缓存已过期，先返回旧结果并在后台刷新：{ticket_type} {from_loc}->{to_loc} {date}，"
+                            f"已返回旧结果{self.ticket_cache.stale_hits}次")
+                self._refresh_tickets(key)
+            else:
+                logger.info(f"车票缓存命中：{ticket_type} {from_loc}->{to_loc} {date}，命中率：{self.ticket_cache.hit_ratio():.1%}")
+            return cached
+        
+        return self.request_tickets(key, priority, deadline or Deadline())
+
+    def _refresh_tickets(self, key):
+        """在后台重新请求一条过期的车票缓存，同一线路同时只有一个刷新任务"""
+        with self._refresh_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            self.ticket_fetch_stats["refreshes"] += 1
+        
+        def refresh():
+            try:
+                if self.request_tickets(key, PRIORITY_PREFETCH, Deadline(), keep_stale=True) is None:
+                    with self._refresh_lock:
+                        self.ticket_fetch_stats["refresh_failures"] += 1
+            finally:
+                with self._refresh_lock:
+                    self._refreshing.discard(key)
+        
+        self.executor("refresh", 2).submit(refresh)
+
+    def _ticket_cache_windows(self, ticket_type):
+        """按车型返回缓存的(有效期, 旧结果容忍期)，普通列车余票变化较慢，可以缓存更久"""
+        config = self._config()
+        if normalize_ticket_type(ticket_type) == "普通":
+            return config.normal_train_cache_ttl, config.normal_train_cache_stale
+        return config.ticket_cache_ttl, config.ticket_cache_stale
+
+    def request_tickets(self, key, priority, deadline, keep_stale=False):
+        """请求车票API并写入缓存，失败时返回None
+
+        接口报错、超时或没有车次时写入负缓存；后台刷新（keep_stale）失败时保留原有的旧结果。
+        因本地排队超时或耗时预算用完而失败时不写入负缓存。
+        """
+        ticket_type, from_loc, to_loc, date = key
+        config = self._config()
+        
+        def remember_failure():
+            if not keep_stale and config.negative_cache_ttl > 0:
+                self.ticket_cache.set(key, FAILED_LOOKUP, ttl=config.negative_cache_ttl)
+            return None
+        
+        if deadline.expired():
+            logger.warning(f"查询耗时预算已用完（{deadline.budget}秒），跳过请求：{from_loc}->{to_loc} {date}")
+            return None
+        
+        # 进程内共享限流，排队时高优先级请求先发出
+        limiter = _api_limiter(config)
+        waited = limiter.acquire(priority, timeout=deadline.timeout(config.api_queue_timeout))
+        if waited is None or deadline.expired():
+            logger.error(f"车票API请求排队超时（{PRIORITY_NAMES[priority]}，队列长度{limiter.queue_depth()}）")
+            return None
+        if waited > 0.1:
+            logger.info(f"车票API请求排队{waited:.2f}秒（{PRIORITY_NAMES[priority]}），限流统计：{limiter.stats()}")
+        
+        requests = lazy_requests()
+        # 构建查询参数
+        params = {
+            "from": from_loc,
+            "to": to_loc,
+            "time": date,  # API参数为time而不是date
+            "type": ticket_type
+        }
+        
+        # 输出完整请求URL
+        param_str = "&".join([f"{k}={v}" for k, v in params.items()])
+        full_url = f"{BASE_URL_HIGHSPEEDTICKET}?{param_str}"
+        logger.info(f"请求URL：{full_url}")
+        
+        # 超时时间被耗时预算截短时，超时不代表接口故障
+        timeout = deadline.timeout(config.api_timeout)
+        try:
+            start = time_module.perf_counter()
+            resp = requests.get(BASE_URL_HIGHSPEEDTICKET, params=params, timeout=timeout)
+            logger.info(f"API响应状态码：{resp.status_code}")
+            # 只输出前200个字节避免日志过长（不用resp.text，避免对整个响应做编码检测和解码）
+            logger.info(f"API响应内容：{resp.content[:200].decode('utf-8', 'replace')}...")
+            
+            if resp.status_code != 200:
+                logger.error(f"API请求失败，状态码：{resp.status_code}")
+                return remember_failure()
+                
+            try:
+                # 直接解析响应字节，安装了orjson时使用orjson
+                data = _json_loads(resp.content)
+                logger.info(f"API返回code：{data.get('code')}")
+                logger.info(f"API返回msg：{data.get('msg')}")
+                
+                if data.get('code') == 200:
+                    raw_data = data.get('data', [])
+                    logger.info(f"获取到{len(raw_data)}条原始数据")
+                    
+                    if not raw_data:
+                        # 没有车次的线路短期内不会有变化，按负缓存处理
+                        if config.negative_cache_ttl > 0:
+                            self.ticket_cache.set(key, raw_data, ttl=config.negative_cache_ttl)
+                        return raw_data
+                    
+                    # 处理数据前先输出几条样例
+                    logger.info(f"数据样例：{raw_data[0]}")
+                    
+                    # 写入缓存前去重：重复的字符串和座位结构在各条线路的结果之间共用
+                    raw_data = _train_interner.trains(raw_data)
+                    fresh, stale = self._ticket_cache_windows(ticket_type)
+                    self.ticket_cache.set(key, raw_data, ttl=fresh, stale=stale,
+                                          cost=time_module.perf_counter() - start)
+                    return raw_data
+                else:
+                    error_msg = data.get('msg', '未知错误')
+                    logger.error(f"API返回错误：{error_msg}")
+                    return remember_failure()
+                    
+            except json.JSONDecodeError as je:
+                logger.error(f"JSON解析错误：{je}")
+                logger.error(f"原始响应内容：{resp.text}")
+                return remember_failure()
+                
+        except requests.exceptions.Timeout:
+            logger.error(f"API请求超时（{timeout:.1f}秒）")
+            if timeout < config.api_timeout:
+                return None
+            return remember_failure()
+        except requests.exceptions.RequestException as e:
+            logger.error(f"请求异常：{e}")
+            return remember_failure()
+        except Exception as e:
+            logger.error(f"未知错误：{str(e)}")
+            logger.error(f"错误详情：{traceback.format_exc()}")
+            return None
+
+    def _process_api_data(self, data, ticket_type, query_time, index=None):
+        """处理API返回数据：按车型和发车时间筛选，结果按发车时间排序
+
+        index为该结果的DepartureIndex（随车票缓存复用），未传入时现场构建；
+        只依赖参数，不读写会话状态，可以在多个线程中并发调用。
+        """
+        logger.info(f"处理API数据：车型={ticket_type}, 查询时间={query_time}")
+        logger.info(f"收到{len(data)}条数据待处理")
+        
+        # 标准化查询车型，确保与API返回数据兼容
+        standard_ticket_type = normalize_ticket_type(ticket_type)
+        
+        # 时间段（如"上午"）、近似时间（如"10:30"、"10:30左右"，前后time_window_minutes分钟）
+        # 和单侧时间（如"14:00之后"）都换算为发车时间范围
+        time_window = parse_departure_window(query_time, self._config().time_window_minutes)
+        if time_window:
+            start, end = time_window
+            describe = lambda minutes: "不限" if minutes is None else f"{minutes // 60:02d}:{minutes % 60:02d}"
+            logger.info(f"使用发车时间范围筛选：{describe(start)}至{describe(end)}")
+        else:
+            start = end = None
+            if query_time:
+                logger.info(f"无法识别的时间条件，不按时间筛选：{query_time}")
+        
+        if index is None:
+            index = DepartureIndex(data)
+        # 共享缓存中按需解析的车次只在这里（通过筛选后）解析座位等详情
+        filtered = [_materialize(item) for item in index.window(standard_ticket_type, start, end)]
+        logger.info(f"筛选完成，共有{len(filtered)}条符合条件的车次")
+        
+        return filtered
+
+    def _departure_index(self, key, trains):
+        """该线路车票结果的发车时间索引；车票缓存更新（结果换成新的列表）后重新构建"""
+        entry = self._departure_indexes.get(key)
+        if entry is not None and entry[0] is trains:
+            return entry[1]
+        index = DepartureIndex(trains)
+        fresh, stale = self._ticket_cache_windows(key[0])
+        self._departure_indexes.set(key, (trains, index), ttl=fresh + stale)
+        return index
+
+    def find_transfer_stations(self, from_loc, to_loc, user_specified=None):
+        """确定中转站"""
+        logger.info(f"寻找从{from_loc}到{to_loc}的中转站")
+        
+        # 1. 如果用户指定了中转站，优先使用
+        if user_specified:
+            logger.info(f"使用用户指定的中转站: {user_specified}")
+            return [user_specified]
+            
+        # 2. 查找预定义的中转站
+        key = (from_loc, to_loc)
+        if key in TRANSFER_STATIONS:
+            logger.info(f"使用预定义的中转站: {TRANSFER_STATIONS[key]}")
+            return TRANSFER_STATIONS[key]
+            
+        # 3. 使用主要枢纽站作为候选中转站
+        # 实际应用中，这里可以调用API查询更精确的中转站
+        # 为了简化，这里暂时使用主要枢纽站中的前N个（transfer_hub_count，默认5个）
+        # 在实际实现中，应该根据地理位置和线路优化选择
+        logger.info("没有预定义中转站，使用主要枢纽站作为候选")
+        return MAJOR_STATIONS[:self._config().transfer_hub_count]
+
+    def search_transfer_routes(self, ticket_type, from_loc, to_loc, transfer_stations, date, time=None,
+                                deadline=None):
+        """查询中转路线；耗时预算用完时停止查询剩余的中转站，返回已找到的最优方案"""
+        logger.info(f"开始查询中转路线: {from_loc} -> [中转] -> {to_loc}")
+        deadline = deadline or Deadline()
+        
+        config = self._config()
+        ranker = TransferRanker(
+            config.min_transfer_time, config.max_transfer_time,  # 换乘时间范围（分钟）
+            weights=(config.transfer_weight_runtime, config.transfer_weight_price, config.transfer_weight_slack),
+            limit=config.transfer_result_limit)
+        
+        for searched, transfer_station in enumerate(transfer_stations):
+            if deadline.expired():
+                logger.warning(f"查询耗时预算已用完（{deadline.budget}秒），跳过剩余{len(transfer_stations) - searched}个中转站，"
+                               f"返回已找到的方案")
+                break
+            logger.info(f"查询经由 {transfer_station} 的中转路线")
+            
+            # 查询第一段: 出发地 -> 中转站
+            first_leg = self.get_ticket_info(ticket_type, from_loc, transfer_station, date, time,
+                                           priority=PRIORITY_FANOUT, deadline=deadline)
+            if not first_leg:
+                logger.warning(f"未找到从 {from_loc} 到 {transfer_station} 的车次")
+                continue
+                
+            logger.info(f"找到从 {from_loc} 到 {transfer_station} 的车次数量: {len(first_leg)}")
+            
+            # 查询第二段: 中转站 -> 目的地
+            second_leg = self.get_ticket_info(ticket_type, transfer_station, to_loc, date, None,
+                                            priority=PRIORITY_FANOUT, deadline=deadline)
+            if not second_leg:
+                logger.warning(f"未找到从 {transfer_station} 到 {to_loc} 的车次")
+                continue
+                
+            logger.info(f"找到从 {transfer_station} 到 {to_loc} 的车次数量: {len(second_leg)}")
+            
+            # 匹配合适的中转方案，只保留帕累托前沿上的方案
+            candidates_before = ranker.candidates
+            ranker.add_station(transfer_station, first_leg, second_leg)
+            logger.info(f"经由 {transfer_station} 的可行组合: {ranker.candidates - candidates_before}个，"
+                        f"当前前沿: {len(ranker.frontier)}个")
+        
+        routes = ranker.top()
+        logger.info(f"共找到{ranker.candidates}个可行的中转方案，帕累托前沿保留{len(ranker.frontier)}个"
+                    f"（剪枝率{ranker.pruning_ratio():.1%}），返回{len(routes)}个")
+        return routes